@@ -1,78 +1,282 @@
 import argparse
-import importlib
+import os
 import threading
+import time
 from http.server import BaseHTTPRequestHandler
 from pathlib import Path
 from time import sleep
 from urllib.parse import urlparse, parse_qs
 import orjson
 
+from extractors.lazy_extractor import LazyExtractor
+from extractors.models import model_tag as model_tag_for
+from handlers.health_handler import HealthHandler, LoadingHandler
+from handlers.duplicates_handler import DuplicatesHandler
+from handlers.jobs_handler import JobsHandler
+from handlers.metrics_handler import MetricsHandler
 from handlers.remove_handler import RemoveHandler
 from handlers.stats_handler import StatsHandler
+from helpers.request_helper import parse_body
 from providers.database import Database
+from providers.metrics import Gauge, registry, response_body, route_label, track_request
+from providers.descriptor_store import DescriptorStore
+from providers.feature_cache import FeatureCache
+from providers.inference_scheduler import InferenceScheduler
+from providers.search_cache import SearchCache
+from providers.startup import Startup
+from providers.jobs import JobManager
 from providers.webserver import WebServer
+from providers.async_webserver import AsyncWebServer
 
 from handlers.add_handler import AddHandler
 from handlers.search_handler import SearchHandler
+from handlers.search_batch_handler import SearchBatchHandler
 
 shutdown_event = threading.Event()
 
 # Parse command-line arguments
 parser = argparse.ArgumentParser(description="Run the feature extraction web server.")
-parser.add_argument("--extractor",default="clip", type=str, choices=["clip", "resnet"], required=False, help="Choose which feature extractor to use (clip or resnet)")
+parser.add_argument("command", nargs="?", default="serve", choices=["serve", "rebuild-store", "evaluate-index", "benchmark-extractor", "ingest", "find-duplicates"], help="serve = run the web server (default), ingest = add the images in TARGET without starting the server, find-duplicates = group near-duplicate images in the database, rebuild-store = regenerate the memory-mapped vector store from the SQLite database, evaluate-index = report recall, latency and memory of --index against an exact search, benchmark-extractor = compare the speed and accuracy of the CLIP inference modes on --benchmark-images")
+parser.add_argument("target", nargs="?", default=None, help="For the ingest command, a directory of images or a text file with one image path per line")
+parser.add_argument("--extractor",default="clip", type=str, choices=["clip", "resnet", "stub"], required=False, help="Choose which feature extractor to use (clip or resnet, stub = a random projection of the pixels for benchmarks and testing without a model)")
+parser.add_argument("--clip-model", dest="clip_model", default="large", type=str, choices=["large", "base"], required=False, help="CLIP model (large = ViT-L/14, base = ViT-B/32 which is several times faster on CPU)")
+parser.add_argument("--precision", dest="precision", default="float32", type=str, choices=["float32", "bf16", "int8"], required=False, help="CLIP inference precision (bf16 = bfloat16 autocast, int8 = dynamic quantization of the linear layers on CPU)")
+parser.add_argument("--compile", dest="compile", action="store_true", help="Run the CLIP image encoder through torch.compile (slower startup, faster inference)")
+parser.add_argument("--benchmark-images", dest="benchmark_images", default="", type=str, required=False, help="Directory of sample images for the benchmark-extractor command.")
+parser.add_argument("--benchmark-sample", dest="benchmark_sample", default=64, type=int, required=False, help="Number of images used by the benchmark-extractor command.")
+parser.add_argument("--data-dir", dest="data_dir", default=str(Path(__file__).parent.resolve() / "data"), type=str, required=False, help="Directory holding the databases.")
 parser.add_argument("--host",default="localhost", type=str, required=False, help="Webserver host")
 parser.add_argument("--port",default=8080, type=int, required=False, help="Webserver port")
+parser.add_argument("--server", dest="server", default="threaded", type=str, choices=["threaded", "async"], required=False, help="threaded = one thread per connection, async = asyncio server with keep-alive, a concurrency limit and streamed responses")
+parser.add_argument("--max-concurrency", dest="max_concurrency", default=32, type=int, required=False, help="With --server async, the number of requests handled at once before new requests get a 429 response.")
+parser.add_argument("--max-body", dest="max_body", default=256, type=int, required=False, help="With --server async, the largest request body accepted in MB.")
 parser.add_argument("--verbose", "-v", dest="verbose", default=0, type=int, required=False, help="Level of log output (0 = Not much, 1 = Info, 2 = Debug")
 parser.add_argument("--output", dest="output", default=100, type=int, required=False, help="Output the count log after processing this many images.")
 parser.add_argument("--update",dest="update_flag", action="store_true", help="Update an image if it already exists, instead of skipping it. (Default False")
-parser.add_argument("--threads", dest="threads", default=2, type=int, required=False, help="Number of threads to run during image processing.")
+parser.add_argument("--threads", dest="threads", default=2, type=int, required=False, help="Number of processes used to decode and preprocess images when adding a directory.")
+parser.add_argument("--inference-threads", dest="inference_threads", default=1, type=int, required=False, help="Number of threads running the model when adding a directory.")
+parser.add_argument("--batch-size", dest="batch_size", default=16, type=int, required=False, help="Number of images sent to the extractor in a single forward pass when adding a directory.")
+parser.add_argument("--batch-wait", dest="batch_wait", default=0.05, type=float, required=False, help="Maximum seconds to wait for a batch to fill before running a partial batch.")
+parser.add_argument("--scheduler-batch", dest="scheduler_batch", default=32, type=int, required=False, help="Maximum images in one forward pass when concurrent requests are combined by the inference scheduler (0 = each request runs the model itself).")
+parser.add_argument("--scheduler-wait", dest="scheduler_wait", default=0.005, type=float, required=False, help="Seconds the inference scheduler waits for more requests before running a partial batch.")
+parser.add_argument("--write-batch", dest="write_batch", default=256, type=int, required=False, help="Number of images written to the database in a single transaction when adding a directory.")
+parser.add_argument("--write-interval", dest="write_interval", default=1.0, type=float, required=False, help="Maximum seconds an added image waits before the database writer commits it.")
+parser.add_argument("--queue-depth", dest="queue_depth", default=64, type=int, required=False, help="Maximum number of images waiting between each stage of the ingest pipeline.")
+parser.add_argument("--warmup", dest="warmup", action="store_true", help="Load the model in the background as soon as the server starts, instead of on the first request that needs it.")
+parser.add_argument("--ingest-workers", dest="ingest_workers", default=0, type=int, required=False, help="Number of worker processes for the ingest command, each loads its own copy of the model (0 = a quarter of the cores).")
 parser.add_argument("--write-only",dest="write_only", action="store_true", help="When loading the database load the keys only, image searching will not work, but it is useful for updating the database without loading the full dataset (Default False")
+parser.add_argument("--index", dest="index", default="exact", type=str, choices=["exact", "ivf", "pq", "sq8"], required=False, help="Vector index used for searching (exact = brute force, ivf = approximate inverted file index, pq = product quantized, sq8 = 8 bit scalar quantized)")
+parser.add_argument("--shards", dest="shards", default=1, type=int, required=False, help="Split the exact index across this many search worker processes so concurrent searches use several cores (1 = search in the server process).")
+parser.add_argument("--ivf-lists", dest="ivf_lists", default=0, type=int, required=False, help="Number of k-means buckets in the ivf index (0 = 4 * sqrt(number of images)).")
+parser.add_argument("--ivf-probe", dest="ivf_probe", default=8, type=int, required=False, help="Number of ivf buckets scanned per search.  Higher gives better recall but slower searches.")
+parser.add_argument("--pq-subvectors", dest="pq_subvectors", default=96, type=int, required=False, help="Number of one byte codes per vector in the pq index.")
+parser.add_argument("--train-size", dest="train_size", default=20000, type=int, required=False, help="Number of sampled images used to train the ivf, pq and sq8 indexes.")
+parser.add_argument("--rerank", dest="rerank", default=0, type=int, required=False, help="For pq / sq8, re-score the best k * rerank candidates with the full precision vectors from SQLite (0 = off).")
+parser.add_argument("--storage", dest="storage", default="float32", type=str, choices=["float32", "float16"], required=False, help="Precision of the vectors held in memory for searching (float16 halves the memory)")
+parser.add_argument("--feature-cache", dest="feature_cache", default="content", type=str, choices=["content", "header", "off"], required=False, help="Reuse features of images whose bytes were already extracted (content = hash whole file, header = hash first/last 64KB and size, faster but files which only differ in the middle share features)")
+parser.add_argument("--search-cache", dest="search_cache", default=64, type=int, required=False, help="MB of memory for caching the features and results of repeated searches (0 = off).")
+parser.add_argument("--descriptors", dest="descriptors", default="", type=str, required=False, help="Comma separated comparator descriptors to precompute while adding images (sift, orb, histogram)")
+parser.add_argument("--descriptor-features", dest="descriptor_features", default=500, type=int, required=False, help="Maximum SIFT / ORB keypoints kept per image in the descriptor store.")
+parser.add_argument("--compare-workers", dest="compare_workers", default=os.cpu_count() or 1, type=int, required=False, help="Number of processes used to run comparators on search results (0 = run them in the request thread).")
+parser.add_argument("--compare-timeout", dest="compare_timeout", default=10.0, type=float, required=False, help="Seconds each search may spend on comparators before remaining results are reported as timed out (0 = no limit).")
+parser.add_argument("--duplicate-threshold", dest="duplicate_threshold", default=0.25, type=float, required=False, help="Largest distance (as reported by /search) between two images counted as near-duplicates.")
+parser.add_argument("--duplicate-block", dest="duplicate_block", default=4096, type=int, required=False, help="Rows compared at once when finding duplicates, each worker holds a few blocks x blocks distance matrix.")
+parser.add_argument("--duplicate-workers", dest="duplicate_workers", default=os.cpu_count() or 1, type=int, required=False, help="Number of processes comparing blocks when finding duplicates.")
+parser.add_argument("--duplicate-output", dest="duplicate_output", default="", type=str, required=False, help="JSON file for the find-duplicates groups (default data/<extractor>.duplicates.json).")
+parser.add_argument("--no-vector-store", dest="vector_store", action="store_false", help="Load vectors from SQLite instead of the memory-mapped vector store")
 params_args = parser.parse_args()
 
-# Dynamically import the chosen extractor
-extractor_module = importlib.import_module(f"extractors.{params_args.extractor}_extractor")
-FeatureExtractor = getattr(extractor_module, f"{params_args.extractor.capitalize()}Extractor")
+# Other CLIP models and precisions get their own database so their vectors are never mixed
+database_name = params_args.extractor
+if params_args.extractor == "clip" and params_args.clip_model != "large":
+    database_name += f"-{params_args.clip_model}"
+if params_args.extractor == "clip" and params_args.precision != "float32":
+    database_name += f"-{params_args.precision}"
+Path(params_args.data_dir).mkdir(parents=True, exist_ok=True)
+database_path = Path(params_args.data_dir) / database_name
+index_options = {"nlist": params_args.ivf_lists, "nprobe": params_args.ivf_probe, "dtype": params_args.storage,
+                 "subvectors": params_args.pq_subvectors, "train_size": params_args.train_size, "rerank": params_args.rerank,
+                 "shards": params_args.shards}
 
+extractor_options = {}
+if params_args.extractor == "clip":
+    extractor_options = {"model": params_args.clip_model, "precision": params_args.precision, "compile": params_args.compile}
 
-# Initialize the selected feature extractor
-feature_extractor = FeatureExtractor()
+if params_args.command == "benchmark-extractor":
+    from extractors.benchmark import benchmark_clip
+    report = benchmark_clip(params_args.benchmark_images, params_args.benchmark_sample, params_args.batch_size)
+    print(orjson.dumps(report, option=orjson.OPT_INDENT_2).decode())
+    exit(0)
 
-# Initialize the database
-database = Database(Path(__file__).parent.resolve() / "data" / f"{params_args.extractor}")
-database.load(params_args.write_only)
+if params_args.command == "rebuild-store":
+    database = Database(database_path)
+    database.rebuild_store()
+    database.close()
+    exit(0)
+
+if params_args.command == "evaluate-index":
+    database = Database(database_path, index_type=params_args.index, index_options=index_options, use_store=params_args.vector_store)
+    database.load()
+    print(orjson.dumps(database.evaluate_index(), option=orjson.OPT_INDENT_2).decode())
+    database.close()
+    exit(0)
+
+if params_args.command == "find-duplicates":
+    from providers.duplicates import DuplicateFinder
+    database = Database(database_path, use_store=False)
+    finder = DuplicateFinder(database, params_args.duplicate_threshold, params_args.duplicate_block, params_args.duplicate_workers,
+                             params_args.duplicate_output or None, verbose=1)
+    print(orjson.dumps(finder.run(), option=orjson.OPT_INDENT_2).decode())
+    database.close()
+    exit(0)
+
+if params_args.command == "ingest":
+    from providers.offline_ingest import OfflineIngest
+    if not params_args.target or not Path(params_args.target).exists():
+        parser.error("ingest needs a directory or file list as TARGET")
+    database = Database(database_path, use_store=params_args.vector_store)
+    try:
+        database.check_model_tag(model_tag_for(params_args.extractor, **extractor_options), model_tag_for(params_args.extractor))
+    except ValueError as e:
+        print(e)
+        exit(1)
+    database.load(write_only=True)
+    if params_args.descriptors:
+        database.descriptor_store = DescriptorStore(database, params_args.descriptors.split(","), params_args.descriptor_features)
+    settings = {"extractor": params_args.extractor, "extractor_options": extractor_options,
+                "decode_workers": params_args.threads, "batch_size": params_args.batch_size, "batch_wait": params_args.batch_wait,
+                "write_batch": params_args.write_batch, "write_interval": params_args.write_interval, "queue_depth": params_args.queue_depth,
+                "descriptors": params_args.descriptors.split(",") if params_args.descriptors else [],
+                "descriptor_features": params_args.descriptor_features, "output": params_args.output, "verbose": params_args.verbose}
+    workers = params_args.ingest_workers or max(1, (os.cpu_count() or 1) // 4)
+    report = OfflineIngest(database, workers, settings, params_args.update_flag).run(params_args.target)
+    if database.store is not None:
+        database.rebuild_store()
+    database.close()
+    print(orjson.dumps(report, option=orjson.OPT_INDENT_2).decode())
+    exit(0)
+
+startup = Startup()
+
+# The model is only loaded on first use, or in the background with --warmup
+feature_extractor = LazyExtractor(params_args.extractor, extractor_options, startup)
+model_tag = feature_extractor.model_tag
+if params_args.scheduler_batch > 0:
+    feature_extractor = InferenceScheduler(feature_extractor, params_args.scheduler_batch, params_args.scheduler_wait)
+
+# Initialize the database, the vectors are loaded in the background once the server is running
+with startup.phase("database_open"):
+    database = Database(database_path,
+                        index_type=params_args.index,
+                        index_options=index_options,
+                        use_store=params_args.vector_store)
+    try:
+        database.check_model_tag(model_tag, model_tag_for(params_args.extractor))  # The original model before tags were saved
+    except ValueError as e:
+        print(e)
+        exit(1)
+database.startup = startup
 database.verbose = params_args.verbose
+if params_args.feature_cache != "off":
+    database.feature_cache = FeatureCache(database, params_args.feature_cache)
+if params_args.descriptors:
+    database.descriptor_store = DescriptorStore(database, params_args.descriptors.split(","), params_args.descriptor_features)
+if params_args.search_cache > 0:
+    database.search_cache = SearchCache(database, model_tag, params_args.search_cache * 1024 * 1024)
+database.jobs = JobManager(params_args, feature_extractor, database, shutdown_event)
+
+# Read on every /metrics scrape
+registry.add(Gauge("image_search_images", "Images in the database", database.count))
+registry.add(Gauge("image_search_index_vectors", "Vectors in the search index", lambda: len(database.index)))
+registry.add(Gauge("image_search_index_memory_bytes", "Bytes of index vectors held in memory", database.index.memory))
+if isinstance(feature_extractor, InferenceScheduler):
+    registry.add(Gauge("image_search_inference_queued", "Images waiting for the inference scheduler", feature_extractor.queue.qsize))
+
+
+def load_database():
+    try:
+        with startup.phase("database_load"):
+            database.load(params_args.write_only)
+        database.start_writer(params_args.write_batch, params_args.write_interval)
+        database.jobs.start()
+    except Exception as e:
+        startup.fail(f"Could not load the database: {e}")  # The main loop stops the server
+        return
+    startup.ready()
+
+
+def warm_up():
+    try:
+        feature_extractor.load()
+    except Exception as e:
+        print(f"Could not load the {params_args.extractor} extractor: {e}")
+
+
+routes = {
+    "/health": HealthHandler,
+    "/add": AddHandler,
+    "/search": SearchHandler,
+    "/search_batch": SearchBatchHandler,
+    "/stats": StatsHandler,
+    "/remove": RemoveHandler,
+    "/jobs": JobsHandler,
+    "/duplicates": DuplicatesHandler,
+    "/metrics": MetricsHandler,
+}
+
+
+def create_handler(handler_class, request):
+    if not database.ready.is_set() and getattr(handler_class, "needs_database", True):
+        handler_class = LoadingHandler  # Answers until the database has finished loading
+    return handler_class(params_args, request, feature_extractor, database, shutdown_event)
 
 
 class SimpleHTTPRequestHandler(BaseHTTPRequestHandler):
     def __init__(self, *args, **kwargs):
         """ Initialize request handler and define routes. """
-        self.routes = {
-            "/add": AddHandler,
-            "/search": SearchHandler,
-            "/stats": StatsHandler,
-            "/remove": RemoveHandler,
-        }
+        self.routes = routes
         super().__init__(*args, **kwargs)  # Call parent constructor
 
-    def json(self, data):
-        self.send_response(200)
+    def json(self, data, status=200):
+        body = response_body(data)
+        self.send_response(status)
         self.send_header("Content-Type", "application/json")
         self.end_headers()
-        self.wfile.write(orjson.dumps(data))
+        self.wfile.write(body)
+
+    def text(self, body, content_type="text/plain; charset=utf-8"):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.end_headers()
+        self.wfile.write(body.encode("utf-8"))
+
+    def ndjson(self, rows):
+        """ Streams an iterable of results as newline delimited JSON, one line per row as it is produced. """
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.end_headers()
+        for row in rows:
+            self.wfile.write(orjson.dumps(row) + b"\n")
+            self.wfile.flush()
 
     def not_found(self):
         self.send_response(404)
         self.end_headers()
         self.wfile.write(orjson.dumps({"error": "Not Found"}))
 
+    def route(self, path):
+        """ Finds the handler for a path, falling back to the first path segment for routes like /jobs/<id>. """
+        return self.routes.get(path) or self.routes.get("/" + path.strip("/").split("/")[0])
+
     def do_GET(self):
         parsed_url = urlparse(self.path)
         query_params = parse_qs(parsed_url.query)
 
-        handler_class = self.routes.get(parsed_url.path)
+        handler_class = self.route(parsed_url.path)
 
         if handler_class:
-            handler_class(params_args, self, feature_extractor, database, shutdown_event).handle(query_params)
+            with track_request(route_label(parsed_url.path), query_params):
+                create_handler(handler_class, self).handle(query_params)
         else:
             self.not_found()
 
@@ -87,33 +291,51 @@ class SimpleHTTPRequestHandler(BaseHTTPRequestHandler):
             print("Finished receiving post data")
 
         try:
-            json_data = orjson.loads(post_data)  # Parse JSON data
-        except orjson.JSONDecodeError:
-            return self.json({"error": "Invalid JSON"})
+            json_data = parse_body(self.path, self.headers.get("Content-Type"), post_data)  # JSON, multipart or raw image
+        except ValueError as e:
+            return self.json({"error": str(e)})
 
         parsed_url = urlparse(self.path)
 
         if params_args.verbose > 1:
             print(f"Loading request handler for {parsed_url.path}")
 
-        handler_class = self.routes.get(parsed_url.path)
+        handler_class = self.route(parsed_url.path)
 
         if handler_class:
-            handler_class(params_args, self, feature_extractor, database, shutdown_event).handle(json_data)
+            with track_request(route_label(parsed_url.path), json_data):
+                create_handler(handler_class, self).handle(json_data)
         else:
             self.not_found()
 
 if __name__ == "__main__":
-    webServer = WebServer(SimpleHTTPRequestHandler, params_args.host, params_args.port)
+    if params_args.server == "async":
+        webServer = AsyncWebServer(routes, create_handler, params_args.host, params_args.port,
+                                   max_concurrency=params_args.max_concurrency,
+                                   max_body=params_args.max_body * 1024 * 1024,
+                                   verbose=params_args.verbose)
+    else:
+        webServer = WebServer(SimpleHTTPRequestHandler, params_args.host, params_args.port)
     webServer.start()
+    startup.record("server_start", time.monotonic() - startup.started)
+    threading.Thread(target=load_database, daemon=True).start()
+    if params_args.warmup:
+        threading.Thread(target=warm_up, daemon=True).start()
     while True:
         try:
             sleep(1)
+            if startup.failed is not None:
+                shutdown_event.set()
+                webServer.shutdown()
+                print("Exiting")
+                exit(1)
         except KeyboardInterrupt:
             print('Keyboard Interrupt sent.')
             shutdown_event.set()
             sleep(2)
             webServer.shutdown()
+            database.jobs.stop()
             print("Saving Database")
+            database.close()
             print("Exiting")
             exit(0)
@@ -0,0 +1,69 @@
+import argparse
+import shutil
+import tempfile
+from pathlib import Path
+
+import orjson
+
+from benchmarks.suite import bench_database, bench_extraction, bench_http, environment, prepare_database
+from benchmarks.synthetic import synthetic_images
+
+
+def int_list(value):
+    return [int(item) for item in value.split(",") if item]
+
+
+def name_list(value):
+    return [item for item in value.split(",") if item]
+
+
+parser = argparse.ArgumentParser(description="Benchmarks extraction, database loading, index search and the HTTP server on synthetic data")
+parser.add_argument("--steps", dest="steps", default="extraction,database,http", type=name_list, required=False, help="Comma separated steps to run (extraction, database, http)")
+parser.add_argument("--extractors", dest="extractors", default="stub", type=name_list, required=False, help="Comma separated extractors to benchmark (stub, clip, resnet).  stub needs no model so runs offline.")
+parser.add_argument("--images", dest="images", default=200, type=int, required=False, help="Number of synthetic images generated for the extraction and http steps.")
+parser.add_argument("--batch-size", dest="batch_size", default=16, type=int, required=False, help="Images per forward pass in the extraction step.")
+parser.add_argument("--vectors", dest="vectors", default=10000, type=int, required=False, help="Number of synthetic vectors in the database step (10000 to 10000000).")
+parser.add_argument("--dim", dest="dim", default=768, type=int, required=False, help="Dimension of the synthetic vectors (768 = CLIP ViT-L/14).")
+parser.add_argument("--indexes", dest="indexes", default="exact,ivf,pq,sq8", type=name_list, required=False, help="Comma separated index types loaded from the vector store in the database step.")
+parser.add_argument("--k", dest="k", default="1,10,100", type=int_list, required=False, help="Comma separated result counts to measure query latency and recall at.")
+parser.add_argument("--queries", dest="queries", default=200, type=int, required=False, help="Number of queries per k in the database step.")
+parser.add_argument("--ivf-lists", dest="ivf_lists", default=0, type=int, required=False, help="Number of k-means buckets in the ivf index (0 = 4 * sqrt(number of images)).")
+parser.add_argument("--ivf-probe", dest="ivf_probe", default=8, type=int, required=False, help="Number of ivf buckets scanned per search.")
+parser.add_argument("--pq-subvectors", dest="pq_subvectors", default=96, type=int, required=False, help="Number of one byte codes per vector in the pq index.")
+parser.add_argument("--servers", dest="servers", default="threaded,async", type=name_list, required=False, help="Comma separated servers to load test in the http step (threaded, async).")
+parser.add_argument("--concurrency", dest="concurrency", default="1,4,16", type=int_list, required=False, help="Comma separated numbers of concurrent clients in the http step.")
+parser.add_argument("--requests", dest="requests", default=200, type=int, required=False, help="Number of searches sent at each concurrency level.")
+parser.add_argument("--work-dir", dest="work_dir", default="", type=str, required=False, help="Directory for the synthetic data.  A synthetic database of the same size left in it is reused (default a temporary directory which is deleted).")
+parser.add_argument("--output", dest="output", default="", type=str, required=False, help="Write the JSON results to this file as well as printing them.")
+params_args = parser.parse_args()
+
+work_dir = Path(params_args.work_dir or tempfile.mkdtemp(prefix="image-search-benchmark-"))
+work_dir.mkdir(parents=True, exist_ok=True)
+report = {"environment": environment(), "config": {key: value for key, value in vars(params_args).items() if key != "output"}}
+
+try:
+    image_paths = []
+    if "extraction" in params_args.steps or "http" in params_args.steps:
+        image_paths = synthetic_images(work_dir / "images", params_args.images)
+
+    if "extraction" in params_args.steps:
+        report["extraction"] = bench_extraction(params_args.extractors, image_paths, params_args.batch_size)
+
+    if "database" in params_args.steps:
+        database_path = work_dir / "synthetic"
+        prepare_database(database_path, params_args.vectors, params_args.dim)
+        index_options = {"nlist": params_args.ivf_lists, "nprobe": params_args.ivf_probe, "subvectors": params_args.pq_subvectors}
+        report["database"] = bench_database(database_path, params_args.indexes, index_options, params_args.k, params_args.queries)
+
+    if "http" in params_args.steps:
+        report["http"] = [bench_http(work_dir / "images", image_paths, work_dir / "server", server, params_args.concurrency, params_args.requests)
+                          for server in params_args.servers]
+finally:
+    if not params_args.work_dir:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+output = orjson.dumps(report, option=orjson.OPT_INDENT_2)
+print(output.decode())
+if params_args.output:
+    with open(params_args.output, "wb") as f:
+        f.write(output)
@@ -0,0 +1,262 @@
+import http.client
+import multiprocessing
+import platform
+import resource
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+from urllib.parse import quote
+
+import numpy as np
+import orjson
+
+from benchmarks.synthetic import fill_database
+
+REPO = Path(__file__).resolve().parent.parent
+
+
+def peak_rss_mb():
+    """ Peak resident memory of this process (ru_maxrss is in KB on Linux and bytes on macOS). """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def percentiles(latencies):
+    latencies = np.asarray(latencies) * 1000
+    return {"mean_ms": round(float(latencies.mean()), 3), "p50_ms": round(float(np.percentile(latencies, 50)), 3),
+            "p90_ms": round(float(np.percentile(latencies, 90)), 3), "p99_ms": round(float(np.percentile(latencies, 99)), 3)}
+
+
+def in_child(function, *args):
+    """ Runs a step in a fresh process, so its time and peak memory do not depend on the steps before it. """
+    with multiprocessing.Pool(1) as pool:
+        return pool.apply(function, args)
+
+
+def environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = None
+    return {"commit": commit or None, "time": time.strftime("%Y-%m-%dT%H:%M:%S"), "platform": platform.platform(),
+            "python": platform.python_version(), "numpy": np.__version__, "cpus": multiprocessing.cpu_count()}
+
+
+def _extract(name, paths, batch_size):
+    from extractors.lazy_extractor import LazyExtractor
+
+    extractor = LazyExtractor(name)
+    start = time.monotonic()
+    try:
+        extractor.load()
+    except Exception as e:
+        return {"error": str(e)}
+    load_sec = time.monotonic() - start
+    extractor.extract_batch(paths[:batch_size])  # Warm up
+
+    start = time.monotonic()
+    tensors = [tensor for tensor in (extractor.preprocess(path) for path in paths) if tensor is not None]
+    preprocess_sec = time.monotonic() - start
+
+    start = time.monotonic()
+    features = [extractor.infer_batch(np.stack(tensors[i:i + batch_size])) for i in range(0, len(tensors), batch_size)]
+    inference_sec = time.monotonic() - start
+
+    return {"model": extractor.model_tag, "dim": features[0].shape[1], "images": len(tensors), "batch_size": batch_size,
+            "load_sec": round(load_sec, 3),
+            "preprocess_images_per_sec": round(len(tensors) / preprocess_sec, 2),
+            "inference_images_per_sec": round(len(tensors) / inference_sec, 2),
+            "images_per_sec": round(len(tensors) / (preprocess_sec + inference_sec), 2),
+            "peak_rss_mb": peak_rss_mb()}
+
+
+def bench_extraction(names, paths, batch_size=16):
+    """ Images/sec of each extractor on the same images, split into preprocessing and the forward pass. """
+    report = {}
+    for name in names:
+        print(f"Benchmarking the {name} extractor on {len(paths)} images")
+        report[name] = in_child(_extract, name, paths, batch_size)
+        print(report[name])
+    return report
+
+
+def prepare_database(path, count, dim, seed=0):
+    """ Creates the synthetic database and its vector store, reusing one left by an earlier run with the same size. """
+    from providers.database import Database
+
+    path = Path(path)
+    description = f"{count}x{dim}/{seed}"
+    database = Database(path)
+    reuse = database.get_meta("synthetic") == description
+    database.close()
+    if reuse:
+        print(f"Reusing the synthetic database {path}")
+        return
+
+    for suffix in (".sqlite", ".sqlite-wal", ".sqlite-shm"):
+        path.with_suffix(suffix).unlink(missing_ok=True)
+    shutil.rmtree(path.with_suffix(".vectors"), ignore_errors=True)
+    database = Database(path)
+    database.load(write_only=True)
+    start = time.monotonic()
+    fill_database(database, count, dim, seed=seed)
+    with database.conn:
+        database.set_meta("synthetic", description)
+    database.close()
+    print(f"Generated {count} vectors in {time.monotonic() - start:.1f}s")
+
+
+def _load_and_query(path, index_type, index_options, use_store, ks, queries):
+    from providers.database import Database
+
+    database = Database(path, index_type=index_type, index_options=index_options, use_store=use_store)
+    count = database.conn.execute("SELECT COUNT(*) FROM images").fetchone()[0]
+    start = time.monotonic()
+    database._train_index(count)  # Timed on its own, load() skips training an index which is already trained
+    train_sec = time.monotonic() - start
+    start = time.monotonic()
+    database.load()
+    load_sec = time.monotonic() - start
+    report = {"index": database.index.stats(), "vector_store": use_store, "train_sec": round(train_sec, 3),
+              "load_sec": round(load_sec, 3), "peak_rss_mb": peak_rss_mb()}
+
+    # Queries are stored vectors moved slightly, like searching with an edited copy of an image
+    rng = np.random.default_rng(1)
+    query_vectors = database.sample_vectors(queries, seed=1)
+    query_vectors = query_vectors + 0.02 * rng.standard_normal(query_vectors.shape).astype(np.float32)
+    query_vectors /= np.linalg.norm(query_vectors, axis=1, keepdims=True)
+    exact = database.exact_neighbours(query_vectors, max(ks))
+
+    for k in ks:
+        latencies = []
+        recall = []
+        for query_vector, expected in zip(query_vectors, exact):
+            start = time.perf_counter()
+            results = database.query(query_vector, k)
+            latencies.append(time.perf_counter() - start)
+            expected = {key for key, _ in expected[:k]}
+            recall.append(len({result["image"] for result in results} & expected) / max(1, len(expected)))
+        start = time.perf_counter()
+        database.query_many(query_vectors, k)
+        batch_sec = time.perf_counter() - start
+        report[f"k={k}"] = {"recall": round(float(np.mean(recall)), 4), **percentiles(latencies),
+                            "batch_queries_per_sec": round(len(query_vectors) / batch_sec, 1)}
+    database.close()
+    return report
+
+
+def bench_database(path, index_types, index_options, ks=(1, 10, 100), queries=200):
+    """ Load time, peak memory, index build time, query latency and recall for each index type. """
+    runs = [("exact", False)] + [(index_type, True) for index_type in index_types]
+    report = []
+    for index_type, use_store in runs:
+        label = f"{index_type} ({'vector store' if use_store else 'SQLite'})"
+        print(f"Benchmarking {label}")
+        result = in_child(_load_and_query, path, index_type, index_options, use_store, list(ks), queries)
+        print(result)
+        report.append(result)
+    return report
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("localhost", 0))
+        return s.getsockname()[1]
+
+
+def get(connection, path):
+    connection.request("GET", path)
+    response = connection.getresponse()
+    return response.status, orjson.loads(response.read())
+
+
+def wait_until_ready(port, process, timeout=120):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"The server exited with code {process.returncode}")
+        try:
+            connection = http.client.HTTPConnection("localhost", port, timeout=5)
+            if get(connection, "/health")[1].get("status") == "ready":
+                return
+        except (OSError, ValueError):
+            pass
+        time.sleep(0.2)
+    raise RuntimeError("The server did not become ready")
+
+
+def load_test(port, paths, concurrency, requests):
+    """ `concurrency` clients with keep-alive connections send `requests` searches in total. """
+    latencies = []
+    errors = [0]
+    remaining = iter(range(requests))
+    lock = threading.Lock()
+
+    def client():
+        connection = http.client.HTTPConnection("localhost", port, timeout=60)
+        while True:
+            with lock:
+                number = next(remaining, None)
+            if number is None:
+                return
+            start = time.perf_counter()
+            try:
+                status, body = get(connection, f"/search?image={quote(str(paths[number % len(paths)]))}&limit=10")
+                failed = status != 200 or "error" in body
+            except (OSError, http.client.HTTPException, ValueError):
+                connection = http.client.HTTPConnection("localhost", port, timeout=60)
+                failed = True
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+                errors[0] += failed
+
+    start = time.monotonic()
+    clients = [threading.Thread(target=client) for _ in range(concurrency)]
+    for t in clients:
+        t.start()
+    for t in clients:
+        t.join()
+    elapsed = time.monotonic() - start
+    return {"concurrency": concurrency, "requests": requests, "errors": errors[0],
+            "requests_per_sec": round(requests / elapsed, 1), **percentiles(latencies)}
+
+
+def bench_http(image_dir, paths, data_dir, server="threaded", concurrency=(1, 4, 16), requests=200):
+    """ Starts the server with the stub extractor, adds the images through /add and load tests /search. """
+    port = free_port()
+    data_dir = Path(data_dir)
+    data_dir.mkdir(parents=True, exist_ok=True)
+    for old in data_dir.glob("stub*"):
+        if old.is_file():
+            old.unlink()
+    command = [sys.executable, str(REPO), "--extractor", "stub", "--data-dir", str(data_dir), "--port", str(port),
+               "--server", server, "--search-cache", "0", "--output", "1000000", "--max-concurrency", str(max(concurrency))]
+    print(f"Starting the {server} server on port {port}")
+    with open(data_dir / f"server-{server}.log", "w") as log:
+        process = subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT)
+    try:
+        wait_until_ready(port, process)
+        connection = http.client.HTTPConnection("localhost", port, timeout=3600)
+        start = time.monotonic()
+        status, body = get(connection, f"/add?image={quote(str(image_dir))}&wait=1")
+        elapsed = time.monotonic() - start
+        report = {"server": server, "add": {"images": body.get("added"), "seconds": round(elapsed, 3),
+                                            "images_per_sec": round((body.get("added") or 0) / elapsed, 2)},
+                  "search": []}
+        for clients in concurrency:
+            result = load_test(port, paths, clients, requests)
+            print(result)
+            report["search"].append(result)
+        return report
+    finally:
+        process.send_signal(signal.SIGINT)
+        try:
+            process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            process.kill()
@@ -0,0 +1,51 @@
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+
+def synthetic_vectors(count, dim=768, clusters=100, seed=0, chunk_rows=100000):
+    """
+    Yields chunks of L2 normalized float32 vectors scattered around random cluster centres.  Real image embeddings
+    are clustered too, uniform random vectors would make every approximate index look worse than it is.
+    """
+    rng = np.random.default_rng(seed)
+    centres = rng.standard_normal((clusters, dim)).astype(np.float32)
+    centres /= np.linalg.norm(centres, axis=1, keepdims=True)
+    for start in range(0, count, chunk_rows):
+        rows = min(chunk_rows, count - start)
+        vectors = centres[rng.integers(clusters, size=rows)] + 0.05 * rng.standard_normal((rows, dim)).astype(np.float32)
+        yield vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def fill_database(database, count, dim=768, clusters=100, seed=0, chunk_rows=100000):
+    """ Writes `count` synthetic vectors to an open database under the names synthetic-00000000.jpg, ... """
+    written = 0
+    for vectors in synthetic_vectors(count, dim, clusters, seed, chunk_rows):
+        database.add_many([(vector, f"synthetic-{written + row:08d}.jpg") for row, vector in enumerate(vectors)])
+        written += len(vectors)
+        print(f"Written {written} / {count} synthetic vectors")
+    return written
+
+
+def synthetic_images(directory, count, size=256, seed=0):
+    """ Writes `count` JPEG images of random shapes on random gradients, returns their paths. """
+    rng = np.random.default_rng(seed)
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    ramp = np.linspace(0, 1, size, dtype=np.float32)
+    paths = []
+    for number in range(count):
+        low, high = rng.integers(0, 256, size=(2, 3))
+        img = (low + np.outer(ramp, ramp)[:, :, None] * (high - low)).astype(np.uint8)
+        for _ in range(rng.integers(1, 6)):
+            color = tuple(int(c) for c in rng.integers(0, 256, size=3))
+            x, y = (int(v) for v in rng.integers(0, size, size=2))
+            if rng.random() < 0.5:
+                cv2.circle(img, (x, y), int(rng.integers(8, size // 3)), color, -1)
+            else:
+                cv2.rectangle(img, (x, y), (x + int(rng.integers(8, size // 2)), y + int(rng.integers(8, size // 2))), color, -1)
+        path = directory / f"synthetic-{number:06d}.jpg"
+        cv2.imwrite(str(path), img)
+        paths.append(path)
+    return paths
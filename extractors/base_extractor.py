@@ -0,0 +1,30 @@
+import numpy as np
+
+
+class BaseExtractor:
+    """
+    Shared extract / extract_batch.  Subclasses set preprocess to a module level function from
+    extractors/preprocess.py, so it can be sent to decode worker processes, and implement infer_batch.
+    """
+    preprocess = None
+
+    def extract(self, image_path):
+        return self.extract_batch([image_path])[0]
+
+    def extract_batch(self, image_paths):
+        """ Extracts features for a list of paths or arrays in a single forward pass.
+        Returns a list aligned with the input, with None for images that could not be read. """
+        tensors = [self.preprocess(image_path) for image_path in image_paths]
+        valid = [i for i, tensor in enumerate(tensors) if tensor is not None]
+        results = [None] * len(tensors)
+        if not valid:
+            return results
+
+        features = self.infer_batch(np.stack([tensors[i] for i in valid]))
+        for row, i in enumerate(valid):
+            results[i] = features[row]
+        return results
+
+    def infer_batch(self, batch):
+        """ Runs the model on a stacked batch of preprocessed tensors and returns L2 normalized features. """
+        raise NotImplementedError
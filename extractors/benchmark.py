@@ -0,0 +1,73 @@
+import time
+
+import numpy as np
+
+from helpers.file_scanner import scan_images
+
+# The first mode is the baseline the others are compared against
+BENCHMARK_MODES = [
+    {"model": "large", "precision": "float32"},
+    {"model": "large", "precision": "float32", "compile": True},
+    {"model": "large", "precision": "bf16"},
+    {"model": "large", "precision": "int8"},
+    {"model": "base", "precision": "float32"},
+]
+
+
+def similarity_agreement(features, baseline):
+    """
+    Compares two sets of features for the same images.  The pairwise similarities are compared rather than the
+    vectors, so models with a different embedding size can be compared too.
+    """
+    sims = features @ features.T
+    base_sims = baseline @ baseline.T
+    upper = np.triu_indices(len(features), k=1)
+    np.fill_diagonal(sims, -np.inf)
+    np.fill_diagonal(base_sims, -np.inf)
+    result = {
+        "similarity_correlation": round(float(np.corrcoef(sims[upper], base_sims[upper])[0, 1]), 4),
+        "nearest_neighbour_agreement": round(float(np.mean(sims.argmax(axis=1) == base_sims.argmax(axis=1))), 4),
+    }
+    if features.shape[1] == baseline.shape[1]:
+        cosine = np.einsum("ij,ij->i", features, baseline)
+        result["mean_cosine"] = round(float(cosine.mean()), 5)
+        result["min_cosine"] = round(float(cosine.min()), 5)
+    return result
+
+
+def benchmark_clip(directory, sample=64, batch_size=16, modes=BENCHMARK_MODES):
+    """ Runs every CLIP mode on the same sample of images, reporting images/sec and agreement with the first mode. """
+    from extractors.clip_extractor import ClipExtractor
+
+    tensors = []
+    for entry in scan_images(directory):
+        tensor = ClipExtractor.preprocess(entry.path)
+        if tensor is not None:
+            tensors.append(tensor)
+        if len(tensors) >= sample:
+            break
+    if len(tensors) < 2:
+        raise ValueError(f"Need at least 2 readable images in {directory}")
+    tensors = np.stack(tensors)
+    print(f"Benchmarking {len(modes)} CLIP modes on {len(tensors)} images")
+
+    report = []
+    baseline = None
+    for mode in modes:
+        extractor = ClipExtractor(**mode)
+        extractor.infer_batch(tensors[:batch_size])  # Warm up, torch.compile builds the graph on the first call
+
+        start = time.monotonic()
+        features = np.vstack([extractor.infer_batch(tensors[i:i + batch_size]) for i in range(0, len(tensors), batch_size)])
+        elapsed = time.monotonic() - start
+
+        entry = {"model": extractor.model_tag, "compile": mode.get("compile", False),
+                 "images_per_sec": round(len(tensors) / elapsed, 2), "dim": features.shape[1]}
+        if baseline is None:
+            baseline = features
+        else:
+            entry.update(similarity_agreement(features, baseline))
+        print(entry)
+        report.append(entry)
+        del extractor
+    return report
@@ -1,43 +1,50 @@
 import torch
 import numpy as np
-import cv2
-from transformers import CLIPProcessor, CLIPModel
+from transformers import CLIPModel
+
+from extractors.base_extractor import BaseExtractor
+from extractors.models import CLIP_MODELS, clip_tag
+from extractors.preprocess import clip_preprocess
+
+class ClipExtractor(BaseExtractor):
+    preprocess = staticmethod(clip_preprocess)
+
+    def __init__(self, model="large", precision="float32", compile=False):
+        """
+        model     = large (ViT-L/14, best accuracy) or base (ViT-B/32, much faster on CPU)
+        precision = float32, bf16 (bfloat16 autocast) or int8 (dynamic quantization of the linear layers, CPU only)
+        compile   = run the image encoder through torch.compile
+        """
+        model_name = CLIP_MODELS[model]
+        self.precision = precision
+        self.model_tag = clip_tag(model, precision)
 
-class ClipExtractor:
-    def __init__(self):
-        # Load CLIP model (ViT-L/14 for best accuracy)
-        model_name = "openai/clip-vit-large-patch14"
         self.model = CLIPModel.from_pretrained(model_name)
-        self.processor = CLIPProcessor.from_pretrained(model_name)
 
         # Use GPU if available
         self.device = "cuda" if torch.cuda.is_available() else "cpu"
-        print(f"Using device: {self.device}")
-        self.model.to(self.device)
+        print(f"Using device: {self.device}, model: {self.model_tag}")
         self.model.eval()  # Set to evaluation mode
 
-    def extract(self, image_path):
-        # Load and preprocess image
-        if isinstance(image_path, np.ndarray):
-            img = image_path  # It's already an image, no need to load
-        else:
-            img = cv2.imread(image_path)
-
-        if img is None:
-            return None
-
-        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)  # Convert BGR to RGB
-        img = cv2.resize(img, (224, 224))  # Resize to 224x224
+        if precision == "int8":
+            if self.device != "cpu":
+                print("int8 quantization only runs on the CPU, the model will not use the GPU")
+                self.device = "cpu"
+            self.model = torch.ao.quantization.quantize_dynamic(self.model, {torch.nn.Linear}, dtype=torch.qint8)
+        self.model.to(self.device)
 
-        # Preprocess for CLIP
-        inputs = self.processor(images=img, return_tensors="pt")
-        inputs = {key: val.to(self.device) for key, val in inputs.items()}  # Move to GPU if available
+        self.image_features = self.model.get_image_features
+        if compile:
+            self.image_features = torch.compile(self.image_features)
 
-        # Extract feature vector
-        with torch.no_grad():
-            feature = self.model.get_image_features(**inputs)
+    def infer_batch(self, batch):
+        """ Runs the model on a stacked batch of preprocessed tensors and returns L2 normalized features. """
+        pixel_values = torch.from_numpy(batch).to(self.device)  # Move to GPU if available
 
-        # Normalize feature vector
-        feature = feature.cpu().numpy().flatten()
-        return feature / np.linalg.norm(feature)  # L2 Normalize
+        # Extract feature vectors
+        with torch.no_grad(), torch.autocast(device_type=self.device, dtype=torch.bfloat16, enabled=self.precision == "bf16"):
+            features = self.image_features(pixel_values=pixel_values)
 
+        # Normalize feature vectors
+        features = features.float().cpu().numpy()
+        return features / np.linalg.norm(features, axis=1, keepdims=True)  # L2 Normalize
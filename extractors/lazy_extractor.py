@@ -0,0 +1,45 @@
+import importlib
+import threading
+import time
+
+from extractors.base_extractor import BaseExtractor
+from extractors.models import EXTRACTORS, model_tag
+from extractors.preprocess import PREPROCESSORS
+from providers.metrics import stage
+
+
+class LazyExtractor(BaseExtractor):
+    """
+    Stands in for an extractor without importing torch / tensorflow or loading the model.  The model is loaded
+    on the first extract call, or earlier by calling load() from a background thread.
+    """
+    def __init__(self, name, options=None, startup=None):
+        self.name = name
+        self.options = options or {}
+        self.startup = startup
+        self.preprocess = PREPROCESSORS[name]
+        self.model_tag = model_tag(name, **self.options)
+        self.extractor = None
+        self.lock = threading.Lock()
+
+    @property
+    def loaded(self):
+        return self.extractor is not None
+
+    def load(self):
+        with self.lock:
+            if self.extractor is None:
+                start = time.monotonic()
+                module_name, class_name = EXTRACTORS[self.name]
+                print(f"Loading {self.name} extractor")
+                extractor_class = getattr(importlib.import_module(module_name), class_name)
+                self.extractor = extractor_class(**self.options)
+                if self.startup is not None:
+                    self.startup.record("extractor_load", time.monotonic() - start)
+        return self.extractor
+
+    def infer_batch(self, batch):
+        """ Loads the model if needed, every forward pass goes through here so it is timed. """
+        extractor = self.load()
+        with stage("inference"):
+            return extractor.infer_batch(batch)
@@ -0,0 +1,31 @@
+""" Model names and tags, kept free of torch / tensorflow imports so they can be read before a model is loaded. """
+
+# Both CLIP models take the same 224px input and normalization
+CLIP_MODELS = {
+    "large": "openai/clip-vit-large-patch14",
+    "base": "openai/clip-vit-base-patch32",
+}
+CLIP_PRECISIONS = ("float32", "bf16", "int8")
+RESNET_TAG = "resnet-v2-152/float32"
+STUB_TAG = "stub-projection-512/float32"
+
+# Extractor name -> (module, class)
+EXTRACTORS = {
+    "clip": ("extractors.clip_extractor", "ClipExtractor"),
+    "resnet": ("extractors.resnet_extractor", "ResNetExtractor"),
+    "stub": ("extractors.stub_extractor", "StubExtractor"),
+}
+
+
+def clip_tag(model="large", precision="float32"):
+    """ Identifies the vectors a configuration produces, vectors with different tags are never mixed. """
+    return f"{CLIP_MODELS[model]}/{precision}"
+
+
+def model_tag(extractor, **options):
+    """ Tag of the vectors an extractor produces with the given options, no options gives the original model. """
+    if extractor == "clip":
+        return clip_tag(options.get("model", "large"), options.get("precision", "float32"))
+    if extractor == "stub":
+        return STUB_TAG
+    return RESNET_TAG
@@ -0,0 +1,64 @@
+import cv2
+import numpy as np
+
+from providers.metrics import stage
+
+# Normalization constants from the openai/clip-vit-large-patch14 preprocessor config
+CLIP_MEAN = np.array([0.48145466, 0.4578275, 0.40821073], dtype=np.float32)
+CLIP_STD = np.array([0.26862954, 0.26130258, 0.27577711], dtype=np.float32)
+
+# These functions are kept free of torch / tensorflow so that they can run in decode worker processes
+
+
+def load_rgb(image_path, size=224):
+    """ Loads an image (path or BGR array) and returns it as a size x size RGB array, or None if unreadable. """
+    if isinstance(image_path, np.ndarray):
+        img = image_path  # It's already an image, no need to load
+    else:
+        with stage("decode"):
+            img = cv2.imread(str(image_path))
+
+    if img is None:
+        return None
+
+    img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)  # Convert BGR to RGB
+    return cv2.resize(img, (size, size))
+
+
+def clip_preprocess(image_path):
+    """ Decodes an image into a normalized 3x224x224 float32 tensor ready for CLIP. """
+    with stage("preprocess"):
+        img = load_rgb(image_path)
+        if img is None:
+            return None
+
+        img = (img.astype(np.float32) / 255.0 - CLIP_MEAN) / CLIP_STD
+        return np.ascontiguousarray(img.transpose(2, 0, 1))  # HWC to CHW
+
+
+def resnet_preprocess(image_path):
+    """ Decodes an image into a 224x224x3 float32 array ready for the ResNet model. """
+    with stage("preprocess"):
+        img = load_rgb(image_path)
+        if img is None:
+            return None
+
+        return img.astype(np.float32)
+
+
+def stub_preprocess(image_path):
+    """ Decodes an image into a 32x32x3 float32 array for the stub extractor. """
+    with stage("preprocess"):
+        img = load_rgb(image_path, size=32)
+        if img is None:
+            return None
+
+        return img.astype(np.float32) / 255.0
+
+
+# Extractor name -> preprocess function, usable before the model is loaded
+PREPROCESSORS = {
+    "clip": clip_preprocess,
+    "resnet": resnet_preprocess,
+    "stub": stub_preprocess,
+}
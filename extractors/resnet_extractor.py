@@ -1,9 +1,15 @@
 import tensorflow_hub
 import numpy as np
-import cv2
 import tf_keras
 
-class ResNetExtractor:
+from extractors.base_extractor import BaseExtractor
+from extractors.models import RESNET_TAG
+from extractors.preprocess import resnet_preprocess
+
+class ResNetExtractor(BaseExtractor):
+    preprocess = staticmethod(resnet_preprocess)
+    model_tag = RESNET_TAG
+
     def __init__(self):
         layer = "https://www.kaggle.com/models/google/resnet-v2/TensorFlow2/152-feature-vector/2"
         #layer = "https://tfhub.dev/google/imagenet/resnet_v2_50/feature_vector/5"
@@ -13,17 +19,7 @@ class ResNetExtractor:
         ])
         self.model.build([None, 224, 224, 3])  # Batch input shape.
 
-    def extract(self, image_path):
-        if isinstance(image_path, np.ndarray):
-            img = image_path  # It's already an image, no need to load
-        else:
-            img = cv2.imread(image_path)
-
-        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)  # Convert to RGB
-        img = cv2.resize(img, (224,224))
-
-        img = tf_keras.preprocessing.image.img_to_array(img)
-        x = np.expand_dims(img, axis=0) # Add a dimension
-
-        feature = self.model.predict(x)[0]
-        return feature / np.linalg.norm(feature)  # Normalize
+    def infer_batch(self, batch):
+        """ Runs the model on a stacked batch of preprocessed images and returns L2 normalized features. """
+        features = self.model.predict(batch)
+        return features / np.linalg.norm(features, axis=1, keepdims=True)  # Normalize
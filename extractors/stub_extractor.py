@@ -0,0 +1,21 @@
+import numpy as np
+
+from extractors.base_extractor import BaseExtractor
+from extractors.models import STUB_TAG
+from extractors.preprocess import stub_preprocess
+
+class StubExtractor(BaseExtractor):
+    """
+    Stands in for a model in benchmarks and tests: a fixed random projection of the 32x32 image, so it needs no
+    torch / tensorflow and similar images still get similar vectors.
+    """
+    preprocess = staticmethod(stub_preprocess)
+    model_tag = STUB_TAG
+
+    def __init__(self, dim=512, seed=0):
+        self.projection = np.random.default_rng(seed).standard_normal((32 * 32 * 3, dim)).astype(np.float32)
+
+    def infer_batch(self, batch):
+        """ Projects a stacked batch of preprocessed images and returns L2 normalized features. """
+        features = (batch.reshape(len(batch), -1) - 0.5) @ self.projection
+        return features / np.linalg.norm(features, axis=1, keepdims=True)
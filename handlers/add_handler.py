@@ -1,105 +1,182 @@
 import os
 import threading
-from queue import Queue
-from concurrent.futures import ThreadPoolExecutor
+import time
 from pathlib import Path
 
+import cv2
+
+from helpers.file_scanner import IMAGE_EXTENSIONS, scan_images
+from helpers.image_helper import UploadedImage
+from providers.filters import first, parse_metadata
+from providers.ingest_pipeline import IngestPipeline
+from providers.metrics import images_failed_total
+
 class AddHandler:
     def __init__(self, program_args, request, feature_extractor, database, shutdown_event):
         self.request = request
         self.feature_extractor = feature_extractor
         self.database = database
+        self.program_args = program_args
         self.allow_update = program_args.update_flag
         self.verbose = program_args.verbose
         self.output_count = program_args.output
+        self.sync = False
+        self.recursive = True
         self.processed = 0
         self.skipped = 0
+        self.removed = 0
+        self.last_output = 0
         self.lock = threading.Lock()
         self.max_files = 1000000
-        self.queue = Queue()
-        self.num_threads = program_args.threads
         self.shutdown_event = shutdown_event
-
-    def process_image_worker(self):
-        """Worker function that processes images from the queue."""
-        while True:
-            image = self.queue.get()  # Get image path from queue
-            if image is None:  # Sentinel value to signal exit
-                break
-
-            if self.shutdown_event.is_set():
-                break
-
-            if self.output_count > 0 and (self.skipped + self.processed) % self.output_count == 0:
-                print(f"Completed {self.processed} | Skipped {self.skipped}")
-
-            self.process_image(image)
-
-    def process_image(self, image):
-        if not self.allow_update and self.database.exists(os.path.basename(image)):
+        self.start_time = time.monotonic()
+        self.metadata = {}
+
+    @staticmethod
+    def enabled(value):
+        """ Flags come as query string values or JSON values: "1", 1, True and "true" are on, "0", 0, False and "false" off. """
+        return str(value).lower() not in ("0", "false")
+
+    def rate(self):
+        """ Images per second extracted since the request started. """
+        elapsed = time.monotonic() - self.start_time
+        return self.processed / elapsed if elapsed > 0 else 0.0
+
+    def should_process(self, image, stat=None):
+        if self.sync:
+            changed = self.database.file_changed(image, stat or os.stat(image))
+        else:
+            changed = self.allow_update or not self.database.exists(os.path.basename(image))
+        if not changed:
             with self.lock:
                 self.skipped += 1
             if self.verbose > 1:
-                print(f"Image {image} already exists")
-            return
+                print(f"Image {image} {'is unchanged' if self.sync else 'already exists'}")
+            return False
+        return True
 
-        features = self.feature_extractor.extract(image)
-        if features is None:
+    def process_image(self, image):
+        if not self.should_process(image):
             return
 
-        self.database.add(features, image)
+        digest, features = None, None
+        if self.database.feature_cache is not None:
+            digest, features = self.database.feature_cache.lookup(image)
 
-        with self.lock:
-            if self.processed >= self.max_files:
+        if features is None:
+            features = self.feature_extractor.extract(image)
+            if features is None:
+                images_failed_total.inc()
                 return
-            self.processed += 1
+            if self.database.feature_cache is not None:
+                self.database.feature_cache.put_many([(digest, features)])
+
+        self.database.add(features, image)
+        self.database.set_metadata([image], self.metadata)
+        if self.database.descriptor_store is not None:
+            img = cv2.imread(str(image))
+            if img is not None:
+                self.database.descriptor_store.put_many([(os.path.basename(image), self.database.descriptor_store.compute(img))])
+        self.processed += 1
 
         if self.verbose > 0:
             print(f"Done Image {self.processed}: {image}")
 
+    def process_upload(self, upload):
+        """ Adds an image sent in the request body, it is stored under the uploaded file name. """
+        name = os.path.basename(upload.name)
+        if not self.allow_update and self.database.exists(name):
+            self.skipped += 1
+            return None
+        img = upload.decode()
+        if img is None:
+            images_failed_total.inc()
+            return "Could not decode image"
+
+        features = self.feature_extractor.extract(img)
+        self.database.add(features, name)
+        self.database.set_metadata([name], self.metadata)
+        if self.database.descriptor_store is not None:
+            self.database.descriptor_store.put_many([(name, self.database.descriptor_store.compute(img))])
+        self.processed += 1
+        if self.verbose > 0:
+            print(f"Done Image {self.processed}: {name} (uploaded)")
+        return None
+
+    def scan(self, p):
+        """ Yields the images under a directory which still need to be processed. """
+        for entry in scan_images(p, recursive=self.recursive):
+            image = Path(entry.path).resolve()
+            if self.should_process(image, entry.stat() if self.sync else None):
+                yield image
+
+    def on_written(self, paths):
+        self.database.set_metadata(paths, self.metadata)
+        with self.lock:
+            self.processed += len(paths)
+            done = self.skipped + self.processed
+            if self.output_count > 0 and done - self.last_output >= self.output_count:
+                self.last_output = done
+                print(f"Completed {self.processed} | Skipped {self.skipped} | {self.rate():.1f} images/sec")
 
     def handle(self, query_params):
-        valid_extensions = {".jpg", ".jpeg", ".png"}
-
         if "image" not in query_params:
             return self.request.json({"error": "Missing 'image' parameter"})
 
-        image_value = query_params["image"][0]
+        try:
+            self.metadata = parse_metadata(query_params)
+        except ValueError as e:
+            return self.request.json({"error": str(e)})
+
+        image_value = first(query_params["image"])
+        if isinstance(image_value, UploadedImage):
+            error = self.process_upload(image_value)
+            if error:
+                return self.request.json({"error": error})
+            return self.request.json({"message": "Extracted features from images", "added": self.processed,
+                                      "skipped": self.skipped})
         p = Path(image_value)
 
         if "limit" in query_params:
-            self.max_files = int(query_params["limit"][0])
+            self.max_files = int(first(query_params["limit"]))
+        self.sync = first(query_params.get("mode", "add")) == "sync"
+        self.recursive = self.enabled(first(query_params.get("recursive", "1")))
 
         self.processed = 0
         self.skipped = 0
+        self.start_time = time.monotonic()
+        pipeline_metrics = None
 
         if not p.exists():
             return self.request.json({"error": f"File does not exist: {image_value}"})
 
-        if p.is_file() and p.suffix.lower() in valid_extensions:
+        if p.is_file() and p.suffix.lower() in IMAGE_EXTENSIONS:
             self.process_image(p.resolve())
+        elif p.is_dir() and self.database.jobs is not None and not self.enabled(first(query_params.get("wait", "0"))):
+            options = {"update": self.allow_update, "limit": self.max_files if "limit" in query_params else None,
+                       "mode": "sync" if self.sync else "add", "recursive": self.recursive, "metadata": self.metadata}
+            job = self.database.jobs.submit(p.resolve(), options)
+            print(f"Queued job {job.id} for {p.resolve()}")
+            return self.request.json({"message": "Job queued", "job": job.id, "status": f"/jobs/{job.id}"})
         elif p.is_dir():
-            # Start worker threads
-            with ThreadPoolExecutor(max_workers=self.num_threads) as executor:
-                print(f"Starting {self.num_threads} image processing threads")
-                workers = [executor.submit(self.process_image_worker) for _ in range(self.num_threads)]
-
-                with os.scandir(p) as entries:
-                    for entry in entries:
-                        if entry.is_file() and Path(entry.name).suffix.lower() in valid_extensions:
-                            self.queue.put(Path(entry.path).resolve())
-
-                            if self.processed >= self.max_files:
-                                print(f"File Limit of {self.max_files} exceeded")
-                                break
-
-                self.destroy_workers()
-
-        print(f"Completed {self.processed} | Skipped {self.skipped}")
-
-        return self.request.json({"message": "Extracted features from images", "added": self.processed, "skipped": self.skipped})
-
-    def destroy_workers(self):
-        for _ in range(self.num_threads):
-            self.queue.put(None)
-
+            pipeline = IngestPipeline.from_args(self.program_args, self.feature_extractor, self.database, self.shutdown_event)
+            print(f"Starting ingest pipeline: {pipeline.decode_workers} decode processes, "
+                  f"{pipeline.inference_workers} inference threads, batch size {pipeline.batch_size}")
+            pipeline.run(self.scan(p), max_files=self.max_files, on_written=self.on_written)
+            if self.processed >= self.max_files:
+                print(f"File Limit of {self.max_files} reached")
+            elif self.sync and not self.shutdown_event.is_set():
+                self.database.flush()
+                self.removed = self.database.prune_files(p.resolve())
+            pipeline_metrics = pipeline.metrics()
+            if self.verbose > 0:
+                print(f"Pipeline metrics: {pipeline_metrics}")
+
+        rate = self.rate()
+        print(f"Completed {self.processed} | Skipped {self.skipped} | Removed {self.removed} | {rate:.1f} images/sec")
+
+        response = {"message": "Extracted features from images", "added": self.processed, "skipped": self.skipped,
+                    "removed": self.removed, "images_per_sec": round(rate, 2)}
+        if pipeline_metrics:
+            response["pipeline"] = pipeline_metrics
+        return self.request.json(response)
@@ -0,0 +1,46 @@
+from urllib.parse import urlparse
+
+from providers.duplicates import DuplicateFinder
+
+
+class DuplicatesHandler:
+    def __init__(self, program_args, request, feature_extractor, database, shutdown_event):
+        self.request = request
+        self.database = database
+        self.program_args = program_args
+
+    @staticmethod
+    def param(query_params, name, default):
+        value = query_params.get(name, default)
+        return value[0] if isinstance(value, list) else value
+
+    def handle(self, query_params):
+        """ GET /duplicates returns the progress of the last run, POST starts a new one and /duplicates/cancel stops it. """
+        parts = [part for part in urlparse(self.request.path).path.split("/") if part]
+        finder = self.database.duplicates
+        limit = int(self.param(query_params, "limit", 100))
+
+        if len(parts) == 2 and parts[1] == "cancel":
+            if finder is None or not finder.running:
+                return self.request.json({"error": "No duplicate search is running"})
+            finder.cancel()
+            return self.request.json({"message": "Duplicate search cancelled", "duplicates": finder.to_dict()})
+        if len(parts) != 1:
+            return self.request.not_found()
+
+        if self.request.command != "POST":
+            if finder is None:
+                return self.request.json({"error": "No duplicate search has been run"})
+            return self.request.json(finder.to_dict(limit))
+
+        if finder is not None and finder.running:
+            return self.request.json({"error": "A duplicate search is already running", "duplicates": finder.to_dict()})
+        args = self.program_args
+        finder = DuplicateFinder(self.database,
+                                 threshold=float(self.param(query_params, "threshold", args.duplicate_threshold)),
+                                 block_rows=args.duplicate_block,
+                                 workers=args.duplicate_workers,
+                                 verbose=args.verbose)
+        self.database.duplicates = finder
+        finder.start()
+        return self.request.json({"message": "Duplicate search started", "duplicates": finder.to_dict()})
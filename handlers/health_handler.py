@@ -0,0 +1,40 @@
+class HealthHandler:
+    needs_database = False
+
+    def __init__(self, program_args, request, feature_extractor, database, shutdown_event):
+        self.request = request
+        self.feature_extractor = feature_extractor
+        self.database = database
+
+    def handle(self, query_params):
+        ready = self.database.ready.is_set()
+        failed = self.database.startup is not None and self.database.startup.failed is not None
+        health = {
+            "status": "ready" if ready else "failed" if failed else "loading",
+            "database_loaded": ready,
+            "extractor_loaded": getattr(self.feature_extractor, "loaded", True),
+            "images": self.database.count(),
+        }
+        index = getattr(self.database, "index", None)
+        if ready and hasattr(index, "health"):
+            health["index"] = index.health()
+            if health["index"]["stopped"]:
+                health["status"] = "degraded"
+        if self.database.startup is not None:
+            health["startup"] = self.database.startup.stats()
+        # 503 until the server can answer searches, so /health works as a readiness probe
+        return self.request.json(health, status=200 if health["status"] == "ready" else 503)
+
+
+class LoadingHandler:
+    """ Used in place of handlers which need the index while the database is still loading. """
+    def __init__(self, program_args, request, feature_extractor, database, shutdown_event):
+        self.request = request
+        self.database = database
+
+    def handle(self, query_params):
+        if self.database.startup is not None and self.database.startup.failed is not None:
+            return self.request.json({"error": f"The database could not be loaded: {self.database.startup.failed}",
+                                      "status": "failed"}, status=503)
+        return self.request.json({"error": "The database is still loading, try again shortly", "status": "loading",
+                                  "images": self.database.count()}, status=503)
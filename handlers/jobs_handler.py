@@ -0,0 +1,27 @@
+from urllib.parse import urlparse
+
+
+class JobsHandler:
+    def __init__(self, program_args, request, feature_extractor, database, shutdown_event):
+        self.request = request
+        self.database = database
+
+    def handle(self, query_params):
+        """ /jobs lists every job, /jobs/<id> returns its progress and /jobs/<id>/cancel stops it. """
+        if self.database.jobs is None:
+            return self.request.json({"error": "Jobs are not available"})
+
+        parts = [part for part in urlparse(self.request.path).path.split("/") if part]
+        if len(parts) == 1:
+            return self.request.json({"jobs": [job.to_dict() for job in self.database.jobs.jobs.values()]})
+
+        job = self.database.jobs.get(parts[1])
+        if job is None:
+            return self.request.json({"error": f"Job does not exist: {parts[1]}"})
+
+        if len(parts) == 3 and parts[2] == "cancel":
+            job.cancel()
+            return self.request.json({"message": "Job cancelled", "job": job.to_dict()})
+        if len(parts) == 2:
+            return self.request.json(job.to_dict())
+        return self.request.not_found()
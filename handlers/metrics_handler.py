@@ -0,0 +1,12 @@
+from providers.metrics import registry
+
+
+class MetricsHandler:
+    needs_database = False
+
+    def __init__(self, program_args, request, feature_extractor, database, shutdown_event):
+        self.request = request
+
+    def handle(self, query_params):
+        """ Every metric in the Prometheus text format, for scraping. """
+        return self.request.text(registry.expose(), "text/plain; version=0.0.4; charset=utf-8")
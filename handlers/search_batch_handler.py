@@ -0,0 +1,99 @@
+from pathlib import Path
+
+from helpers.image_helper import readb64, UploadedImage
+from providers.filters import SearchFilter
+
+
+class SearchBatchHandler:
+    def __init__(self, program_args, request, feature_extractor, database, shutdown_event):
+        self.request = request
+        self.feature_extractor = feature_extractor
+        self.database = database
+        self.verbose = program_args.verbose
+        self.chunk_size = max(1, program_args.batch_size)
+        self.shutdown_event = shutdown_event
+        self.search_filter = None
+
+    def load(self, image_value):
+        """ Returns (image, error) for a path, base64 data URI or uploaded image. """
+        if isinstance(image_value, UploadedImage):
+            img = image_value.decode()
+            return (img, None) if img is not None else (None, "Could not decode image")
+
+        if image_value.startswith("data:"):
+            try:
+                img = readb64(image_value)
+            except Exception as e:
+                return None, f"Invalid base64 image: {e}"
+            if img is None:
+                return None, "Could not decode base64 image"
+            return img, None
+
+        p = Path(image_value)
+        if not p.is_file():
+            return None, f"File does not exist: {image_value}"
+        return p.resolve(), None
+
+    def search_chunk(self, offset, image_values, limit):
+        """ Extracts and searches one chunk of inputs, yielding a result row per input in order. """
+        rows = [None] * len(image_values)
+        images = []
+        positions = []
+        for i, image_value in enumerate(image_values):
+            label = "base64" if str(image_value).startswith("data:") else str(image_value)
+            rows[i] = {"index": offset + i, "image": label}
+            img, error = self.load(image_value)
+            if error:
+                rows[i]["error"] = error
+            else:
+                images.append(img)
+                positions.append(i)
+
+        if images:
+            if self.verbose > 1:
+                print(f"Getting Image Features from CNN for {len(images)} images")
+            try:
+                features = self.feature_extractor.extract_batch(images)
+            except Exception as e:
+                for i in positions:
+                    rows[i]["error"] = f"Feature extraction failed: {e}"
+                features = []
+
+            valid = [(i, feature) for i, feature in zip(positions, features) if feature is not None]
+            for i, feature in zip(positions, features):
+                if feature is None:
+                    rows[i]["error"] = "Could not read image"
+
+            if valid:
+                results = self.database.query_many([feature for _, feature in valid], limit, self.search_filter)
+                for (i, _), result in zip(valid, results):
+                    rows[i]["results"] = result
+                    if self.search_filter is not None:
+                        rows[i]["plan"] = self.search_filter.plan  # Shared by the chunk, searched together
+
+        yield from rows
+
+    def results(self, image_values, limit):
+        for offset in range(0, len(image_values), self.chunk_size):
+            if self.shutdown_event.is_set():
+                break
+            yield from self.search_chunk(offset, image_values[offset:offset + self.chunk_size], limit)
+
+    def handle(self, query_params):
+        image_values = query_params.get("images") or query_params.get("image")
+        if not image_values:
+            return self.request.json({"error": "Missing 'images' parameter"})
+        if isinstance(image_values, str):
+            image_values = [image_values]
+
+        limit = 10
+        if "limit" in query_params:
+            limit = int(isinstance(query_params["limit"], list) and query_params["limit"][0] or query_params["limit"])
+
+        try:
+            self.search_filter = SearchFilter.from_params(query_params)
+        except ValueError as e:
+            return self.request.json({"error": str(e)})
+
+        image_values = [v if isinstance(v, UploadedImage) else str(v) for v in image_values]
+        return self.request.ndjson(self.results(image_values, limit))
@@ -1,7 +1,9 @@
 from pathlib import Path
 
-from helpers.image_helper import readb64
-from providers.compare import Compare
+from helpers.image_helper import readb64, UploadedImage
+from providers.filters import SearchFilter
+from providers.metrics import stage
+from providers.reranker import Reranker
 
 
 class SearchHandler:
@@ -10,6 +12,17 @@ class SearchHandler:
         self.feature_extractor = feature_extractor
         self.database = database
         self.verbose = program_args.verbose
+        self.compare_workers = program_args.compare_workers
+        self.compare_timeout = program_args.compare_timeout
+
+    @staticmethod
+    def load(source):
+        """ Decodes a base64 data URI or uploaded image, paths are passed to the extractor as they are. """
+        if isinstance(source, str):
+            return readb64(source)
+        if isinstance(source, UploadedImage):
+            return source.decode()
+        return source
 
     def handle(self, query_params):
         if "image" not in query_params:
@@ -22,31 +35,67 @@ class SearchHandler:
         compare_opts = None
         if "compare" in query_params:
             compare_opts = query_params["compare"]
+            if isinstance(compare_opts, str):
+                compare_opts = [compare_opts]
+
+        timeout = self.compare_timeout
+        if "compare_timeout" in query_params:
+            timeout = float(isinstance(query_params["compare_timeout"], list) and query_params["compare_timeout"][0] or query_params["compare_timeout"])
+
+        sort_by = None
+        if "sort" in query_params:
+            sort_by = isinstance(query_params["sort"], list) and query_params["sort"][0] or query_params["sort"]
+
+        try:
+            search_filter = SearchFilter.from_params(query_params)
+        except ValueError as e:
+            return self.request.json({"error": str(e)})
 
         if isinstance(query_params["image"], str):
-            file = readb64(query_params["image"])
+            source = query_params["image"]
+        elif isinstance(query_params["image"][0], UploadedImage):
+            source = query_params["image"][0]
         else:
             image_value = query_params["image"][0]
             p = Path(image_value)
 
             if not p.is_file():
                 return self.request.json({"error": f"File does not exist: {image_value}"})
-            file = p.resolve()
-
-        if self.verbose > 1:
-            print("Getting Image Features from CNN")
-        features = self.feature_extractor.extract(file)
-        if self.verbose > 1:
-            print("Received Image Features from CNN")
-
-        results = self.database.query(features, limit)
-        if compare_opts:
-            comp = Compare(p.resolve())
-            for result in results:
-                comp.set(result['image'])
-                result['compare'] = {}
-                for c in compare_opts:
-                    if hasattr(comp, c) and callable(getattr(comp, c)):
-                        result['compare'][c] = str(getattr(comp, c)())
-
-        return self.request.json({"results": results})
+            source = p.resolve()
+
+        cache = self.database.search_cache
+        image_key = cache.image_key(source) if cache is not None else None
+        features = cache.get_features(image_key) if cache is not None else None
+
+        file = None
+        if features is None:
+            file = self.load(source)
+            if file is None:
+                return self.request.json({"error": "Could not decode image"})
+            if self.verbose > 1:
+                print("Getting Image Features from CNN")
+            features = self.feature_extractor.extract(file)
+            if self.verbose > 1:
+                print("Received Image Features from CNN")
+            if cache is not None:
+                cache.put_features(image_key, features)
+
+        result_key = cache.result_key(features, limit, tuple(compare_opts or ()), sort_by,
+                                       search_filter.key() if search_filter else None) if cache is not None else None
+        results = cache.get_results(result_key) if cache is not None else None
+        if results is None:
+            results = self.database.query(features, limit, search_filter)
+            if compare_opts:
+                if file is None:
+                    file = self.load(source)
+                reranker = Reranker(self.compare_workers, self.database.descriptor_store)
+                with stage("compare"):
+                    results = reranker.rerank(file, results, compare_opts, timeout, sort_by)
+            timed_out = any("timeout" in result.get("compare", {}).values() for result in results)
+            if cache is not None and not timed_out:
+                cache.put_results(result_key, results)
+
+        response = {"results": results}
+        if search_filter is not None and search_filter.plan is not None:
+            response["plan"] = search_filter.plan
+        return self.request.json(response)
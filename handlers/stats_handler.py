@@ -1,4 +1,6 @@
 class StatsHandler:
+    needs_database = False
+
     def __init__(self, program_args, request, feature_extractor, database, shutdown_event):
         self.request = request
         self.feature_extractor = feature_extractor
@@ -6,4 +8,14 @@ class StatsHandler:
 
     def handle(self, query_params):
 
-        return self.request.json({"images": self.database.count()})
+        stats = {"images": self.database.count(), "index": self.database.index.stats()}
+        if self.database.writer is not None:
+            stats["writer"] = self.database.writer.stats()
+        if hasattr(self.feature_extractor, "stats"):
+            stats["inference"] = self.feature_extractor.stats()
+        if self.database.feature_cache is not None:
+            stats["feature_cache"] = self.database.feature_cache.stats()
+        if self.database.search_cache is not None:
+            stats["search_cache"] = self.database.search_cache.stats()
+
+        return self.request.json(stats)
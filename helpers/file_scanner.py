@@ -0,0 +1,27 @@
+import os
+from pathlib import Path
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png"}
+
+
+def scan_images(root, extensions=IMAGE_EXTENSIONS, recursive=True):
+    """
+    Yields a DirEntry for every image under root as it is found.  Only the directories still to be visited are
+    held in memory, so it can stream millions of files into the ingest queue.
+    """
+    pending = [os.fspath(root)]
+    while pending:
+        directory = pending.pop()
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            if recursive:
+                                pending.append(entry.path)
+                        elif entry.is_file() and Path(entry.name).suffix.lower() in extensions:
+                            yield entry
+                    except OSError as e:
+                        print(f"Could not read {entry.path}: {e}")
+        except OSError as e:
+            print(f"Could not scan {directory}: {e}")
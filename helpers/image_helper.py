@@ -2,8 +2,28 @@ import base64
 import cv2
 import numpy as np
 
+from providers.metrics import stage
+
+def decode_image(buffer):
+   """ Decodes encoded image bytes (bytes, bytearray or memoryview) without copying them first. """
+   if len(buffer) == 0:
+      return None
+   with stage("decode"):
+      return cv2.imdecode(np.frombuffer(buffer, np.uint8), cv2.IMREAD_COLOR)
+
 def readb64(uri):
    encoded_data = uri.split(',')[1]
-   nparr = np.fromstring(base64.b64decode(encoded_data), np.uint8)
-   img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-   return img
+   return decode_image(base64.b64decode(encoded_data))
+
+
+class UploadedImage:
+   """ An image sent in the request body, data is a view into the request buffer. """
+   def __init__(self, name, data):
+      self.name = name
+      self.data = data
+
+   def decode(self):
+      return decode_image(self.data)
+
+   def __str__(self):
+      return self.name
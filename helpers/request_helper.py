@@ -0,0 +1,77 @@
+import hashlib
+import mimetypes
+import re
+from urllib.parse import urlparse, parse_qs
+
+import orjson
+
+from helpers.image_helper import UploadedImage
+
+
+def upload_name(data, mime):
+    """ Name for an upload sent without a file name, taken from its content so different images never share one. """
+    return f"upload-{hashlib.blake2b(data, digest_size=8).hexdigest()}{mimetypes.guess_extension(mime) or ''}"
+
+
+def parse_multipart(body, boundary):
+    """
+    Splits a multipart/form-data body into {name: [values]}.  File parts become UploadedImage objects whose data is
+    a memoryview of the body, so uploads are not copied.
+    """
+    view = memoryview(body)
+    delimiter = b"--" + boundary
+    fields = {}
+    start = body.find(delimiter)
+    while start != -1:
+        start += len(delimiter)
+        if body[start:start + 2] == b"--":
+            break
+        header_end = body.find(b"\r\n\r\n", start)
+        end = body.find(b"\r\n" + delimiter, header_end + 4)
+        if header_end == -1 or end == -1:
+            raise ValueError("Malformed multipart body")
+
+        headers = {}
+        for line in bytes(view[start:header_end]).decode("utf-8").split("\r\n"):
+            name, _, value = line.partition(":")
+            if value:
+                headers[name.strip().lower()] = value.strip()
+        disposition = dict(re.findall(r'(\w+)="([^"]*)"', headers.get("content-disposition", "")))
+        content = view[header_end + 4:end]
+
+        part_type = headers.get("content-type", "").split(";")[0].strip().lower()
+        if "filename" in disposition or part_type.startswith("image/"):
+            value = UploadedImage(disposition.get("filename") or upload_name(content, part_type), content)
+        else:
+            value = bytes(content).decode("utf-8")
+        fields.setdefault(disposition.get("name", "image"), []).append(value)
+        start = end + 2
+    return fields
+
+
+def parse_body(path, content_type, body):
+    """
+    Returns the handler parameters for a POST body.  JSON bodies are passed on as before, multipart/form-data and
+    raw image/* bodies are returned like query parameters with the upload under "image".  Raises ValueError.
+    """
+    mime, _, options = (content_type or "").partition(";")
+    mime = mime.strip().lower()
+
+    if mime == "multipart/form-data":
+        match = re.search(r'boundary="?([^";]+)"?', options)
+        if not match:
+            raise ValueError("Missing multipart boundary")
+        params = parse_qs(urlparse(path).query)
+        params.update(parse_multipart(body, match.group(1).encode("latin-1")))
+        return params
+
+    if mime.startswith("image/"):
+        params = parse_qs(urlparse(path).query)
+        name = params.pop("name", [None])[0] or upload_name(body, mime)
+        params["image"] = [UploadedImage(name, memoryview(body))]
+        return params
+
+    try:
+        return orjson.loads(body)
+    except orjson.JSONDecodeError:
+        raise ValueError("Invalid JSON")
@@ -0,0 +1,254 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from urllib.parse import urlparse, parse_qs
+
+import orjson
+
+from helpers.request_helper import parse_body
+from providers.metrics import response_body, route_label, track_request
+
+
+class HttpError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class AsyncRequest:
+    """
+    Gives the handlers the same json / ndjson / not_found methods as the threaded server.  Handlers run on an
+    executor thread, every write is passed to the event loop and waits for the socket to drain.
+    """
+    def __init__(self, loop, writer, method, path, headers, keep_alive, version="HTTP/1.1"):
+        self.loop = loop
+        self.writer = writer
+        self.command = method
+        self.path = path
+        self.headers = headers
+        self.keep_alive = keep_alive
+        self.chunked = version != "HTTP/1.0"  # HTTP/1.0 clients do not understand chunked responses
+        self.responded = False
+
+    async def _send(self, data):
+        self.writer.write(data)
+        await self.writer.drain()
+
+    def write(self, data):
+        asyncio.run_coroutine_threadsafe(self._send(data), self.loop).result()
+
+    def head(self, status, content_type, length=None):
+        """ Without a length the body is chunked, or for HTTP/1.0 ends when the connection is closed. """
+        self.responded = True
+        if length is None and not self.chunked:
+            self.keep_alive = False
+        lines = [f"HTTP/1.1 {status.value} {status.phrase}", f"Content-Type: {content_type}",
+                 f"Connection: {'keep-alive' if self.keep_alive else 'close'}"]
+        if length is not None:
+            lines.append(f"Content-Length: {length}")
+        elif self.chunked:
+            lines.append("Transfer-Encoding: chunked")
+        return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+    def respond(self, status, data):
+        body = response_body(data)
+        self.write(self.head(status, "application/json", len(body)) + body)
+
+    def text(self, body, content_type="text/plain; charset=utf-8"):
+        body = body.encode("utf-8")
+        self.write(self.head(HTTPStatus.OK, content_type, len(body)) + body)
+
+    def json(self, data, status=200):
+        self.respond(HTTPStatus(status), data)
+
+    def ndjson(self, rows):
+        """ Sends each row as a chunk as soon as it is produced. """
+        self.write(self.head(HTTPStatus.OK, "application/x-ndjson"))
+        try:
+            for row in rows:
+                line = orjson.dumps(row) + b"\n"
+                self.write(f"{len(line):x}\r\n".encode("latin-1") + line + b"\r\n" if self.chunked else line)
+        except Exception:
+            self.keep_alive = False  # The response is cut short, closing the connection tells the client
+            raise
+        if self.chunked:
+            self.write(b"0\r\n\r\n")
+
+    def not_found(self):
+        self.respond(HTTPStatus.NOT_FOUND, {"error": "Not Found"})
+
+
+class AsyncWebServer(threading.Thread):
+    """
+    HTTP/1.1 server on an asyncio event loop, an alternative to the thread per connection WebServer.
+    Connections are kept alive, request bodies are read without blocking a thread and at most `max_concurrency`
+    requests run at once on the executor, further requests get a 429 straight away.
+    """
+    keep_alive_timeout = 15
+    max_header_lines = 100
+
+    def __init__(self, routes, create_handler, host="localhost", port=8080, max_concurrency=32, max_body=256 * 1024 * 1024, verbose=0):
+        super().__init__()
+        self.routes = routes
+        self.create_handler = create_handler
+        self.host = host
+        self.port = port
+        self.max_concurrency = max_concurrency
+        self.max_body = max_body
+        self.verbose = verbose
+        self.active = 0
+        self.rejected = 0
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="request")
+        self.loop = asyncio.new_event_loop()
+        self.server = None
+        self.started = threading.Event()
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        self.server = self.loop.run_until_complete(asyncio.start_server(self.connection, self.host, self.port))
+        print(f"Server started at http://{self.host}:{self.port} (asyncio, {self.max_concurrency} concurrent requests)")
+        self.started.set()
+        self.loop.run_forever()
+
+        # Close idle keep-alive connections before the loop goes away
+        tasks = asyncio.all_tasks(self.loop)
+        for task in tasks:
+            task.cancel()
+        self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        self.loop.close()
+
+    def route(self, path):
+        """ Finds the handler for a path, falling back to the first path segment for routes like /jobs/<id>. """
+        return self.routes.get(path) or self.routes.get("/" + path.strip("/").split("/")[0])
+
+    async def read_head(self, reader):
+        """ Returns (method, target, version, headers), or None when the client closed an idle connection. """
+        try:
+            line = await asyncio.wait_for(reader.readline(), self.keep_alive_timeout)
+        except asyncio.TimeoutError:
+            return None
+        if not line:
+            return None
+        parts = line.decode("latin-1").split()
+        if len(parts) != 3:
+            raise HttpError(HTTPStatus.BAD_REQUEST, "Malformed request line")
+
+        headers = {}
+        for _ in range(self.max_header_lines):
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                return parts[0].upper(), parts[1], parts[2], headers
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        raise HttpError(HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE, "Too many headers")
+
+    async def read_body(self, reader, writer, headers):
+        """ Reads a Content-Length or chunked body in pieces, rejecting it as soon as it passes max_body. """
+        if headers.get("expect", "").lower() == "100-continue":
+            writer.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+
+        body = bytearray()
+        if "chunked" in headers.get("transfer-encoding", "").lower():
+            while True:
+                size = int((await reader.readline()).split(b";")[0].strip() or b"0", 16)
+                if size == 0:
+                    while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                        pass  # Trailers
+                    return body
+                if len(body) + size > self.max_body:
+                    raise HttpError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, f"Request body is larger than {self.max_body} bytes")
+                body += await reader.readexactly(size)
+                await reader.readline()
+
+        length = int(headers.get("content-length", 0))
+        if length > self.max_body:
+            raise HttpError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, f"Request body is larger than {self.max_body} bytes")
+        while len(body) < length:
+            chunk = await reader.read(min(65536, length - len(body)))
+            if not chunk:
+                raise asyncio.IncompleteReadError(bytes(body), length)
+            body += chunk
+        return body  # Uploads are decoded straight from this buffer
+
+    def dispatch(self, request, method, body):
+        """ Runs on an executor thread, parses the parameters and calls the handler like the threaded server. """
+        parsed_url = urlparse(request.path)
+        if method == "POST":
+            try:
+                params = parse_body(request.path, request.headers.get("content-type"), body)
+            except ValueError as e:
+                return request.json({"error": str(e)})
+        else:
+            params = parse_qs(parsed_url.query)
+
+        handler_class = self.route(parsed_url.path)
+        if handler_class is None:
+            return request.not_found()
+        try:
+            with track_request(route_label(parsed_url.path), params):
+                self.create_handler(handler_class, request).handle(params)
+        except Exception as e:
+            print(f"Request {request.path} failed: {e}")
+            if not request.responded:
+                request.respond(HTTPStatus.INTERNAL_SERVER_ERROR, {"error": str(e)})
+            else:
+                request.keep_alive = False  # The response may be incomplete
+
+    async def error(self, writer, status, message, retry_after=None):
+        body = orjson.dumps({"error": message})
+        head = f"HTTP/1.1 {status.value} {status.phrase}\r\nContent-Type: application/json\r\nContent-Length: {len(body)}\r\nConnection: close\r\n"
+        if retry_after is not None:
+            head += f"Retry-After: {retry_after}\r\n"
+        writer.write(head.encode("latin-1") + b"\r\n" + body)
+        await writer.drain()
+
+    async def connection(self, reader, writer):
+        try:
+            while True:
+                head = await self.read_head(reader)
+                if head is None:
+                    break
+                method, target, version, headers = head
+                connection = headers.get("connection", "").lower()
+                keep_alive = connection == "keep-alive" if version == "HTTP/1.0" else connection != "close"
+
+                if method not in ("GET", "POST"):
+                    await self.error(writer, HTTPStatus.METHOD_NOT_ALLOWED, f"Unsupported method {method}")
+                    break
+                if self.active >= self.max_concurrency:
+                    # Rejected before the body is read, the connection is closed so the client can retry later
+                    self.rejected += 1
+                    await self.error(writer, HTTPStatus.TOO_MANY_REQUESTS, "Server is busy", retry_after=1)
+                    break
+
+                self.active += 1
+                try:
+                    body = await self.read_body(reader, writer, headers) if method == "POST" else b""
+                    if self.verbose > 1:
+                        print(f"Received {method} request: {target}")
+                    request = AsyncRequest(self.loop, writer, method, target, headers, keep_alive, version)
+                    await self.loop.run_in_executor(self.executor, self.dispatch, request, method, body)
+                finally:
+                    self.active -= 1
+                if not request.keep_alive:
+                    break
+        except HttpError as e:
+            await self.error(writer, e.status, str(e))
+        except (asyncio.IncompleteReadError, asyncio.CancelledError, ConnectionError, ValueError):
+            pass  # Client went away, sent garbage or the server is stopping
+        finally:
+            writer.close()
+
+    def stats(self):
+        return {"active": self.active, "max_concurrency": self.max_concurrency, "rejected": self.rejected}
+
+    def shutdown(self):
+        print('Shutting down server.')
+        self.started.wait()
+
+        self.loop.call_soon_threadsafe(self.server.close)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        print('Closing thread.')
+        self.join()
+        self.executor.shutdown(wait=False)
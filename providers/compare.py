@@ -1,22 +1,82 @@
+import os
 import cv2
 import numpy as np
 from skimage.metrics import structural_similarity as ssim
 
+from providers.descriptor_store import compute_descriptors
+
+# Methods which can be requested with the compare parameter
+COMPARATORS = ("basic", "ssim", "orb", "sift", "histogram")
+
 class Compare:
-    def __init__(self, path1):
-        self.path1 = path1
-        self.img1 = cv2.imread(path1, cv2.IMREAD_GRAYSCALE)
+    def __init__(self, path1, descriptor_store=None, max_features=None):
+        """ path1 can be a file path or an already decoded BGR image. """
+        if isinstance(path1, np.ndarray):
+            self.path1 = None
+            self.color1 = path1
+            self.img1 = cv2.cvtColor(path1, cv2.COLOR_BGR2GRAY) if path1.ndim == 3 else path1
+        else:
+            self.path1 = path1
+            self.color1 = None
+            self.img1 = cv2.imread(str(path1), cv2.IMREAD_GRAYSCALE)
         self.img2 = None
         self.path2 = None
-
-    def set(self, path2):
+        self.descriptor_store = descriptor_store
+        if max_features is None:
+            max_features = descriptor_store.max_features if descriptor_store else 0
+        self.max_features = max_features
+        self.query_descriptors = {}  # Computed once per request
+        self.candidate_descriptors = {}
+        self.matchers = {}  # Reused for every candidate
+
+    def set(self, path2, descriptors=None):
+        """ descriptors can hold already loaded descriptors of the candidate, keyed by comparator. """
         self.path2 = path2
-        self.img2 = cv2.imread(path2, cv2.IMREAD_GRAYSCALE)
+        self.img2 = None  # Only read from disk when a comparator needs the pixels
+        self.candidate_descriptors = descriptors or {}
+
+    def _image2(self):
+        if self.img2 is None:
+            self.img2 = cv2.imread(str(self.path2), cv2.IMREAD_GRAYSCALE)
+        return self.img2
+
+    def query(self, kinds):
+        """ Computes the search image descriptors for several comparators at once and returns them. """
+        for kind in kinds:
+            self._query(kind)
+        return dict(self.query_descriptors)
+
+    def image1(self):
+        """ The search image in color, read on first use. """
+        if self.color1 is None:
+            self.color1 = cv2.imread(str(self.path1))
+        return self.color1
+
+    def _query(self, kind):
+        """ Descriptors of the search image, computed on first use. """
+        if kind not in self.query_descriptors:
+            # Same conversion as the descriptors stored during /add
+            self.query_descriptors[kind] = compute_descriptors(self.image1(), [kind], self.max_features).get(kind)
+        return self.query_descriptors[kind]
+
+    def _candidate(self, kind):
+        """ Stored descriptors of the current candidate, falling back to computing them from the file. """
+        if self.candidate_descriptors.get(kind) is not None:
+            return self.candidate_descriptors[kind]
+        if self.descriptor_store is not None:
+            stored = self.descriptor_store.get(os.path.basename(self.path2), kind)
+            if stored is not None:
+                return stored
+
+        img = cv2.imread(str(self.path2))  # Don't use the grayscale images
+        if img is None:
+            return None
+        return compute_descriptors(img, [kind], self.max_features).get(kind)
 
     def basic(self):
         # Load images in grayscale
         img1 = self.img1
-        img2 = self.img2
+        img2 = self._image2()
 
         # Ensure both images are the same size
         if img1.shape != img2.shape:
@@ -33,7 +93,7 @@ class Compare:
 
     def ssim(self):
         img1 = self.img1
-        img2 = self.img2
+        img2 = self._image2()
 
         # Resize to match shapes
         if img1.shape != img2.shape:
@@ -45,22 +105,17 @@ class Compare:
 
 
     def orb(self):
-        img1 = self.img1
-        img2 = self.img2
-
-        # Initialize ORB detector
-        orb = cv2.ORB_create()
-
-        # Detect and compute ORB descriptors
-        keypoints1, descriptors1 = orb.detectAndCompute(img1, None)
-        keypoints2, descriptors2 = orb.detectAndCompute(img2, None)
+        descriptors1 = self._query("orb")
+        descriptors2 = self._candidate("orb")
+        if descriptors1 is None or descriptors2 is None:
+            return float("inf")
 
         # Use BFMatcher to find best matches
-        bf = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=True)
-        matches = bf.match(descriptors1, descriptors2)
-
-        # Sort matches by distance
-        matches = sorted(matches, key=lambda x: x.distance)
+        if "orb" not in self.matchers:
+            self.matchers["orb"] = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=True)
+        matches = self.matchers["orb"].match(descriptors1, descriptors2)
+        if not matches:
+            return float("inf")
 
         # Calculate similarity score (lower distance = better match)
         score = sum(match.distance for match in matches) / len(matches)
@@ -68,46 +123,33 @@ class Compare:
         return score  # Lower is better (0 = identical images)
 
     def sift(self):
-        img1 = self.img1
-        img2 = self.img2
-
-        # Initialize SIFT detector
-        sift = cv2.SIFT_create()
-
-        # Detect and compute SIFT descriptors
-        keypoints1, descriptors1 = sift.detectAndCompute(img1, None)
-        keypoints2, descriptors2 = sift.detectAndCompute(img2, None)
+        descriptors1 = self._query("sift")
+        descriptors2 = self._candidate("sift")
+        if descriptors1 is None or descriptors2 is None or len(descriptors2) < 2:
+            return 0
 
         # Use FLANN matcher for SIFT (faster than brute-force)
-        index_params = dict(algorithm=1, trees=5)
-        search_params = dict(checks=50)
-        flann = cv2.FlannBasedMatcher(index_params, search_params)
+        if "sift" not in self.matchers:
+            index_params = dict(algorithm=1, trees=5)
+            search_params = dict(checks=50)
+            self.matchers["sift"] = cv2.FlannBasedMatcher(index_params, search_params)
 
-        matches = flann.knnMatch(descriptors1, descriptors2, k=2)
+        matches = self.matchers["sift"].knnMatch(descriptors1.astype(np.float32), descriptors2.astype(np.float32), k=2)
 
         # Apply Lowe's ratio test
-        good_matches = [m for m, n in matches if m.distance < 0.75 * n.distance]
+        good_matches = [m for m, n in (match for match in matches if len(match) == 2) if m.distance < 0.75 * n.distance]
 
         # Return match count as a similarity score
         return len(good_matches)  # Higher is better
 
     def histogram(self):
-        # Don't use the grayscale images
-        img1 = cv2.imread(self.path1)
-        img2 = cv2.imread(self.path2)
-
-        # Convert to HSV for better color matching
-        img1_hsv = cv2.cvtColor(img1, cv2.COLOR_BGR2HSV)
-        img2_hsv = cv2.cvtColor(img2, cv2.COLOR_BGR2HSV)
-
-        # Compute color histograms
-        hist1 = cv2.calcHist([img1_hsv], [0, 1, 2], None, [8, 8, 8], [0, 256, 0, 256, 0, 256])
-        hist2 = cv2.calcHist([img2_hsv], [0, 1, 2], None, [8, 8, 8], [0, 256, 0, 256, 0, 256])
-
-        # Normalize and compare using correlation
-        hist1 = cv2.normalize(hist1, hist1).flatten()
-        hist2 = cv2.normalize(hist2, hist2).flatten()
-
-        similarity = cv2.compareHist(hist1, hist2, cv2.HISTCMP_CORREL)
+        # Color histograms in HSV space for better color matching
+        hist1 = self._query("histogram")
+        hist2 = self._candidate("histogram")
+        if hist1 is None or hist2 is None:
+            return 0.0
+
+        # Compare using correlation
+        similarity = cv2.compareHist(hist1.astype(np.float32), hist2.astype(np.float32), cv2.HISTCMP_CORREL)
 
         return similarity  # 1 = identical, 0 = no match
@@ -1,23 +1,49 @@
 import os
 import sqlite3
+import threading
+import time
 from pathlib import Path
-os.environ["LOKY_MAX_CPU_COUNT"] = "4"
-from sklearn.neighbors import NearestNeighbors
+from queue import Queue, Empty
 import numpy as np
 
+from providers import filters
+from providers.index import ExactIndex, create_index
+from providers.metrics import images_added_total, stage
+from providers.vector_store import VectorStore
+
 class Database:
-    def __init__(self, filename):
-        self.data = {}  # Dictionary: {img_file: features}
-        self.feature_matrix = None  # Precomputed feature matrix for fast querying
-        self.features_altered = True
-        self.img_files = []  # Ordered list of image paths
+    def __init__(self, filename, index_type="exact", index_options=None, use_store=True):
+        self.keys = set()  # Every image file in the database
+        self.index_type = index_type
+        self.index_options = index_options or {}
+        self.index = create_index(index_type, **self.index_options)
+        self.write_only = False
         self.filename = Path(filename).with_suffix(".sqlite")
+        self.store = VectorStore(Path(filename).with_suffix(".vectors")) if use_store else None
+        self.store_clean = True
         self.conn = sqlite3.connect(self.filename, check_same_thread=False)
+        self.lock = threading.RLock()  # The connection is shared between request threads and the writer
+        self._set_pragmas()
         self.cursor = self.conn.cursor()
         self._create_table()
-        self.nn_model = None
+        self.writer = None
+        self.feature_cache = None
+        self.descriptor_store = None
+        self.jobs = None
+        self.duplicates = None  # The last near-duplicate search started from /duplicates
+        self.search_cache = None
+        self.ready = threading.Event()  # Set once load() has built the index
+        self.startup = None
+        self.version = 0  # Incremented on every add or remove, cached search results are only valid for one version
         self.verbose = 0
 
+    def _set_pragmas(self):
+        """ WAL lets searches read while the writer commits, NORMAL sync only fsyncs at checkpoints. """
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("PRAGMA temp_store=MEMORY")
+        self.conn.execute("PRAGMA cache_size=-65536")  # 64MB
+
     def _create_table(self):
         """ Creates table to store feature vectors. """
         self.cursor.execute("""
@@ -26,44 +52,275 @@ class Database:
                 features BLOB
             )
         """)
+        self.cursor.execute("""
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                img_file VARCHAR(255),
+                size INTEGER,
+                mtime_ns INTEGER
+            )
+        """)
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS files_img_file ON files (img_file)")
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS files_mtime ON files (mtime_ns)")
+        self.cursor.execute("""
+            CREATE TABLE IF NOT EXISTS metadata (
+                img_file VARCHAR(255),
+                key VARCHAR(64),
+                value TEXT,
+                PRIMARY KEY (img_file, key, value)
+            )
+        """)
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS metadata_key_value ON metadata (key, value)")
+        self.cursor.execute("""
+            CREATE TABLE IF NOT EXISTS meta (
+                key VARCHAR(255) PRIMARY KEY,
+                value TEXT
+            )
+        """)
         self.conn.commit()
 
+    def get_meta(self, key, default=None):
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key, )).fetchone()
+        return row[0] if row else default
+
+    def set_meta(self, key, value):
+        """ Must be called inside a transaction. """
+        self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, str(value)))
+
+    def check_model_tag(self, tag, legacy_tag):
+        """
+        Records which model produced the vectors and refuses to open the database with a different one.
+        Databases from before tags were recorded are assumed to hold legacy_tag vectors.
+        """
+        stored = self.get_meta("model_tag")
+        if stored is None:
+            with self.lock, self.conn:
+                empty = self.conn.execute("SELECT COUNT(*) FROM images").fetchone()[0] == 0
+                stored = tag if empty else legacy_tag
+                self.set_meta("model_tag", stored)
+        if stored != tag:
+            raise ValueError(f"{self.filename} holds vectors from {stored}, they can not be mixed with {tag}")
+
+    def _store_changing(self):
+        """ Flags the vector store as stale in the same transaction as the SQLite change. """
+        if self.store is not None and self.store_clean:
+            self.set_meta("vector_store_clean", 0)
+            self.store_clean = False
+
+    def _store_changed(self):
+        if self.store is not None and not self.store_clean and self.store.is_clean():
+            with self.conn:
+                self.set_meta("vector_store_clean", 1)
+            self.store_clean = True
+
     def exists(self, img_file):
         """ Check if an image already exists in the database. """
-        return img_file in self.data
+        return img_file in self.keys
 
     def add(self, feature_vector, img_path):
         basename = os.path.basename(img_path)
         """ Adds or updates an entry with features and associated image path. """
         feature_blob = feature_vector.tobytes()
 
-        with self.conn:
-            if self.exists(basename):
-                print(f"Image '{basename}' already exists. Updating features.")
-                self.conn.execute("UPDATE images SET features = ? WHERE img_file = ?", (feature_blob, basename))
-            else:
-                self.conn.execute("INSERT INTO images (img_file, features) VALUES (?, ?)", (basename, feature_blob))
+        with self.lock:
+            with self.conn:
+                self._store_changing()
+                if self.exists(basename):
+                    print(f"Image '{basename}' already exists. Updating features.")
+                    self.conn.execute("UPDATE images SET features = ? WHERE img_file = ?", (feature_blob, basename))
+                else:
+                    self.conn.execute("INSERT INTO images (img_file, features) VALUES (?, ?)", (basename, feature_blob))
+                self._record_files([img_path])
 
-        self.data[basename] = np.array(feature_vector, dtype="float32")  # Store in dictionary
-        self.features_altered = True
+            self.keys.add(basename)
+            self.version += 1
+            images_added_total.inc()
+            if self.store is not None:
+                self.store.append([basename], [feature_vector])
+                self._store_changed()
+        if not self.write_only:
+            self.index.add(basename, feature_vector)
 
-    def _update_feature_matrix(self):
-        self.features_altered = False
-        """ Recomputes the NumPy feature matrix for fast queries. """
-        if self.data:
-            self.feature_matrix = np.vstack(list(self.data.values()))  # Stack all feature vectors
-            self.img_files = list(self.data.keys())  # Maintain an ordered list of image files
+    def add_many(self, items):
+        """ Adds or updates a list of (feature_vector, img_path) pairs in a single transaction. """
+        rows = [(os.path.basename(img_path), np.asarray(feature_vector, dtype="float32")) for feature_vector, img_path in items]
+        if not rows:
+            return
 
-            self.nn_model = NearestNeighbors(n_neighbors=5, algorithm="auto", metric="euclidean")
-            self.nn_model.fit(self.feature_matrix)
-        else:
-            self.nn_model = None
-            self.feature_matrix = None
-            self.img_files = []
+        keys = [basename for basename, _ in rows]
+        vectors = [vector for _, vector in rows]
+        with self.lock:
+            with self.conn:
+                self._store_changing()
+                self.conn.executemany("INSERT OR REPLACE INTO images (img_file, features) VALUES (?, ?)",
+                                      [(basename, vector.tobytes()) for basename, vector in rows])
+                self._record_files([img_path for _, img_path in items])
+
+            self.keys.update(keys)
+            self.version += 1
+            images_added_total.inc(len(keys))
+            if self.store is not None:
+                self.store.append(keys, vectors)
+                self._store_changed()
+        if not self.write_only:
+            self.index.add_many(keys, vectors)
+
+    def set_metadata(self, img_files, metadata):
+        """ Adds {key: [values]} metadata (such as tags) to images, used by search filters. """
+        rows = [(os.path.basename(img_file), key, value) for img_file in img_files for key, items in metadata.items() for value in items]
+        if not rows:
+            return
+        with self.lock:
+            with self.conn:
+                self.conn.executemany("INSERT OR IGNORE INTO metadata (img_file, key, value) VALUES (?, ?, ?)", rows)
+            self.version += 1
+
+    def get_metadata(self, img_file):
+        with self.lock:
+            rows = self.conn.execute("SELECT key, value FROM metadata WHERE img_file = ?", (os.path.basename(img_file), )).fetchall()
+        metadata = {}
+        for key, value in rows:
+            metadata.setdefault(key, []).append(value)
+        return metadata
+
+    def _record_files(self, paths):
+        """ Saves the size and modification time of added files, must be called inside the transaction adding them. """
+        rows = []
+        for path in paths:
+            if not os.path.isabs(path):
+                continue  # Uploaded images only have a name
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            rows.append((os.path.abspath(path), os.path.basename(path), stat.st_size, stat.st_mtime_ns))
+        self.conn.executemany("INSERT OR REPLACE INTO files (path, img_file, size, mtime_ns) VALUES (?, ?, ?, ?)", rows)
+
+    def file_changed(self, path, stat):
+        """
+        True if the file at path is new or its size or modification time differ from when it was added.
+        Images added before their path was recorded are adopted as unchanged rather than extracted again.
+        """
+        path = os.path.abspath(path)
+        with self.lock:
+            row = self.conn.execute("SELECT size, mtime_ns FROM files WHERE path = ?", (path, )).fetchone()
+            if row is not None:
+                return row != (stat.st_size, stat.st_mtime_ns)
+            if not self.exists(os.path.basename(path)):
+                return True
+            with self.conn:
+                self.conn.execute("INSERT OR REPLACE INTO files (path, img_file, size, mtime_ns) VALUES (?, ?, ?, ?)",
+                                  (path, os.path.basename(path), stat.st_size, stat.st_mtime_ns))
+        return False
+
+    def prune_files(self, root, page_size=1000):
+        """ Removes images under root whose files no longer exist, returns how many were removed. """
+        prefix = os.path.join(os.path.abspath(root), "")
+        upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)  # Every path starting with prefix sorts below this
+        removed = 0
+        last = prefix
+        while True:
+            with self.lock:
+                rows = self.conn.execute("SELECT path, img_file FROM files WHERE path > ? AND path < ? ORDER BY path LIMIT ?",
+                                         (last, upper, page_size)).fetchall()
+            if not rows:
+                return removed
+            last = rows[-1][0]
+
+            for path, img_file in rows:
+                if os.path.exists(path):
+                    continue
+                with self.lock:
+                    with self.conn:
+                        self.conn.execute("DELETE FROM files WHERE path = ?", (path, ))
+                    shared = self.conn.execute("SELECT 1 FROM files WHERE img_file = ? LIMIT 1", (img_file, )).fetchone()
+                if shared is None and self.remove(img_file):
+                    removed += 1
+                    if self.verbose > 0:
+                        print(f"Removed missing image {path}")
 
+    def merge(self, path):
+        """ Copies the images, file details and descriptors of another database into this one, returns the image count. """
+        with self.lock:
+            self.conn.execute("ATTACH DATABASE ? AS part", (str(path), ))
+            try:
+                tables = {name for name, in self.conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+                part_tables = {name for name, in self.conn.execute("SELECT name FROM part.sqlite_master WHERE type = 'table'")}
+                with self.conn:
+                    self._store_changing()
+                    count = self.conn.execute("INSERT OR REPLACE INTO images (img_file, features) SELECT img_file, features FROM part.images").rowcount
+                    self.conn.execute("INSERT OR REPLACE INTO files (path, img_file, size, mtime_ns) SELECT path, img_file, size, mtime_ns FROM part.files")
+                    if "metadata" in part_tables:
+                        self.conn.execute("INSERT OR IGNORE INTO metadata (img_file, key, value) SELECT img_file, key, value FROM part.metadata")
+                    if "descriptors" in tables and "descriptors" in part_tables:
+                        self.conn.execute("INSERT OR REPLACE INTO descriptors (img_file, kind, data) SELECT img_file, kind, data FROM part.descriptors")
+                self.keys.update(img_file for img_file, in self.conn.execute("SELECT img_file FROM part.images"))
+                self.version += 1
+            finally:
+                self.conn.execute("DETACH DATABASE part")
+        return count
+
+    def rebuild_store(self):
+        """ Regenerates the memory-mapped vector store from SQLite. """
+        print(f"Rebuilding vector store {self.store.path} from {self.filename}")
+        with self.lock:
+            self.store.rebuild(self.conn.execute("SELECT img_file, features FROM images"))
+            with self.conn:
+                self.set_meta("vector_store_clean", 1)
+            self.store_clean = True
+        print(f"Vector store rebuilt with {len(self.store)} images")
+
+    def fetch_vectors(self, keys):
+        """ Full precision vectors for a list of image files, read from SQLite. """
+        vectors = {}
+        keys = list(keys)
+        with self.lock:
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                rows = self.conn.execute(f"SELECT img_file, features FROM images WHERE img_file IN ({','.join('?' * len(chunk))})", chunk)
+                for img_file, feature_blob in rows:
+                    vectors[img_file] = np.frombuffer(feature_blob, dtype=np.float32)
+        return vectors
+
+    def sample_vectors(self, count, seed=0):
+        """ A random sample of up to `count` vectors from the images table. """
+        with self.lock:
+            max_rowid = self.conn.execute("SELECT MAX(rowid) FROM images").fetchone()[0]
+        if not max_rowid:
+            return np.empty((0, 0), dtype=np.float32)
+        rowids = np.random.default_rng(seed).choice(np.arange(1, max_rowid + 1), size=min(count, max_rowid), replace=False)
+        vectors = []
+        with self.lock:
+            for start in range(0, len(rowids), 500):
+                chunk = [int(rowid) for rowid in rowids[start:start + 500]]
+                rows = self.conn.execute(f"SELECT features FROM images WHERE rowid IN ({','.join('?' * len(chunk))})", chunk)
+                vectors.extend(np.frombuffer(feature_blob, dtype=np.float32) for feature_blob, in rows)
+        return np.vstack(vectors) if vectors else np.empty((0, 0), dtype=np.float32)
+
+    def _train_index(self, count):
+        """ Indexes which need training (ivf, pq, sq8) are trained from a sample of the table before loading. """
+        if getattr(self.index, "trained", True) or count == 0:
+            return
+        sample = self.sample_vectors(self.index_options.get("train_size", 20000))
+        if len(sample):
+            print(f"Training {self.index_type} index on {len(sample)} sampled images")
+            self.index.train(sample, count=count)
+
+    def _open_store(self, count):
+        """ Opens the vector store, rebuilding it first if it is missing or out of date with SQLite. """
+        if not self.store.exists() or self.get_meta("vector_store_clean") != "1":
+            self.rebuild_store()
+        blocks = self.store.open()
+        if len(self.store) != count:
+            print(f"Vector store has {len(self.store)} images but the database has {count}")
+            self.rebuild_store()
+            blocks = self.store.open()
+        return blocks
 
     def load(self, write_only=False):
         """ Loads all image features from the database. """
+        self.write_only = write_only
         self.cursor.execute("SELECT COUNT(*) FROM images")
         count = self.cursor.fetchone()[0]
         if write_only:
@@ -71,53 +328,255 @@ class Database:
         else:
             print(f"Loading {count} images from the database.  This may take a while...")
 
-        self.cursor.execute("SELECT img_file, features FROM images")
-        for img_file, feature_blob in self.cursor.fetchall():
-            if write_only:
-                self.data[img_file] =np.array([1], dtype=np.float32) # Do this so that we can load the database with empty data and track the image keys only
-            else:
-                self.data[img_file] = np.frombuffer(feature_blob, dtype=np.float32)  # Convert binary back to NumPy array
+        if hasattr(self.index, "fetch"):
+            self.index.fetch = self.fetch_vectors
+        if not write_only:
+            self._train_index(count)
 
-        self._update_feature_matrix()
+        if self.store is not None:
+            blocks = self._open_store(count)
+            self.keys.update(self.store.locations)
+            if not write_only:
+                for keys, vectors, norms, deleted in blocks:
+                    self.index.attach(keys, vectors, norms, deleted)
+        elif write_only:
+            self.cursor.execute("SELECT img_file FROM images")
+            self.keys.update(img_file for img_file, in self.cursor)  # Track the image keys only
+        else:
+            self.cursor.execute("SELECT img_file, features FROM images")
+            keys = []
+            vectors = []
+            for img_file, feature_blob in self.cursor:
+                keys.append(img_file)
+                vectors.append(np.frombuffer(feature_blob, dtype=np.float32))  # Convert binary back to NumPy array
+            self.keys.update(keys)
+            if keys:
+                self.index.add_many(keys, np.vstack(vectors))
 
         print("Loading Database Completed")
+        self.ready.set()
 
-    def query(self, query_vector, top_k=5):
-        """ Finds the closest feature matches and returns (image_path, distance). """
-        # if self.features_altered:
-        #     self._update_feature_matrix()
-
-        if self.nn_model is None:
+    def query(self, query_vector, top_k=5, search_filter=None):
+        """ Finds the closest feature matches and returns (image_path, distance), only those matching search_filter if given. """
+        if len(self.index) == 0:
             print("Database is empty. No query can be performed.")
             return []
 
         if self.verbose > 1:
             print("Finding nearest neighbors...")
 
-        dists, ids = self.nn_model.kneighbors([query_vector], n_neighbors=top_k)
+        with stage("index"):
+            if search_filter is None:
+                results = self.index.search(query_vector, top_k)
+            else:
+                results = filters.search(self, [query_vector], top_k, search_filter)[0]
 
         if self.verbose > 1:
-            print(f"Found {len(ids[0])} nearest neighbors.")
+            print(f"Found {len(results)} nearest neighbors.")
 
-        nearest_images = [{"image": self.img_files[ids[0][i]], "distance": float(dists[0][i])} for i in range(len(ids[0]))]
+        return [{"image": img_file, "distance": distance} for img_file, distance in results]
 
-        return nearest_images
+    def query_many(self, query_vectors, top_k=5, search_filter=None):
+        """ Runs several queries in one index call and returns a result list per query vector. """
+        if len(self.index) == 0:
+            print("Database is empty. No query can be performed.")
+            return [[] for _ in query_vectors]
+
+        with stage("index"):
+            if search_filter is None:
+                results = self.index.search_many(query_vectors, top_k)
+            else:
+                results = filters.search(self, query_vectors, top_k, search_filter)
+        return [[{"image": img_file, "distance": distance} for img_file, distance in rows] for rows in results]
 
     def count(self):
-        if self.features_altered:
-            self._update_feature_matrix()
-        return len(self.img_files)
+        return len(self.keys)
+
+    def exact_neighbours(self, query_vectors, top_k=10):
+        """ Exact top-k (key, distance) lists streamed from SQLite one chunk at a time, so memory stays bounded. """
+        exact = [[] for _ in query_vectors]
+        with self.lock:
+            rows = self.conn.execute("SELECT img_file, features FROM images").fetchmany
+            while chunk := rows(50000):
+                block = ExactIndex()
+                block.add_many([img_file for img_file, _ in chunk], [np.frombuffer(blob, dtype=np.float32) for _, blob in chunk])
+                for best, found in zip(exact, block.search_many(query_vectors, top_k)):
+                    best.extend(found)
+                    best.sort(key=lambda r: r[1])
+                    del best[top_k:]
+        return exact
+
+    def evaluate_index(self, queries=100, top_k=10):
+        """ Compares the loaded index with an exact search streamed from SQLite, reporting recall@k, latency and memory. """
+        query_vectors = self.sample_vectors(queries, seed=1)
+        if len(query_vectors) == 0:
+            return {"error": "Database is empty"}
+
+        start = time.monotonic()
+        approximate = self.index.search_many(query_vectors, top_k)
+        latency = (time.monotonic() - start) / len(query_vectors)
+        exact = self.exact_neighbours(query_vectors, top_k)
+
+        recall = np.mean([len({k for k, _ in a} & {k for k, _ in e}) / max(1, len(e)) for a, e in zip(approximate, exact)])
+        dim = query_vectors.shape[1]
+        return {
+            "index": self.index.stats(),
+            "queries": len(query_vectors),
+            "k": top_k,
+            f"recall@{top_k}": round(float(recall), 4),
+            "avg_query_ms": round(1000 * latency, 3),
+            "memory_bytes": self.index.memory(),
+            "float32_memory_bytes": len(self.index) * dim * 4,
+        }
 
     def remove(self, img_path):
         basename = os.path.basename(img_path)
 
-        with self.conn:
+        with self.lock, self.conn:
             if self.exists(basename):
+                self._store_changing()
                 self.conn.execute("DELETE FROM images WHERE img_file = ?", (basename, ))
-                del self.data[basename]
-                self.features_altered = True
+                self.conn.execute("DELETE FROM files WHERE img_file = ?", (basename, ))
+                self.conn.execute("DELETE FROM metadata WHERE img_file = ?", (basename, ))
+                if self.descriptor_store is not None:
+                    self.descriptor_store._delete(basename)  # Same transaction, so either every row goes or none
+                self.keys.discard(basename)
+                self.version += 1
+                self.index.remove(basename)
+                if self.store is not None:
+                    self.store.delete(basename)
                 return True
 
         return False
 
+    def start_writer(self, batch_size=256, interval=1.0):
+        """ Starts the background thread which commits submitted rows in batches. """
+        self.writer = DatabaseWriter(self, batch_size, interval)
+        self.writer.start()
+
+    def submit_many(self, items, on_failed=None):
+        """
+        Queues (feature_vector, img_path) pairs for the writer thread, or writes them now if there is none.
+        on_failed is called with the path of each row which could not be committed.
+        """
+        if self.writer is None:
+            return self.add_many(items)
+        self.writer.submit_many(items, on_failed)
+
+    def flush(self):
+        """ Blocks until every submitted row has been committed or reported to its on_failed callback. """
+        if self.writer is not None:
+            self.writer.flush()
+
+    def close(self):
+        """ Commits queued rows, writes any buffered vectors to the vector store and closes the connection. """
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        with self.lock:
+            if self.store is not None:
+                self.store.flush()
+                self._store_changed()
+            self.conn.close()
+        if hasattr(self.index, "close"):
+            self.index.close()
+
+
+class DatabaseWriter(threading.Thread):
+    """
+    Background thread which takes (feature_vector, img_path) rows from ingest workers and commits them with
+    executemany, once `batch_size` rows are waiting or `interval` seconds after the first waiting row.
+    """
+    def __init__(self, database, batch_size=256, interval=1.0):
+        super().__init__(daemon=True)
+        self.database = database
+        self.batch_size = max(1, batch_size)
+        self.interval = interval
+        self.queue = Queue()
+        self.rows = 0
+        self.commits = 0
+        self.errors = 0
+        self.failed_rows = 0
+        self.commit_time = 0.0
+        self.max_commit_time = 0.0
+        self.start_time = time.monotonic()
+
+    def submit_many(self, items, on_failed=None):
+        for item in items:
+            self.queue.put((item, on_failed))
+
+    def flush(self):
+        done = threading.Event()
+        self.queue.put(done)
+        done.wait()
+
+    def close(self):
+        self.queue.put(None)  # Sentinel value to signal exit
+        self.join()
+
+    def commit(self, batch):
+        """ Commits a batch of (row, on_failed) items, retrying row by row if the batch fails so one bad row loses only itself. """
+        if not batch:
+            return
+        start = time.monotonic()
+        try:
+            self.database.add_many([row for row, _ in batch])
+            committed = len(batch)
+        except Exception as e:
+            self.errors += 1
+            print(f"Failed to write {len(batch)} images to the database, retrying one at a time: {e}")
+            committed = 0
+            for row, on_failed in batch:
+                try:
+                    self.database.add_many([row])
+                    committed += 1
+                except Exception as e:
+                    self.failed_rows += 1
+                    print(f"Failed to write {row[1]} to the database: {e}")
+                    if on_failed:
+                        on_failed(row[1])
+        elapsed = time.monotonic() - start
+        self.rows += committed
+        self.commits += 1
+        self.commit_time += elapsed
+        self.max_commit_time = max(self.max_commit_time, elapsed)
+
+    def run(self):
+        batch = []
+        deadline = None
+        while True:
+            try:
+                item = self.queue.get(timeout=max(0.0, deadline - time.monotonic()) if batch else None)
+            except Empty:
+                self.commit(batch)
+                batch = []
+                continue
+
+            if item is None:
+                self.commit(batch)
+                break
+            if isinstance(item, threading.Event):  # Flush marker
+                self.commit(batch)
+                batch = []
+                item.set()
+                continue
+
+            if not batch:
+                deadline = time.monotonic() + self.interval
+            batch.append(item)
+            if len(batch) >= self.batch_size:
+                self.commit(batch)
+                batch = []
 
+    def stats(self):
+        elapsed = time.monotonic() - self.start_time
+        return {
+            "rows": self.rows,
+            "commits": self.commits,
+            "errors": self.errors,
+            "failed_rows": self.failed_rows,
+            "queued": self.queue.qsize(),
+            "rows_per_sec": round(self.rows / elapsed, 2) if elapsed > 0 else 0.0,
+            "avg_commit_ms": round(1000 * self.commit_time / self.commits, 2) if self.commits else 0.0,
+            "max_commit_ms": round(1000 * self.max_commit_time, 2),
+        }
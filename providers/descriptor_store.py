@@ -0,0 +1,84 @@
+import cv2
+import numpy as np
+
+# Row width and storage type of each descriptor kind
+DESCRIPTOR_LAYOUT = {
+    "sift": (128, np.uint8),  # OpenCV SIFT values are saturated to 0-255 so uint8 is lossless
+    "orb": (32, np.uint8),
+    "histogram": (512, np.float16),
+}
+
+
+def compute_descriptors(img, kinds, max_features=0):
+    """ Computes comparator descriptors for a BGR image.  Kept free of database state so it can run in decode worker processes. """
+    descriptors = {}
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY) if img.ndim == 3 else img
+
+    if "sift" in kinds:
+        _, des = cv2.SIFT_create(nfeatures=max_features).detectAndCompute(gray, None)
+        descriptors["sift"] = None if des is None else np.clip(des, 0, 255).astype(np.uint8)
+    if "orb" in kinds:
+        _, des = cv2.ORB_create(nfeatures=max_features or 500).detectAndCompute(gray, None)
+        descriptors["orb"] = des
+    if "histogram" in kinds and img.ndim == 3:
+        hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
+        hist = cv2.calcHist([hsv], [0, 1, 2], None, [8, 8, 8], [0, 256, 0, 256, 0, 256])
+        descriptors["histogram"] = cv2.normalize(hist, hist).flatten().astype(np.float16)
+
+    return descriptors
+
+
+class DescriptorStore:
+    """ Precomputed SIFT / ORB descriptors and HSV histograms per image, saved in the extractor's database. """
+    def __init__(self, database, kinds, max_features=500):
+        self.database = database
+        self.kinds = [kind for kind in kinds if kind in DESCRIPTOR_LAYOUT]
+        self.max_features = max_features
+        with database.lock, database.conn:
+            database.conn.execute("""
+                CREATE TABLE IF NOT EXISTS descriptors (
+                    img_file VARCHAR(255),
+                    kind VARCHAR(16),
+                    data BLOB,
+                    PRIMARY KEY (img_file, kind)
+                )
+            """)
+
+    def compute(self, img):
+        return compute_descriptors(img, self.kinds, self.max_features)
+
+    def put_many(self, items):
+        """ Stores a list of (img_file, descriptors dict) pairs. """
+        rows = []
+        for img_file, descriptors in items:
+            for kind, data in descriptors.items():
+                if data is not None:
+                    rows.append((img_file, kind, np.ascontiguousarray(data, dtype=DESCRIPTOR_LAYOUT[kind][1]).tobytes()))
+        if not rows:
+            return
+        with self.database.lock, self.database.conn:
+            self.database.conn.executemany("INSERT OR REPLACE INTO descriptors (img_file, kind, data) VALUES (?, ?, ?)", rows)
+
+    def missing(self, img_file):
+        """ The kinds which have no stored descriptors for this image. """
+        with self.database.lock:
+            stored = {kind for kind, in self.database.conn.execute("SELECT kind FROM descriptors WHERE img_file = ?", (img_file, ))}
+        return [kind for kind in self.kinds if kind not in stored]
+
+    def get(self, img_file, kind):
+        """ Returns the stored descriptors, or None if they were never computed for this image. """
+        with self.database.lock:
+            row = self.database.conn.execute("SELECT data FROM descriptors WHERE img_file = ? AND kind = ?", (img_file, kind)).fetchone()
+        if row is None:
+            return None
+        width, dtype = DESCRIPTOR_LAYOUT[kind]
+        data = np.frombuffer(row[0], dtype=dtype)
+        return data if kind == "histogram" else data.reshape(-1, width)
+
+    def _delete(self, img_file):
+        """ Deletes within the caller's transaction, the caller holds the database lock. """
+        self.database.conn.execute("DELETE FROM descriptors WHERE img_file = ?", (img_file, ))
+
+    def remove(self, img_file):
+        with self.database.lock, self.database.conn:
+            self._delete(img_file)
@@ -0,0 +1,190 @@
+import multiprocessing
+import signal
+import sqlite3
+import threading
+import time
+
+import numpy as np
+import orjson
+
+_vectors = None  # The exported matrix, mapped once per worker process
+
+
+def _init_worker(filename, shape):
+    global _vectors
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # The parent stops the pool itself
+    _vectors = np.memmap(filename, dtype=np.float32, mode="r", shape=shape)
+
+
+def _compare_blocks(task):
+    """ Pairs of rows closer than the threshold between two row ranges, only i < j pairs are returned. """
+    a_start, a_stop, b_start, b_stop, threshold = task
+    a = np.asarray(_vectors[a_start:a_stop])
+    b = a if a_start == b_start else np.asarray(_vectors[b_start:b_stop])
+    a_norms = np.einsum("ij,ij->i", a, a)
+    b_norms = a_norms if a_start == b_start else np.einsum("ij,ij->i", b, b)
+
+    dists = a_norms[:, None] + b_norms[None, :] - 2 * (a @ b.T)  # Squared euclidean distance
+    close = dists <= threshold * threshold
+    if a_start == b_start:
+        close = np.triu(close, k=1)
+    rows, cols = np.nonzero(close)
+    return len(a) * len(b), rows + a_start, cols + b_start
+
+
+class UnionFind:
+    def __init__(self, size):
+        self.parent = list(range(size))
+
+    def find(self, item):
+        parent = self.parent
+        while parent[item] != item:
+            parent[item] = parent[parent[item]]  # Path halving
+            item = parent[item]
+        return item
+
+    def union(self, a, b):
+        a, b = self.find(a), self.find(b)
+        if a != b:
+            self.parent[max(a, b)] = min(a, b)
+
+
+class DuplicateFinder:
+    """
+    Groups near-duplicate images by comparing every stored vector with every other.  The vectors are copied from
+    SQLite into a temporary memory-mapped file, then square blocks of it are compared by worker processes with one
+    matrix product each, so memory stays at a few blocks no matter how large the database is.  Pairs closer than
+    `threshold` (the distance reported by /search) are joined with union-find and every connected group of two or
+    more images is written to `output` as JSON.
+    """
+    def __init__(self, database, threshold=0.25, block_rows=4096, workers=1, output=None, verbose=0):
+        self.database = database
+        self.threshold = threshold
+        self.block_rows = max(1, block_rows)
+        self.workers = max(1, workers)
+        self.output = output or database.filename.with_suffix(".duplicates.json")
+        self.verbose = verbose
+        self.cancel_event = threading.Event()
+        self.thread = None
+        self.status = "queued"
+        self.error = None
+        self.images = 0
+        self.blocks_total = 0
+        self.blocks_done = 0
+        self.comparisons = 0
+        self.pairs = 0
+        self.groups = []
+        self.started = None
+        self.finished = None
+
+    def export(self, filename):
+        """ Streams every vector into a flat float32 file, returns the image keys in row order. """
+        conn = sqlite3.connect(self.database.filename)  # Own connection, reads do not block the server's writes
+        try:
+            count = conn.execute("SELECT COUNT(*) FROM images").fetchone()[0]
+            keys = []
+            matrix = None
+            cursor = conn.execute("SELECT img_file, features FROM images")
+            while len(keys) < count:
+                rows = cursor.fetchmany(self.block_rows)
+                if not rows:
+                    break
+                vectors = np.vstack([np.frombuffer(feature_blob, dtype=np.float32) for _, feature_blob in rows])
+                if matrix is None:
+                    matrix = np.memmap(filename, dtype=np.float32, mode="w+", shape=(count, vectors.shape[1]))
+                matrix[len(keys):len(keys) + len(rows)] = vectors
+                keys.extend(img_file for img_file, _ in rows)
+        finally:
+            conn.close()
+        if matrix is None:
+            return keys, None
+        matrix.flush()
+        return keys, (len(keys), matrix.shape[1])
+
+    def tasks(self, rows):
+        bounds = list(range(0, rows, self.block_rows)) + [rows]
+        for i in range(len(bounds) - 1):
+            for j in range(i, len(bounds) - 1):
+                yield bounds[i], bounds[i + 1], bounds[j], bounds[j + 1], self.threshold
+
+    def run(self):
+        """ Runs the whole comparison in the calling thread and returns the report. """
+        self.status = "running"
+        self.started = time.time()
+        matrix_file = self.database.filename.with_suffix(".duplicates.f32")
+        try:
+            keys, shape = self.export(matrix_file)
+            self.images = len(keys)
+            groups = UnionFind(len(keys))
+            if shape is not None:
+                blocks = -(-shape[0] // self.block_rows)
+                self.blocks_total = blocks * (blocks + 1) // 2
+                self.compare(matrix_file, shape, groups)
+
+            if self.cancel_event.is_set():
+                self.status = "cancelled"
+                return self.to_dict()
+            members = {}
+            for row in range(len(keys)):
+                members.setdefault(groups.find(row), []).append(keys[row])
+            self.groups = sorted((sorted(images) for images in members.values() if len(images) > 1), key=len, reverse=True)
+            with open(self.output, "wb") as f:
+                f.write(orjson.dumps({"threshold": self.threshold, "images": self.images, "pairs": self.pairs,
+                                      "groups": self.groups}))
+            self.status = "completed"
+        except Exception as e:
+            print(f"Duplicate search failed: {e}")
+            self.status = "failed"
+            self.error = str(e)
+        finally:
+            matrix_file.unlink(missing_ok=True)
+            self.finished = time.time()
+        print(f"Duplicate search {self.status}: {len(self.groups)} groups from {self.pairs} close pairs in {self.images} images")
+        return self.to_dict()
+
+    def compare(self, matrix_file, shape, groups):
+        last_output = 0
+        with multiprocessing.Pool(self.workers, initializer=_init_worker, initargs=(str(matrix_file), shape)) as pool:
+            for comparisons, rows, cols in pool.imap_unordered(_compare_blocks, self.tasks(shape[0])):
+                for a, b in zip(rows.tolist(), cols.tolist()):
+                    groups.union(a, b)
+                self.pairs += len(rows)
+                self.comparisons += comparisons
+                self.blocks_done += 1
+                if self.cancel_event.is_set():
+                    pool.terminate()
+                    return
+                if self.verbose and time.monotonic() - last_output >= 5:
+                    last_output = time.monotonic()
+                    print(f"Compared {self.blocks_done} / {self.blocks_total} blocks | {self.pairs} close pairs")
+
+    def start(self):
+        """ Runs in a background thread, used by the /duplicates endpoint. """
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    @property
+    def running(self):
+        return self.status in ("queued", "running")
+
+    def to_dict(self, limit=0):
+        elapsed = (self.finished or time.time()) - self.started if self.started else 0.0
+        status = {
+            "status": self.status,
+            "threshold": self.threshold,
+            "images": self.images,
+            "blocks": self.blocks_done,
+            "total_blocks": self.blocks_total,
+            "progress": round(self.blocks_done / self.blocks_total, 4) if self.blocks_total else 0.0,
+            "comparisons_per_sec": round(self.comparisons / elapsed, 1) if elapsed else 0.0,
+            "pairs": self.pairs,
+            "groups": len(self.groups),
+            "output": str(self.output),
+            "error": self.error,
+        }
+        if limit:
+            status["largest_groups"] = self.groups[:limit]
+        return status
@@ -0,0 +1,93 @@
+import hashlib
+import os
+import threading
+import numpy as np
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+
+class FeatureCache:
+    """
+    Content addressed cache of extracted features, stored in the extractor's own SQLite database so duplicate,
+    renamed or moved images only cost a hash instead of a forward pass.
+
+    Modes:
+        content = hash of the whole file
+        header  = hash of the first and last 64KB plus the file size (much faster on large files, but two different
+                  images of the same size whose first and last 64KB match, such as uncompressed screenshots, share
+                  one cached vector)
+    """
+    block_size = 65536
+
+    def __init__(self, database, mode="content"):
+        self.database = database
+        self.mode = mode
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        with database.lock, database.conn:
+            database.conn.execute("""
+                CREATE TABLE IF NOT EXISTS feature_cache (
+                    hash VARCHAR(64) PRIMARY KEY,
+                    features BLOB
+                )
+            """)
+            self.entries = database.conn.execute("SELECT COUNT(*) FROM feature_cache").fetchone()[0]
+
+    def _hasher(self):
+        return xxhash.xxh3_128() if xxhash is not None else hashlib.blake2b(digest_size=16)
+
+    def hash_file(self, path):
+        """ Returns a digest of the file, prefixed with the mode so digests from different modes never mix. """
+        hasher = self._hasher()
+        with open(path, "rb") as f:
+            if self.mode == "content":
+                while chunk := f.read(1024 * 1024):
+                    hasher.update(chunk)
+            else:
+                size = os.fstat(f.fileno()).st_size
+                hasher.update(size.to_bytes(8, "little"))
+                hasher.update(f.read(self.block_size))
+                if size > 2 * self.block_size:
+                    f.seek(-self.block_size, os.SEEK_END)
+                    hasher.update(f.read(self.block_size))
+                elif size > self.block_size:
+                    hasher.update(f.read())
+        return f"{self.mode[0]}:{hasher.hexdigest()}"
+
+    def get(self, digest):
+        """ Returns the cached feature vector for a digest, or None. """
+        with self.database.lock:
+            row = self.database.conn.execute("SELECT features FROM feature_cache WHERE hash = ?", (digest, )).fetchone()
+        with self.lock:
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return np.frombuffer(row[0], dtype=np.float32)
+
+    def lookup(self, path):
+        """ Returns (digest, cached features or None) for an image file. """
+        try:
+            digest = self.hash_file(path)
+        except OSError:
+            return None, None
+        return digest, self.get(digest)
+
+    def put_many(self, items):
+        """ Stores a list of (digest, feature_vector) pairs. """
+        rows = [(digest, np.asarray(vector, dtype=np.float32).tobytes()) for digest, vector in items if digest is not None]
+        if not rows:
+            return
+        with self.database.lock, self.database.conn:
+            before = self.database.conn.total_changes
+            self.database.conn.executemany("INSERT OR IGNORE INTO feature_cache (hash, features) VALUES (?, ?)", rows)
+            self.entries += self.database.conn.total_changes - before
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"mode": self.mode, "entries": self.entries, "hits": self.hits, "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0}
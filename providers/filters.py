@@ -0,0 +1,203 @@
+import math
+import os
+import time
+from datetime import datetime
+
+from providers.index import ExactIndex
+
+# Plan thresholds, as the fraction of the indexed images matching the filter
+FILTER_FIRST_RATIO = 0.02  # At or below, the matching vectors are gathered and searched on their own
+SEARCH_FIRST_RATIO = 0.3  # At or above, the index is searched first and the results filtered
+SEARCH_FIRST_ATTEMPTS = 3
+
+
+def first(value):
+    return value[0] if isinstance(value, list) else value
+
+
+def values(value):
+    """ Query string values come as lists, JSON values as a string or list, comma separated strings are split. """
+    if value is None:
+        return []
+    items = value if isinstance(value, list) else [value]
+    return [part.strip() for item in items for part in str(item).split(",") if part.strip()]
+
+
+def parse_time(value):
+    """ Unix seconds or an ISO date / datetime, returned as nanoseconds to compare with the stored mtimes. """
+    value = str(value)
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            seconds = datetime.fromisoformat(value).timestamp()
+        except ValueError:
+            raise ValueError(f"Invalid time '{value}', use unix seconds or an ISO date such as 2024-01-31")
+    return int(seconds * 1_000_000_000)
+
+
+def parse_metadata(params):
+    """
+    Metadata given with /add: tags=a,b and metadata as a JSON object or repeated key:value strings.
+    Returns {key: [values]}, tags are stored under the key 'tag'.
+    """
+    metadata = {}
+    tags = values(params.get("tags"))
+    if tags:
+        metadata["tag"] = tags
+    extra = params.get("metadata")
+    if isinstance(extra, dict):
+        for key, value in extra.items():
+            metadata.setdefault(str(key), []).extend(str(v) for v in (value if isinstance(value, list) else [value]))
+    else:
+        for item in values(extra):
+            key, separator, value = item.partition(":")
+            if not separator or not key:
+                raise ValueError(f"Invalid metadata '{item}', use key:value")
+            metadata.setdefault(key, []).append(value)
+    return metadata
+
+
+class SearchFilter:
+    """
+    Conditions a search result has to meet, all of them must match:
+    folder (the image file is under this directory), after / before (file modification time),
+    tags and key:value metadata given when the image was added.
+    """
+    def __init__(self, folder=None, after=None, before=None, tags=(), metadata=()):
+        self.folder = os.path.join(os.path.abspath(folder), "") if folder else None
+        self.after = after
+        self.before = before
+        self.tags = tuple(sorted(set(tags)))
+        self.metadata = tuple(sorted(set(metadata)))
+        self.plan = None  # Set by search(), how the last search was run
+
+    @classmethod
+    def from_params(cls, params):
+        """ Reads the filter from the request parameters, None when there is nothing to filter on. """
+        folder = first(params.get("folder"))
+        after = first(params.get("after"))
+        before = first(params.get("before"))
+        tags = values(params.get("tag")) + values(params.get("tags"))
+        metadata = []
+        for key, items in parse_metadata({"metadata": params.get("meta")}).items():
+            metadata.extend((key, value) for value in items)
+        if not (folder or after or before or tags or metadata):
+            return None
+        return cls(folder, parse_time(after) if after else None, parse_time(before) if before else None, tags, metadata)
+
+    def key(self):
+        """ Identifies the filter in the search cache. """
+        return self.folder, self.after, self.before, self.tags, self.metadata
+
+    def sql(self):
+        """ A query selecting the img_file of every matching image, each condition uses an index. """
+        parts = []
+        args = []
+        if self.folder:
+            upper = self.folder[:-1] + chr(ord(self.folder[-1]) + 1)  # Every path starting with folder sorts below this
+            parts.append("SELECT img_file FROM files WHERE path > ? AND path < ?")
+            args += [self.folder, upper]
+        if self.after is not None:
+            parts.append("SELECT img_file FROM files WHERE mtime_ns >= ?")
+            args.append(self.after)
+        if self.before is not None:
+            parts.append("SELECT img_file FROM files WHERE mtime_ns < ?")
+            args.append(self.before)
+        for tag in self.tags:
+            parts.append("SELECT img_file FROM metadata WHERE key = 'tag' AND value = ?")
+            args.append(tag)
+        for key, value in self.metadata:
+            parts.append("SELECT img_file FROM metadata WHERE key = ? AND value = ?")
+            args += [key, value]
+        return " INTERSECT ".join(parts), args
+
+
+def _matching(database, search_filter, candidates=None):
+    """ The keys matching the filter, restricted to the candidates if given. """
+    sql, args = search_filter.sql()
+    if candidates is None:
+        with database.lock:
+            return {img_file for img_file, in database.conn.execute(sql, args) if img_file in database.keys}
+    candidates = list(candidates)
+    matching = set()
+    with database.lock:
+        for start in range(0, len(candidates), 500):
+            chunk = candidates[start:start + 500]
+            rows = database.conn.execute(f"SELECT img_file FROM ({sql}) WHERE img_file IN ({','.join('?' * len(chunk))})", args + chunk)
+            matching.update(img_file for img_file, in rows)
+    return matching
+
+
+def _gather(database, query_vectors, top_k, keys):
+    """ Exact search over just the matching images, their vectors are read from the index or SQLite. """
+    index = database.index
+    if isinstance(index, ExactIndex):
+        vectors = {key: index.get(key) for key in keys}
+    else:
+        vectors = database.fetch_vectors(keys)  # Approximate indexes only keep codes, shards hold theirs in other processes
+    vectors = {key: vector for key, vector in vectors.items() if vector is not None}
+    if not vectors:
+        return [[] for _ in query_vectors]
+    block = ExactIndex()
+    block.add_many(list(vectors), list(vectors.values()))
+    return block.search_many(query_vectors, top_k)
+
+
+def _search_first(database, query_vectors, top_k, search_filter, matching_count, selectivity):
+    """
+    Over-fetches from the unfiltered index and drops results which do not match, None if too few were left.
+    Even fetching every row can leave too few, an approximate index does not scan every vector.
+    """
+    total = len(database.index)
+    fetch = min(total, max(2 * top_k, math.ceil(1.5 * top_k / selectivity)))
+    wanted = min(top_k, matching_count)
+    for attempt in range(SEARCH_FIRST_ATTEMPTS):
+        rows = database.index.search_many(query_vectors, fetch)
+        matching = _matching(database, search_filter, {key for row in rows for key, _ in row})
+        results = [[(key, distance) for key, distance in row if key in matching][:top_k] for row in rows]
+        if all(len(row) >= wanted for row in results):
+            return results, fetch
+        if fetch >= total:
+            break
+        fetch = min(total, fetch * 4)
+    return None, fetch
+
+
+def search(database, query_vectors, top_k, search_filter):
+    """
+    Runs a filtered search, choosing the plan from how many images match:
+      filter-first (gather)  - few matches, search only their vectors
+      filter-first (bitmask) - an exact index skips rows outside the filter while scanning the matrix
+      search-first           - most images match, search the index and drop the rows which do not match
+    Returns one list of (key, distance) per query and sets search_filter.plan.
+    """
+    start = time.monotonic()
+    sql, args = search_filter.sql()
+    with database.lock:
+        matching_count = database.conn.execute(f"SELECT COUNT(*) FROM ({sql})", args).fetchone()[0]
+    total = len(database.index)
+    selectivity = min(1.0, matching_count / total) if total else 0.0
+    plan = {"matching": matching_count, "selectivity": round(selectivity, 6)}
+
+    if matching_count == 0 or total == 0:
+        plan["plan"] = "empty"
+        results = [[] for _ in query_vectors]
+    elif selectivity >= SEARCH_FIRST_RATIO or (selectivity > FILTER_FIRST_RATIO and not database.index.supports_allowed):
+        results, fetched = _search_first(database, query_vectors, top_k, search_filter, matching_count, selectivity)
+        plan.update(plan="search-first", fetched=fetched)
+        if results is None:
+            plan["fallback"] = "filter-first"
+            keys = _matching(database, search_filter)
+            results = (database.index.search_many(query_vectors, top_k, allowed=keys) if database.index.supports_allowed
+                       else _gather(database, query_vectors, top_k, keys))
+    elif selectivity <= FILTER_FIRST_RATIO:
+        plan["plan"] = "filter-first (gather)"
+        results = _gather(database, query_vectors, top_k, _matching(database, search_filter))
+    else:
+        plan["plan"] = "filter-first (bitmask)"
+        results = database.index.search_many(query_vectors, top_k, allowed=_matching(database, search_filter))
+
+    plan["ms"] = round(1000 * (time.monotonic() - start), 3)
+    search_filter.plan = plan
+    return results
@@ -0,0 +1,422 @@
+import threading
+import numpy as np
+
+
+class ExactIndex:
+    """
+    Exact euclidean index over contiguous matrices.  Searches use chunked matrix products with
+    |q - x|^2 = |q|^2 + |x|^2 - 2 q.x and a partial sort, vectors can optionally be stored as float16 to halve memory.
+
+    Rows live in read-only base blocks (for example memory-mapped segments from the VectorStore) followed by one
+    growable in-memory tail.  Base rows are deleted by setting their norm to infinity, tail rows by moving the
+    last row into their place.
+    """
+    supports_allowed = True  # search_many can be restricted to a set of keys
+
+    def __init__(self, dim=None, capacity=1024, dtype="float32", chunk_rows=16384):
+        self.dim = dim
+        self.capacity = capacity
+        self.dtype = np.dtype(dtype)
+        self.chunk_rows = chunk_rows
+        self.blocks = []  # Read-only base blocks: (first row, vectors, norms)
+        self.base_rows = 0
+        self.vectors = None  # Growable tail
+        self.norms = None  # Squared length of every tail row, kept in float32
+        self.keys = []  # Row number -> key (None for deleted base rows)
+        self.positions = {}  # Key -> row number
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __contains__(self, key):
+        return key in self.positions
+
+    def _tail_rows(self):
+        return len(self.keys) - self.base_rows
+
+    def _reserve(self, size):
+        if self.vectors is None:
+            self.vectors = np.empty((max(self.capacity, size), self.dim), dtype=self.dtype)
+            self.norms = np.empty(len(self.vectors), dtype=np.float32)
+        elif size > len(self.vectors):
+            used = self._tail_rows()
+            capacity = max(size, len(self.vectors) * 2)
+            vectors = np.empty((capacity, self.dim), dtype=self.dtype)
+            vectors[:used] = self.vectors[:used]
+            norms = np.empty(capacity, dtype=np.float32)
+            norms[:used] = self.norms[:used]
+            self.vectors, self.norms = vectors, norms
+
+    def attach(self, keys, vectors, norms=None, deleted=None):
+        """
+        Adds a read-only block of vectors (typically a memory-mapped array) without copying it.
+        Memory-mapped blocks keep the dtype of the file, arrays in memory are converted to the index dtype.
+        Must be called before any vectors are added to the tail.
+        """
+        with self.lock:
+            if self._tail_rows():
+                raise RuntimeError("Blocks can only be attached before vectors are added")
+            if self.dim is None:
+                self.dim = vectors.shape[1]
+            if not isinstance(vectors, np.memmap) and vectors.dtype != self.dtype:
+                vectors = vectors.astype(self.dtype)
+                norms = None  # Norms of the stored (possibly float16) values
+            if norms is None:
+                norms = np.einsum("ij,ij->i", vectors, vectors, dtype=np.float32)
+            norms = np.array(norms, dtype=np.float32)  # Writable copy, used to mark deleted rows
+            if deleted is not None:
+                norms[deleted] = np.inf
+
+            start = self.base_rows
+            self.blocks.append((start, vectors, norms))
+            self.base_rows += len(vectors)
+            for row, key in enumerate(keys, start):
+                if deleted is not None and deleted[row - start]:
+                    key = None
+                elif key in self.positions:
+                    self._delete_base_row(self.positions[key])
+                self.keys.append(key)
+                if key is not None:
+                    self.positions[key] = row
+
+    def _block(self, row):
+        for start, vectors, norms in reversed(self.blocks):
+            if row >= start:
+                return start, vectors, norms
+
+    def _delete_base_row(self, row):
+        start, _, norms = self._block(row)
+        norms[row - start] = np.inf
+        self.keys[row] = None
+
+    def add(self, key, vector):
+        self.add_many([key], [vector])
+
+    def add_many(self, keys, vectors):
+        """ Inserts or replaces vectors for the given keys. """
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if len(keys) == 0:
+            return
+        with self.lock:
+            if self.dim is None:
+                self.dim = vectors.shape[1]
+            self._reserve(self._tail_rows() + len(keys))
+            rows = np.empty(len(keys), dtype=np.int64)
+            for i, key in enumerate(keys):
+                row = self.positions.get(key)
+                if row is not None and row < self.base_rows:
+                    self._delete_base_row(row)  # Replaced base rows move to the tail
+                    row = None
+                if row is None:
+                    row = len(self.keys)
+                    self.keys.append(key)
+                    self.positions[key] = row
+                rows[i] = row - self.base_rows
+            self.vectors[rows] = vectors
+            stored = self.vectors[rows].astype(np.float32)  # Norms of the stored (possibly float16) values
+            self.norms[rows] = np.einsum("ij,ij->i", stored, stored)
+
+    def remove(self, key):
+        """ Removes a key, tail rows are removed by moving the last row into their place. """
+        with self.lock:
+            row = self.positions.pop(key, None)
+            if row is None:
+                return False
+            if row < self.base_rows:
+                self._delete_base_row(row)
+                return True
+            last = len(self.keys) - 1
+            if row != last:
+                moved = self.keys[last]
+                self.vectors[row - self.base_rows] = self.vectors[last - self.base_rows]
+                self.norms[row - self.base_rows] = self.norms[last - self.base_rows]
+                self.keys[row] = moved
+                self.positions[moved] = row
+            self.keys.pop()
+            return True
+
+    def get(self, key):
+        with self.lock:
+            row = self.positions.get(key)
+            if row is None:
+                return None
+            if row < self.base_rows:
+                start, vectors, _ = self._block(row)
+                return np.array(vectors[row - start], dtype=np.float32)
+            return self.vectors[row - self.base_rows].astype(np.float32)
+
+    def _chunks(self):
+        """ Yields (first row, vectors, norms) for every chunk of the base blocks and the tail. """
+        for start, vectors, norms in self.blocks:
+            for offset in range(0, len(vectors), self.chunk_rows):
+                yield start + offset, vectors[offset:offset + self.chunk_rows], norms[offset:offset + self.chunk_rows]
+        tail = self._tail_rows()
+        for offset in range(0, tail, self.chunk_rows):
+            end = min(offset + self.chunk_rows, tail)
+            yield self.base_rows + offset, self.vectors[offset:end], self.norms[offset:end]
+
+    def matrix(self):
+        """ Returns the live vectors as one array (a view when there are no base blocks). """
+        if not self.blocks:
+            return self.vectors[:len(self.keys)] if self.vectors is not None else np.empty((0, self.dim or 0), dtype=self.dtype)
+        parts = [vectors[np.isfinite(norms)] for _, vectors, norms in self.blocks]
+        if self._tail_rows():
+            parts.append(self.vectors[:self._tail_rows()])
+        return np.vstack(parts)
+
+    def live_keys(self):
+        """ Keys in the same order as the rows returned by matrix(). """
+        return [key for key in self.keys if key is not None]
+
+    def _mask(self, keys):
+        """ Bitmask over the rows, set for the given keys. """
+        mask = np.zeros(len(self.keys), dtype=bool)
+        mask[[self.positions[key] for key in keys if key in self.positions]] = True
+        return mask
+
+    def _search_matrix(self, queries, top_k, mask=None):
+        """
+        Top-k rows and distances for every query row, scanning the matrix chunk by chunk.
+        With a mask only its rows are searched, chunks without any of them are skipped.
+        """
+        top_k = min(top_k, len(self.positions))
+        query_norms = np.einsum("ij,ij->i", queries, queries)
+        best_ids = np.empty((len(queries), 0), dtype=np.int64)
+        best_dists = np.empty((len(queries), 0), dtype=np.float32)
+
+        for start, chunk, norms in self._chunks():
+            if mask is not None:
+                allowed = mask[start:start + len(chunk)]
+                if not allowed.any():
+                    continue
+                norms = np.where(allowed, norms, np.inf)  # Filtered out rows can never be in the top-k
+            if chunk.dtype != np.float32:
+                chunk = chunk.astype(np.float32)
+            dists = norms - 2 * (queries @ chunk.T)
+            if len(chunk) > top_k:
+                ids = np.argpartition(dists, top_k - 1, axis=1)[:, :top_k]
+            else:
+                ids = np.broadcast_to(np.arange(len(chunk)), dists.shape)
+            best_dists = np.hstack([best_dists, np.take_along_axis(dists, ids, axis=1)])
+            best_ids = np.hstack([best_ids, ids + start])
+            if best_ids.shape[1] > top_k:
+                keep = np.argpartition(best_dists, top_k - 1, axis=1)[:, :top_k]
+                best_dists = np.take_along_axis(best_dists, keep, axis=1)
+                best_ids = np.take_along_axis(best_ids, keep, axis=1)
+
+        order = np.argsort(best_dists, axis=1)
+        best_ids = np.take_along_axis(best_ids, order, axis=1)
+        best_dists = np.take_along_axis(best_dists, order, axis=1) + query_norms[:, None]
+        return best_ids, np.sqrt(np.maximum(best_dists, 0))
+
+    def search(self, query_vector, top_k=5):
+        """ Returns a list of (key, distance) sorted by distance. """
+        return self.search_many([query_vector], top_k)[0]
+
+    def search_many(self, query_vectors, top_k=5, allowed=None):
+        """
+        Searches several query vectors with one matrix product per chunk, returns one result list per query.
+        allowed restricts the search to a collection of keys.
+        """
+        with self.lock:
+            queries = np.asarray(query_vectors, dtype=np.float32).reshape(len(query_vectors), -1)
+            if not self.positions or top_k <= 0:
+                return [[] for _ in range(len(queries))]
+            ids, dists = self._search_matrix(queries, top_k, self._mask(allowed) if allowed is not None else None)
+            return [[(self.keys[i], float(d)) for i, d in zip(row_ids, row_dists) if np.isfinite(d)]
+                    for row_ids, row_dists in zip(ids, dists)]
+
+    def memory(self):
+        """ Bytes of vectors held in RAM (memory-mapped blocks are counted separately). """
+        total = 0 if self.vectors is None else self.vectors.nbytes + self.norms.nbytes
+        for _, vectors, norms in self.blocks:
+            total += norms.nbytes + (0 if isinstance(vectors, np.memmap) else vectors.nbytes)
+        return total
+
+    def mapped(self):
+        """ Bytes of vectors read from memory-mapped files. """
+        return sum(vectors.nbytes for _, vectors, _ in self.blocks if isinstance(vectors, np.memmap))
+
+    def mapped_dtype(self):
+        """ dtype of the memory-mapped blocks, which stay as stored in the file whatever the index dtype. """
+        return ",".join(sorted({vectors.dtype.name for _, vectors, _ in self.blocks if isinstance(vectors, np.memmap)})) or None
+
+    def stats(self):
+        return {"type": "exact", "vectors": len(self), "dtype": self.dtype.name, "memory_bytes": self.memory(),
+                "mapped_bytes": self.mapped(), "mapped_dtype": self.mapped_dtype()}
+
+
+def kmeans(data, k, iterations=10, seed=0):
+    """ Plain Lloyd's k-means returning the centroids. """
+    rng = np.random.default_rng(seed)
+    centroids = data[rng.choice(len(data), size=k, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = nearest_centroids(data, centroids)
+        counts = np.bincount(assignment, minlength=k)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, data)
+        filled = counts > 0
+        centroids[filled] = sums[filled] / counts[filled, None]
+        empty = np.flatnonzero(~filled)
+        centroids[empty] = data[rng.integers(len(data), size=len(empty))]  # Re-seed empty clusters
+    return centroids
+
+
+def nearest_centroids(data, centroids, count=1):
+    """ Ids of the closest centroid(s) for every row of data. """
+    # |x - c|^2 = |x|^2 - 2 x.c + |c|^2, the |x|^2 term does not change the ordering
+    dists = (centroids ** 2).sum(axis=1) - 2 * data @ centroids.T
+    if count == 1:
+        return np.argmin(dists, axis=1)
+    count = min(count, len(centroids))
+    ids = np.argpartition(dists, count - 1, axis=1)[:, :count]
+    order = np.take_along_axis(dists, ids, axis=1).argsort(axis=1)
+    return np.take_along_axis(ids, order, axis=1)
+
+
+class IvfIndex:
+    """
+    Approximate inverted file index.  Vectors are bucketed by their nearest k-means centroid and a query only
+    scans the `nprobe` closest buckets.  Until enough vectors have been added to train the centroids the index
+    behaves like an ExactIndex.
+    """
+    supports_allowed = False
+
+    def __init__(self, nlist=0, nprobe=8, train_size=None, dtype="float32"):
+        self.nlist = nlist
+        self.dtype = dtype
+        self.nprobe = nprobe
+        self.train_size = train_size
+        self.centroids = None
+        self.lists = []
+        self.assignment = {}  # Key -> list number
+        self.pending = ExactIndex(dtype=dtype)  # Vectors added before the centroids are trained
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.assignment) + len(self.pending)
+
+    def __contains__(self, key):
+        return key in self.assignment or key in self.pending
+
+    def _lists_for(self, count):
+        return self.nlist or max(1, int(4 * np.sqrt(count)))
+
+    def _train_threshold(self):
+        if self.train_size:
+            return self.train_size
+        return 39 * self.nlist if self.nlist else 10000
+
+    @property
+    def trained(self):
+        return self.centroids is not None
+
+    def train(self, sample=None, count=None):
+        """
+        Trains the centroids from a sample (or the pending vectors) and moves pending vectors into the inverted lists.
+        count is the expected collection size, used to pick the number of lists.
+        """
+        with self.lock:
+            data = self.pending.matrix().astype(np.float32) if sample is None else np.asarray(sample, dtype=np.float32)
+            if len(data) == 0:
+                return
+            nlist = min(self._lists_for(count or len(data)), len(data))
+            sample = data
+            if len(sample) > nlist * 256:
+                sample = sample[np.random.default_rng(0).choice(len(sample), size=nlist * 256, replace=False)]
+            self.centroids = kmeans(sample, nlist)
+            self.lists = [ExactIndex(dim=data.shape[1], capacity=16, dtype=self.dtype) for _ in range(nlist)]
+
+            pending = self.pending
+            self.pending = ExactIndex(dtype=self.dtype)
+            if len(pending):
+                self._assign(pending.live_keys(), pending.matrix().astype(np.float32))
+
+    def _assign(self, keys, vectors):
+        list_ids = nearest_centroids(vectors, self.centroids)
+        for key, list_id in zip(keys, list_ids):
+            previous = self.assignment.get(key)
+            if previous is not None and previous != list_id:
+                self.lists[previous].remove(key)
+            self.assignment[key] = int(list_id)
+        for list_id in np.unique(list_ids):
+            members = np.flatnonzero(list_ids == list_id)
+            self.lists[list_id].add_many([keys[i] for i in members], vectors[members])
+
+    def attach(self, keys, vectors, norms=None, deleted=None):
+        """ The inverted lists own their vectors, so attached blocks are copied in. """
+        if deleted is not None:
+            live = np.flatnonzero(~deleted)
+            keys = [keys[i] for i in live]
+            vectors = vectors[live]
+        self.add_many(keys, vectors)
+
+    def add(self, key, vector):
+        self.add_many([key], [vector])
+
+    def add_many(self, keys, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if len(keys) == 0:
+            return
+        with self.lock:
+            if self.centroids is None:
+                self.pending.add_many(keys, vectors)
+                if len(self.pending) >= self._train_threshold():
+                    self.train()
+            else:
+                self._assign(list(keys), vectors)
+
+    def remove(self, key):
+        with self.lock:
+            if self.pending.remove(key):
+                return True
+            list_id = self.assignment.pop(key, None)
+            if list_id is None:
+                return False
+            return self.lists[list_id].remove(key)
+
+    def get(self, key):
+        with self.lock:
+            if key in self.pending:
+                return self.pending.get(key)
+            list_id = self.assignment.get(key)
+            return None if list_id is None else self.lists[list_id].get(key)
+
+    def search(self, query_vector, top_k=5):
+        with self.lock:
+            query_vector = np.asarray(query_vector, dtype=np.float32)
+            results = self.pending.search(query_vector, top_k)
+            if self.centroids is not None:
+                for list_id in np.ravel(nearest_centroids(query_vector[None, :], self.centroids, self.nprobe)):  # 1-D when nprobe is 1
+                    results.extend(self.lists[list_id].search(query_vector, top_k))
+            results.sort(key=lambda r: r[1])
+            return results[:top_k]
+
+    def search_many(self, query_vectors, top_k=5):
+        """ Each query probes its own buckets so they are searched one at a time. """
+        return [self.search(query_vector, top_k) for query_vector in query_vectors]
+
+    def stats(self):
+        return {"type": "ivf", "vectors": len(self), "lists": len(self.lists), "nprobe": self.nprobe,
+                "trained": self.centroids is not None, "dtype": np.dtype(self.dtype).name, "memory_bytes": self.memory()}
+
+    def memory(self):
+        return self.pending.memory() + sum(index.memory() for index in self.lists)
+
+
+def create_index(kind="exact", **options):
+    """ Builds the index backend selected on the command line. """
+    dtype = options.get("dtype", "float32")
+    if kind == "exact":
+        if options.get("shards", 1) > 1:
+            from providers.sharded_index import ShardedIndex
+            return ShardedIndex(shards=options["shards"], dtype=dtype)
+        return ExactIndex(dtype=dtype)
+    if kind == "ivf":
+        return IvfIndex(nlist=options.get("nlist", 0), nprobe=options.get("nprobe", 8), dtype=dtype)
+    if kind in ("pq", "sq8"):
+        from providers.quantizer import QuantizedIndex  # Imported here as the quantizer module builds on this one
+        return QuantizedIndex(kind, subvectors=options.get("subvectors", 96), train_size=options.get("train_size", 20000),
+                              rerank=options.get("rerank", 0))
+    raise ValueError(f"Unknown index type: {kind}")
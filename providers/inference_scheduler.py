@@ -0,0 +1,164 @@
+import itertools
+import threading
+import time
+from concurrent.futures import Future
+from queue import PriorityQueue, Empty
+
+import numpy as np
+
+from providers.metrics import stage
+
+SEARCH_PRIORITY = 0
+INGEST_PRIORITY = 1
+
+
+class Histogram:
+    """ Counts values in power of two buckets: 0, 1, 2-3, 4-7, ... keyed by the bucket's upper bound. """
+    def __init__(self, largest):
+        self.bounds = [0] + [2 ** i for i in range(int(np.ceil(np.log2(max(largest, 1)))) + 1)]
+        self.counts = [0] * (len(self.bounds) + 1)
+
+    def record(self, value):
+        for i, bound in enumerate(self.bounds):
+            if value <= bound:
+                self.counts[i] += 1
+                return
+        self.counts[-1] += 1
+
+    def to_dict(self):
+        buckets = {f"<={bound}": count for bound, count in zip(self.bounds, self.counts)}
+        buckets[f">{self.bounds[-1]}"] = self.counts[-1]
+        return buckets
+
+
+class InferenceScheduler:
+    """
+    Single owner of the model.  Request threads and ingest pipelines submit preprocessed tensors and get futures
+    back, a worker thread runs everything that arrives within `batch_wait` seconds as one forward pass.
+    Searches are queued ahead of ingest so a large /add does not delay them.
+
+    It has the same extract / extract_batch / infer_batch methods as the extractors, so it can be used in their place.
+    """
+    def __init__(self, feature_extractor, batch_size=32, batch_wait=0.005):
+        self.feature_extractor = feature_extractor
+        self.preprocess = feature_extractor.preprocess
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.queue = PriorityQueue()
+        self.sequence = itertools.count()  # Keeps FIFO order within a priority
+        self.lock = threading.Lock()
+        self.batches = 0
+        self.items = 0
+        self.errors = 0
+        self.queued_sec = 0.0
+        self.busy_sec = 0.0
+        self.max_queued_sec = 0.0
+        self.batch_sizes = Histogram(batch_size)
+        self.queue_depths = Histogram(1024)
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+    @property
+    def loaded(self):
+        return getattr(self.feature_extractor, "loaded", True)
+
+    def load(self):
+        """ Loads a lazy extractor now instead of on the first request. """
+        if hasattr(self.feature_extractor, "load"):
+            self.feature_extractor.load()
+
+    def submit(self, tensor, priority=SEARCH_PRIORITY):
+        """ Queues one preprocessed tensor, the future resolves to its feature vector. """
+        future = Future()
+        self.queue.put((priority, next(self.sequence), tensor, future, time.monotonic()))
+        return future
+
+    def extract(self, image_path):
+        return self.extract_batch([image_path])[0]
+
+    def extract_batch(self, image_paths, priority=SEARCH_PRIORITY):
+        """ Preprocesses in the calling thread and waits for the features, None for images that could not be read. """
+        tensors = [self.preprocess(image_path) for image_path in image_paths]
+        futures = [self.submit(tensor, priority) if tensor is not None else None for tensor in tensors]
+        with stage("inference", histogram=False):  # The forward pass itself is timed on the scheduler thread
+            return [future.result() if future is not None else None for future in futures]
+
+    def infer_batch(self, batch, priority=INGEST_PRIORITY):
+        """ Used by the ingest pipeline, its rows may be run together with other requests. """
+        futures = [self.submit(tensor, priority) for tensor in batch]
+        return np.stack([future.result() for future in futures])
+
+    def _collect(self):
+        """ Takes up to batch_size items, waiting at most batch_wait seconds after the first one. """
+        item = self.queue.get()
+        if item[2] is None:
+            return None
+        depth = self.queue.qsize()
+
+        batch = [item]
+        deadline = time.monotonic() + self.batch_wait
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                item = self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait()
+            except Empty:
+                break
+            if item[2] is None:
+                self.queue.put(item)  # Leave the sentinel for the next get
+                break
+            batch.append(item)
+
+        with self.lock:
+            self.queue_depths.record(depth)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            if batch is None:
+                break
+
+            start = time.monotonic()
+            try:
+                features = self.feature_extractor.infer_batch(np.stack([tensor for _, _, tensor, _, _ in batch]))
+            except Exception as e:
+                print(f"Inference failed for a batch of {len(batch)} images: {e}")
+                with self.lock:
+                    self.errors += len(batch)
+                for _, _, _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+            finished = time.monotonic()
+
+            with self.lock:
+                self.batches += 1
+                self.items += len(batch)
+                self.busy_sec += finished - start
+                for _, _, _, _, submitted in batch:
+                    self.queued_sec += start - submitted
+                    self.max_queued_sec = max(self.max_queued_sec, start - submitted)
+                self.batch_sizes.record(len(batch))
+
+            for (_, _, _, future, _), feature in zip(batch, features):
+                future.set_result(feature)
+
+    def close(self):
+        self.queue.put((INGEST_PRIORITY + 1, next(self.sequence), None, None, None))
+        self.worker.join()
+
+    def stats(self):
+        with self.lock:
+            items = max(self.items, 1)
+            batches = max(self.batches, 1)
+            return {
+                "batches": self.batches,
+                "images": self.items,
+                "errors": self.errors,
+                "queued": self.queue.qsize(),
+                "avg_batch_size": round(self.items / batches, 2),
+                "avg_queue_ms": round(1000 * self.queued_sec / items, 3),
+                "max_queue_ms": round(1000 * self.max_queued_sec, 3),
+                "avg_inference_ms": round(1000 * self.busy_sec / batches, 3),
+                "batch_sizes": self.batch_sizes.to_dict(),
+                "queue_depths": self.queue_depths.to_dict(),
+            }
@@ -0,0 +1,316 @@
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from queue import Queue, Empty
+
+import cv2
+import numpy as np
+
+from providers.descriptor_store import compute_descriptors
+from providers.metrics import collect_stages, images_failed_total, observe_stages, stage
+
+
+def decode_image(path, preprocess, descriptor_kinds=None, max_features=0):
+    """
+    Runs in a decode worker process: reads the file once and returns (tensor, comparator descriptors, stage timings).
+    The timings are recorded by the parent, the worker's own metrics are never scraped.
+    """
+    with collect_stages() as timings:
+        with stage("decode"):
+            img = cv2.imread(path)
+        if img is None:
+            return None, None, timings
+
+        descriptors = compute_descriptors(img, descriptor_kinds, max_features) if descriptor_kinds else None
+        return preprocess(img), descriptors, timings
+
+
+def decode_descriptors(path, descriptor_kinds, max_features=0):
+    """ Runs in a decode worker process for images whose features came from the cache, only the descriptors are needed. """
+    with collect_stages() as timings:
+        with stage("decode"):
+            img = cv2.imread(path)
+        if img is None:
+            return None, timings
+        return compute_descriptors(img, descriptor_kinds, max_features), timings
+
+
+class StageStats:
+    def __init__(self, name, workers):
+        self.name = name
+        self.workers = workers
+        self.items = 0
+        self.failed = 0
+        self.busy = 0.0
+        self.lock = threading.Lock()
+
+    def record(self, items, busy, failed=0):
+        with self.lock:
+            self.items += items
+            self.failed += failed
+            self.busy += busy
+
+    def to_dict(self):
+        return {"workers": self.workers, "items": self.items, "failed": self.failed, "busy_sec": round(self.busy, 3)}
+
+
+class MeteredQueue(Queue):
+    """ Bounded queue which remembers the deepest it has been. """
+    def __init__(self, maxsize):
+        super().__init__(maxsize)
+        self.max_depth = 0
+
+    def _put(self, item):
+        super()._put(item)
+        self.max_depth = max(self.max_depth, len(self.queue))
+
+    def to_dict(self):
+        return {"depth": self.qsize(), "max_depth": self.max_depth, "capacity": self.maxsize}
+
+
+class IngestPipeline:
+    """
+    Staged ingest: decode / resize / normalize in a process pool -> bounded queue -> batched inference
+    -> bounded queue -> batched database writer.  Each stage runs concurrently so decoding overlaps model compute.
+    """
+    def __init__(self, feature_extractor, database, decode_workers=2, inference_workers=1, batch_size=16,
+                 batch_wait=0.05, write_batch=256, queue_depth=64, shutdown_event=None, verbose=0, feature_cache=None,
+                 descriptor_store=None):
+        self.feature_extractor = feature_extractor
+        self.database = database
+        self.feature_cache = feature_cache
+        self.descriptor_store = descriptor_store
+        self.decode_workers = max(1, decode_workers)
+        self.inference_workers = max(1, inference_workers)
+        self.batch_size = max(1, batch_size)
+        self.batch_wait = batch_wait
+        self.write_batch = max(1, write_batch)
+        self.queue_depth = max(1, queue_depth)
+        self.shutdown_event = shutdown_event or threading.Event()
+        self.verbose = verbose
+
+        self.tensor_queue = MeteredQueue(self.queue_depth)
+        self.write_queue = MeteredQueue(self.queue_depth)
+        self.stats = {
+            "decode": StageStats("decode", self.decode_workers),
+            "inference": StageStats("inference", self.inference_workers),
+            "write": StageStats("write", 1),
+        }
+        self.max_files = None
+        self.on_failed = None
+        self.written = 0
+        self.written_lock = threading.Lock()  # The database writer thread takes back rows it could not commit
+        self.cached = 0
+        self.start_time = None
+        self.threads = []
+
+    @classmethod
+    def from_args(cls, program_args, feature_extractor, database, shutdown_event):
+        """ A pipeline configured from the command line, used by /add and the ingest jobs. """
+        return cls(feature_extractor, database,
+                   decode_workers=program_args.threads,
+                   inference_workers=program_args.inference_threads,
+                   batch_size=program_args.batch_size,
+                   batch_wait=program_args.batch_wait,
+                   write_batch=program_args.write_batch,
+                   queue_depth=program_args.queue_depth,
+                   shutdown_event=shutdown_event,
+                   verbose=program_args.verbose,
+                   feature_cache=database.feature_cache,
+                   descriptor_store=database.descriptor_store)
+
+    def run(self, paths, max_files=None, on_written=None, on_failed=None):
+        """
+        Runs every path through the pipeline and blocks until the last row is written.
+        on_written is called with each list of paths handed to the database, on_failed with each path that could not be
+        read, extracted or, later, committed by the database writer.
+        """
+        self.max_files = max_files
+        self.on_failed = on_failed
+        self.start_time = time.monotonic()
+
+        self.threads = [threading.Thread(target=self._inference_stage, daemon=True) for _ in range(self.inference_workers)]
+        writer = threading.Thread(target=self._write_stage, args=(on_written,), daemon=True)
+        for t in self.threads:
+            t.start()
+        writer.start()
+
+        try:
+            self._decode_stage(paths)
+        finally:
+            for _ in self.threads:
+                self.tensor_queue.put(None)
+            for t in self.threads:
+                t.join()
+            self.write_queue.put(None)
+            writer.join()
+            self.database.flush()  # Wait for the database writer to commit everything submitted
+
+        return self.written
+
+    def _limit_reached(self):
+        return self.max_files is not None and self.written >= self.max_files
+
+    def _decode_stage(self, paths):
+        """ Submits paths to the process pool, keeping at most queue_depth decodes in flight. """
+        preprocess = self.feature_extractor.preprocess
+        kinds = self.descriptor_store.kinds if self.descriptor_store is not None else None
+        max_features = self.descriptor_store.max_features if self.descriptor_store is not None else 0
+        pending = deque()
+        with ProcessPoolExecutor(max_workers=self.decode_workers) as executor:
+            for path in paths:
+                if self.shutdown_event.is_set() or self._limit_reached():
+                    break
+
+                digest, feature = None, None
+                if self.feature_cache is not None:
+                    digest, feature = self.feature_cache.lookup(path)
+                if feature is not None:  # Same bytes already extracted, skip decode and inference
+                    self.cached += 1
+                    missing = self.descriptor_store.missing(os.path.basename(path)) if self.descriptor_store is not None else None
+                    if not missing:
+                        self.write_queue.put((path, feature, None, None))
+                        continue
+                    # A copy under a new name still needs its comparator descriptors, decode it for those only
+                    future = executor.submit(decode_descriptors, str(path), missing, max_features)
+                else:
+                    future = executor.submit(decode_image, str(path), preprocess, kinds, max_features)
+
+                pending.append((path, digest, feature, time.monotonic(), future))
+                if len(pending) >= self.queue_depth:
+                    self._forward_decoded(*pending.popleft())
+
+            while pending:
+                path, digest, feature, submitted, future = pending.popleft()
+                if self.shutdown_event.is_set():
+                    future.cancel()
+                    continue
+                self._forward_decoded(path, digest, feature, submitted, future)
+
+    def _forward_decoded(self, path, digest, feature, submitted, future):
+        if feature is not None:  # Features came from the cache, only the descriptors were computed
+            try:
+                descriptors, timings = future.result()
+                observe_stages(timings)
+            except Exception as e:
+                print(f"Failed to compute descriptors for {path}: {e}")
+                descriptors = None
+            self.write_queue.put((path, feature, None, descriptors))
+            return
+
+        try:
+            tensor, descriptors, timings = future.result()
+            observe_stages(timings)
+        except Exception as e:
+            print(f"Failed to decode {path}: {e}")
+            tensor, descriptors = None, None
+
+        failed = int(tensor is None)
+        self.stats["decode"].record(1 - failed, time.monotonic() - submitted, failed=failed)
+        if failed:
+            images_failed_total.inc()
+            if self.on_failed:
+                self.on_failed(path)
+        if tensor is not None:
+            self.tensor_queue.put((path, digest, tensor, descriptors))
+
+    def _collect(self, queue, size, wait):
+        """ Collects up to size items from queue, waiting at most wait seconds after the first one. """
+        item = queue.get()
+        if item is None:
+            return None
+
+        batch = [item]
+        deadline = time.monotonic() + wait
+        while len(batch) < size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = queue.get(timeout=remaining)
+            except Empty:
+                break
+            if item is None:
+                queue.put(None)  # Leave the sentinel for the next get
+                break
+            batch.append(item)
+        return batch
+
+    def _inference_stage(self):
+        while True:
+            batch = self._collect(self.tensor_queue, self.batch_size, self.batch_wait)
+            if batch is None:
+                break
+            if self.shutdown_event.is_set():
+                continue
+
+            start = time.monotonic()
+            try:
+                features = self.feature_extractor.infer_batch(np.stack([tensor for _, _, tensor, _ in batch]))
+            except Exception as e:
+                print(f"Inference failed for a batch of {len(batch)} images: {e}")
+                self.stats["inference"].record(0, time.monotonic() - start, failed=len(batch))
+                images_failed_total.inc(len(batch))
+                if self.on_failed:
+                    for path, _, _, _ in batch:
+                        self.on_failed(path)
+                continue
+            self.stats["inference"].record(len(batch), time.monotonic() - start)
+
+            for (path, digest, _, descriptors), feature in zip(batch, features):
+                self.write_queue.put((path, feature, digest, descriptors))
+
+    def _write_stage(self, on_written):
+        while True:
+            batch = self._collect(self.write_queue, self.write_batch, self.batch_wait)
+            if batch is None:
+                break
+
+            if self.max_files is not None:
+                batch = batch[:max(0, self.max_files - self.written)]
+            if not batch:
+                continue
+
+            start = time.monotonic()
+            self.database.submit_many([(feature, path) for path, feature, _, _ in batch], on_failed=self._write_failed)
+            if self.feature_cache is not None:
+                self.feature_cache.put_many([(digest, feature) for _, feature, digest, _ in batch])
+            if self.descriptor_store is not None:
+                self.descriptor_store.put_many([(os.path.basename(path), descriptors)
+                                                for path, _, _, descriptors in batch if descriptors])
+            self.stats["write"].record(len(batch), time.monotonic() - start)
+            with self.written_lock:
+                self.written += len(batch)
+
+            if on_written:
+                on_written([path for path, _, _, _ in batch])
+
+    def _write_failed(self, path):
+        """ Called by the database writer for a row handed to it which could not be committed. """
+        with self.written_lock:
+            self.written -= 1
+        images_failed_total.inc()
+        if self.on_failed:
+            self.on_failed(path)
+
+    def rate(self):
+        """ Images per second written since the pipeline started. """
+        if self.start_time is None:
+            return 0.0
+        elapsed = time.monotonic() - self.start_time
+        return self.written / elapsed if elapsed > 0 else 0.0
+
+    def metrics(self):
+        metrics = {
+            "images_per_sec": round(self.rate(), 2),
+            "cached": self.cached,
+            "stages": {name: stats.to_dict() for name, stats in self.stats.items()},
+            "queues": {"tensors": self.tensor_queue.to_dict(), "writes": self.write_queue.to_dict()},
+        }
+        if self.database.writer is not None:
+            metrics["database_writer"] = self.database.writer.stats()
+        if self.feature_cache is not None:
+            metrics["feature_cache"] = self.feature_cache.stats()
+        return metrics
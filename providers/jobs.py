@@ -0,0 +1,335 @@
+import os
+import threading
+import time
+import uuid
+from queue import Queue
+
+import orjson
+
+from helpers.file_scanner import scan_images
+from providers.ingest_pipeline import IngestPipeline
+
+
+class Checkpoint:
+    """ Tracks the first line of the job's file list which is not finished yet, so a restart can resume there. """
+    def __init__(self, line=0, offset=0):
+        self.line = line
+        self.offset = offset
+        self.started = {}  # Line -> byte offset just after it
+        self.finished = set()
+        self.lock = threading.Lock()
+
+    def start(self, line, end_offset):
+        with self.lock:
+            self.started[line] = end_offset
+
+    def finish(self, line):
+        with self.lock:
+            self.finished.add(line)
+            while self.line in self.finished:
+                self.finished.remove(self.line)
+                self.offset = self.started.pop(self.line)
+                self.line += 1
+
+    def position(self):
+        with self.lock:
+            return self.line, self.offset
+
+
+class StopSignal:
+    """ Looks like a threading.Event to the pipeline, set when either the job is cancelled or the server stops. """
+    def __init__(self, *events):
+        self.events = events
+
+    def is_set(self):
+        return any(event.is_set() for event in self.events)
+
+
+class IngestJob:
+    checkpoint_interval = 5.0
+
+    def __init__(self, manager, row):
+        self.manager = manager
+        self.id = row["id"]
+        self.path = row["path"]
+        self.options = row["options"]
+        self.status = row["status"]
+        self.total = row["total"]
+        self.processed = row["processed"]
+        self.skipped = row["skipped"]
+        self.failed = row["failed"]
+        self.removed = row["removed"]
+        self.error = row["error"]
+        self.created = row["created"]
+        self.finished_at = row["finished"]
+        self.checkpoint = Checkpoint(row["position"], row["offset"])
+        self.cancel_event = threading.Event()
+        self.done = threading.Event()
+        self.lines = {}  # Path -> line number for images in the pipeline
+        self.lock = threading.Lock()
+        self.run_started = None
+        self.run_done = 0
+        self.last_checkpoint = time.monotonic()
+        self.pipeline = None
+        self.uncommitted = False  # An image was handed to the database writer but not committed
+
+    @property
+    def list_file(self):
+        return self.manager.directory / f"{self.id}.list"
+
+    @property
+    def sync(self):
+        return self.options.get("mode") == "sync"
+
+    def list_images(self):
+        """
+        Writes the image paths to the job's list file once, so a resumed job never lists the directory again.
+        A sync job only lists files which are new or changed since they were added.
+        """
+        self.manager.update(self, status="listing")
+        tmp = self.list_file.with_suffix(".tmp")
+        total = 0
+        with open(tmp, "wb") as f:
+            for entry in scan_images(self.path, recursive=self.options.get("recursive", True)):
+                if self.cancel_event.is_set() or self.manager.shutdown_event.is_set():
+                    return False
+                if self.sync and not self.manager.database.file_changed(entry.path, entry.stat()):
+                    self.skipped += 1
+                    continue
+                f.write(os.fsencode(os.path.abspath(entry.path)) + b"\n")
+                total += 1
+        os.replace(tmp, self.list_file)
+        self.total = total
+        return True
+
+    def read_list(self, f, line):
+        """ Yields paths from the list file, skipping images which already exist. """
+        allow_update = self.options.get("update", False) or self.sync
+        offset = f.tell()
+        for raw in f:
+            offset += len(raw)
+            path = os.fsdecode(raw.rstrip(b"\n"))
+            self.checkpoint.start(line, offset)
+
+            if not allow_update and self.manager.database.exists(os.path.basename(path)):
+                with self.lock:
+                    self.skipped += 1
+                    self.run_done += 1
+                self.checkpoint.finish(line)
+            else:
+                with self.lock:
+                    self.lines[path] = line
+                yield path
+            line += 1
+
+    def _finished(self, paths, counter):
+        with self.lock:
+            for path in paths:
+                line = self.lines.pop(str(path), None)
+                if line is not None:
+                    self.checkpoint.finish(line)
+            setattr(self, counter, getattr(self, counter) + len(paths))
+            self.run_done += len(paths)
+
+        if time.monotonic() - self.last_checkpoint > self.checkpoint_interval:
+            self.save_checkpoint()
+
+    def on_written(self, paths):
+        if self.options.get("metadata"):
+            self.manager.database.set_metadata(paths, self.options["metadata"])
+        self._finished(paths, "processed")
+
+    def on_failed(self, path):
+        with self.lock:
+            written = str(path) not in self.lines
+            if written:  # Already counted as processed, the database writer could not commit it
+                self.processed -= 1
+                self.failed += 1
+                self.uncommitted = True
+        if not written:
+            self._finished([path], "failed")
+
+    def save_checkpoint(self):
+        """
+        Only positions whose rows are committed are saved, so the position is read before flushing.  Once a row
+        failed to commit the checkpoint stays where it was, so a resumed job goes over that image again.
+        """
+        self.last_checkpoint = time.monotonic()
+        line, offset = self.checkpoint.position()
+        self.manager.database.flush()  # Rows which fail to commit are reported to on_failed before this returns
+        if not self.uncommitted:
+            self.manager.update(self, position=line, offset=offset)
+        else:
+            print(f"Job {self.id}: some images could not be written to the database, the checkpoint was not moved")
+            self.manager.update(self)
+
+    def run(self):
+        self.run_started = time.monotonic()
+        self.run_done = 0
+        try:
+            if not self.list_file.exists() and not self.list_images():
+                self.skipped = 0  # Listing starts again with the counters
+                if self.cancel_event.is_set():
+                    self.manager.update(self, status="cancelled", finished=time.time())
+                return
+            self.manager.update(self, status="running", total=self.total)
+
+            self.pipeline = self.manager.create_pipeline(StopSignal(self.cancel_event, self.manager.shutdown_event))
+            line, offset = self.checkpoint.position()
+            with open(self.list_file, "rb") as f:
+                f.seek(offset)
+                limit = self.options.get("limit")
+                self.pipeline.run(self.read_list(f, line), max_files=limit - self.processed if limit else None,
+                                  on_written=self.on_written, on_failed=self.on_failed)
+
+            self.save_checkpoint()
+            if self.manager.shutdown_event.is_set():
+                return  # Left as running so it resumes on the next start
+            if self.sync and not self.cancel_event.is_set() and not self.options.get("limit"):
+                self.manager.update(self, status="pruning")
+                self.removed = self.manager.database.prune_files(self.path)
+            status = "cancelled" if self.cancel_event.is_set() else "completed"
+            self.manager.update(self, status=status, finished=time.time())
+            self.list_file.unlink(missing_ok=True)
+            print(f"Job {self.id} {status}: Completed {self.processed} | Skipped {self.skipped} | Failed {self.failed} | Removed {self.removed}")
+        except Exception as e:
+            print(f"Job {self.id} failed: {e}")
+            self.manager.update(self, status="failed", error=str(e), finished=time.time())
+        finally:
+            self.done.set()
+
+    def cancel(self):
+        self.cancel_event.set()
+        if self.status == "queued":
+            self.manager.update(self, status="cancelled", finished=time.time())
+            self.done.set()
+
+    def rate(self):
+        if self.run_started is None:
+            return 0.0
+        elapsed = time.monotonic() - self.run_started
+        return self.run_done / elapsed if elapsed > 0 else 0.0
+
+    def to_dict(self):
+        rate = self.rate()
+        line, _ = self.checkpoint.position()
+        remaining = max(0, (self.total or 0) - line) if self.total is not None else None
+        data = {
+            "id": self.id,
+            "path": self.path,
+            "status": self.status,
+            "total": self.total,
+            "processed": self.processed,
+            "skipped": self.skipped,
+            "failed": self.failed,
+            "removed": self.removed,
+            "position": line,
+            "images_per_sec": round(rate, 2),
+            "eta_sec": round(remaining / rate, 1) if rate > 0 and remaining is not None and self.status == "running" else None,
+            "created": self.created,
+            "finished": self.finished_at,
+        }
+        if self.error:
+            data["error"] = self.error
+        if self.pipeline is not None and self.status == "running":
+            data["pipeline"] = self.pipeline.metrics()
+        return data
+
+
+class JobManager:
+    """
+    Runs directory ingests in the background, one job at a time.  Job state and checkpoints are saved in the
+    database so jobs interrupted by a restart carry on from their last checkpoint.
+    """
+    columns = ("id", "path", "options", "status", "total", "position", "offset", "processed", "skipped", "failed",
+               "removed", "error", "created", "finished")
+
+    def __init__(self, program_args, feature_extractor, database, shutdown_event):
+        self.program_args = program_args
+        self.feature_extractor = feature_extractor
+        self.database = database
+        self.shutdown_event = shutdown_event
+        self.directory = database.filename.with_suffix(".jobs")
+        self.directory.mkdir(exist_ok=True)
+        self.jobs = {}
+        self.queue = Queue()
+        with database.lock, database.conn:
+            database.conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id VARCHAR(32) PRIMARY KEY,
+                    path TEXT,
+                    options TEXT,
+                    status VARCHAR(16),
+                    total INTEGER,
+                    position INTEGER DEFAULT 0,
+                    offset INTEGER DEFAULT 0,
+                    processed INTEGER DEFAULT 0,
+                    skipped INTEGER DEFAULT 0,
+                    failed INTEGER DEFAULT 0,
+                    removed INTEGER DEFAULT 0,
+                    error TEXT,
+                    created REAL,
+                    finished REAL
+                )
+            """)
+        self.worker = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        """ Loads previous jobs, re-queues unfinished ones and starts the worker thread. """
+        with self.database.lock:
+            rows = self.database.conn.execute(f"SELECT {', '.join(self.columns)} FROM jobs ORDER BY created").fetchall()
+        for values in rows:
+            row = dict(zip(self.columns, values))
+            row["options"] = orjson.loads(row["options"])
+            job = IngestJob(self, row)
+            self.jobs[job.id] = job
+            if job.status in ("queued", "listing", "running", "pruning"):
+                print(f"Resuming job {job.id} for {job.path} at image {job.checkpoint.line}")
+                job.status = "queued"
+                self.queue.put(job)
+        self.worker.start()
+
+    def create_pipeline(self, stop_signal):
+        return IngestPipeline.from_args(self.program_args, self.feature_extractor, self.database, stop_signal)
+
+    def submit(self, path, options):
+        row = {"id": uuid.uuid4().hex[:12], "path": str(path), "options": options, "status": "queued", "total": None,
+               "position": 0, "offset": 0, "processed": 0, "skipped": 0, "failed": 0, "removed": 0, "error": None,
+               "created": time.time(), "finished": None}
+        with self.database.lock, self.database.conn:
+            self.database.conn.execute(f"INSERT INTO jobs ({', '.join(self.columns)}) VALUES ({', '.join('?' * len(self.columns))})",
+                                       [orjson.dumps(v).decode() if k == "options" else v for k, v in row.items()])
+        job = IngestJob(self, row)
+        self.jobs[job.id] = job
+        self.queue.put(job)
+        return job
+
+    def update(self, job, **fields):
+        """ Saves fields plus the job counters. """
+        for key, value in fields.items():
+            if key == "finished":
+                job.finished_at = value
+            elif key not in ("position", "offset"):
+                setattr(job, key, value)
+        fields.update(processed=job.processed, skipped=job.skipped, failed=job.failed, removed=job.removed)
+        with self.database.lock, self.database.conn:
+            self.database.conn.execute(f"UPDATE jobs SET {', '.join(f'{k} = ?' for k in fields)} WHERE id = ?",
+                                       [*fields.values(), job.id])
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def _run(self):
+        while not self.shutdown_event.is_set():
+            job = self.queue.get()
+            if job is None or self.shutdown_event.is_set():
+                break
+            if job.cancel_event.is_set():
+                continue
+            job.run()
+
+    def stop(self):
+        """ Wakes the worker so it can exit, the running job saves its checkpoint when the pipeline stops. """
+        self.queue.put(None)
+        if self.worker.is_alive():
+            self.worker.join()
@@ -0,0 +1,206 @@
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+import orjson
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _labels(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(names, values)) + "}"
+
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {} if self.labels else {(): 0}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, "") for name in self.labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{_labels(self.labels, key)} {value}")
+        return lines
+
+
+class Gauge:
+    """ A value read when the metrics are scraped, so nothing is updated on the request path. """
+    def __init__(self, name, help, function):
+        self.name = name
+        self.help = help
+        self.function = function
+
+    def expose(self):
+        try:
+            value = self.function()
+        except Exception:
+            return []  # Not available yet, for example while the database is loading
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge", f"{self.name} {value}"]
+
+
+class LatencyHistogram:
+    """ Cumulative histogram of seconds per label set, one bisect and one locked update per observation. """
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.series = {}  # Label values -> [bucket counts (the last is +Inf), sum, count]
+        self.lock = threading.Lock()
+
+    def observe(self, seconds, **labels):
+        key = tuple(labels.get(name, "") for name in self.labels)
+        bucket = bisect_left(self.buckets, seconds)
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][bucket] += 1
+            series[1] += seconds
+            series[2] += 1
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for key, (counts, total, count) in sorted(self.series.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + ("+Inf", ), counts):
+                    cumulative += bucket_count
+                    lines.append(f"{self.name}_bucket{_labels(self.labels + ('le', ), key + (bound, ))} {cumulative}")
+                lines.append(f"{self.name}_sum{_labels(self.labels, key)} {total}")
+                lines.append(f"{self.name}_count{_labels(self.labels, key)} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+
+    def add(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def expose(self):
+        """ All metrics in the Prometheus text exposition format. """
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.expose())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+stage_seconds = registry.add(LatencyHistogram("image_search_stage_seconds", "Seconds spent in each stage, inference is per batch", ["stage"]))
+request_seconds = registry.add(LatencyHistogram("image_search_request_seconds", "Seconds to handle a request", ["route"]))
+requests_total = registry.add(Counter("image_search_requests_total", "Requests handled", ["route"]))
+errors_total = registry.add(Counter("image_search_request_errors_total", "Requests answered with an error", ["route"]))
+images_added_total = registry.add(Counter("image_search_images_added_total", "Images written to the database"))
+images_failed_total = registry.add(Counter("image_search_images_failed_total", "Images that could not be decoded or extracted"))
+
+_local = threading.local()  # Per thread stack of running stages and the timings of the current request
+
+
+@contextmanager
+def stage(name, histogram=True):
+    """
+    Times a block as one stage.  Time spent in nested stages is only counted for the inner stage.
+    With histogram=False the time only goes into the request's timing breakdown, used where the work itself is
+    recorded on another thread.
+    """
+    stack = _local.__dict__.setdefault("stack", [])
+    nested = [0.0]
+    stack.append(nested)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        stack.pop()
+        if stack:
+            stack[-1][0] += elapsed
+        own = elapsed - nested[0]
+        if histogram:
+            stage_seconds.observe(own, stage=name)
+        timings = getattr(_local, "timings", None)
+        if timings is not None:
+            timings[name] = timings.get(name, 0.0) + own
+
+
+@contextmanager
+def collect_stages():
+    """
+    Collects the stage timings of a block into a dict, for work done in another process (the ingest decode workers)
+    whose own registry is never scraped.  The parent records them with observe_stages.
+    """
+    previous = getattr(_local, "timings", None)
+    timings = _local.timings = {}
+    try:
+        yield timings
+    finally:
+        _local.timings = previous
+
+
+def observe_stages(timings):
+    for name, seconds in timings.items():
+        stage_seconds.observe(seconds, stage=name)
+
+
+def route_label(path):
+    """ The route a path is counted under, /jobs/<id> is counted as /jobs. """
+    return "/" + path.strip("/").split("/")[0]
+
+
+def _wants_timings(params):
+    value = params.get("timings") if isinstance(params, dict) else None
+    if isinstance(value, list):
+        value = value[0] if value else None
+    return value in (True, 1, "1", "true")
+
+
+@contextmanager
+def track_request(route, params):
+    """ Counts and times a request, collecting a per stage breakdown when it was asked for with timings=1. """
+    _local.route = route
+    _local.timings = {} if _wants_timings(params) else None
+    _local.started = time.perf_counter()
+    requests_total.inc(route=route)
+    try:
+        yield
+    except Exception:
+        errors_total.inc(route=route)
+        raise
+    finally:
+        request_seconds.observe(time.perf_counter() - _local.started, route=route)
+        _local.route = None
+        _local.timings = None
+
+
+def response_body(data):
+    """
+    Serializes the JSON response of the current request, counting errors.  If timings were requested they are
+    appended after serializing, so the breakdown includes the serialize stage and the total includes it too.
+    """
+    with stage("serialize"):
+        body = orjson.dumps(data)
+    route = getattr(_local, "route", None)
+    if route is None or not isinstance(data, dict):
+        return body
+    if "error" in data:
+        errors_total.inc(route=route)
+    timings = getattr(_local, "timings", None)
+    if timings is not None:
+        breakdown = orjson.dumps({"timings": {**{name: round(1000 * seconds, 3) for name, seconds in timings.items()},
+                                              "total": round(1000 * (time.perf_counter() - _local.started), 3)}})
+        body = body[:-1] + (b"," if data else b"") + breakdown[1:]  # Adds the key to the serialized object
+    return body
@@ -0,0 +1,152 @@
+import multiprocessing
+import os
+import threading
+import time
+from pathlib import Path
+from queue import Empty
+
+from helpers.file_scanner import scan_images
+
+
+def list_paths(source):
+    """ Yields image paths from a directory tree, or from a text file with one path per line. """
+    source = Path(source)
+    if source.is_dir():
+        for entry in scan_images(source):
+            yield os.path.abspath(entry.path)
+    else:
+        with open(source, encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield os.path.abspath(line)
+
+
+def ingest_partition(number, list_file, partition_path, settings, progress):
+    """ Worker process: extracts every image in its list into its own partition database. """
+    # Must be set before torch / tensorflow are imported so each model copy only uses its share of the cores
+    threads = str(settings["intra_op_threads"])
+    os.environ.update({"OMP_NUM_THREADS": threads, "MKL_NUM_THREADS": threads,
+                       "TF_NUM_INTRAOP_THREADS": threads, "TF_NUM_INTEROP_THREADS": "1"})
+
+    from extractors.lazy_extractor import LazyExtractor
+    from providers.database import Database
+    from providers.descriptor_store import DescriptorStore
+    from providers.ingest_pipeline import IngestPipeline
+
+    feature_extractor = LazyExtractor(settings["extractor"], settings["extractor_options"])
+    database = Database(partition_path, use_store=False)
+    database.check_model_tag(feature_extractor.model_tag, feature_extractor.model_tag)
+    database.load(write_only=True)
+    database.start_writer(settings["write_batch"], settings["write_interval"])
+    descriptor_store = None
+    if settings["descriptors"]:
+        descriptor_store = DescriptorStore(database, settings["descriptors"], settings["descriptor_features"])
+
+    pipeline = IngestPipeline(feature_extractor, database,
+                              decode_workers=settings["decode_workers"],
+                              inference_workers=1,
+                              batch_size=settings["batch_size"],
+                              batch_wait=settings["batch_wait"],
+                              write_batch=settings["write_batch"],
+                              queue_depth=settings["queue_depth"],
+                              shutdown_event=threading.Event(),
+                              verbose=settings["verbose"],
+                              descriptor_store=descriptor_store)
+    with open(list_file, encoding="utf-8") as f:
+        pipeline.run((line.rstrip("\n") for line in f),
+                     on_written=lambda paths: progress.put((number, len(paths), 0)),
+                     on_failed=lambda path: progress.put((number, 0, 1)))
+    database.close()
+    progress.put((number, None, pipeline.metrics()))
+
+
+class OfflineIngest:
+    """
+    Builds a database without the web server.  The image list is split across worker processes, each with its
+    own model and share of the cores, which write to partition databases that are merged into the main
+    database at the end.  The finished files can then be copied to the serving hosts.
+    """
+    def __init__(self, database, workers, settings, update=False):
+        self.database = database
+        self.workers = max(1, workers)
+        self.settings = dict(settings, intra_op_threads=max(1, (os.cpu_count() or 1) // self.workers))
+        self.update = update
+        self.directory = database.filename.with_suffix(".ingest")
+
+    def partition(self, source):
+        """ Deals the new images out to one list file per worker, returns (list files, images, skipped). """
+        self.directory.mkdir(exist_ok=True)
+        lists = [self.directory / f"part-{number}.txt" for number in range(self.workers)]
+        files = [open(path, "w", encoding="utf-8") for path in lists]
+        total = skipped = 0
+        try:
+            for path in list_paths(source):
+                if not self.update and self.database.exists(os.path.basename(path)):
+                    skipped += 1
+                    continue
+                files[total % self.workers].write(path + "\n")
+                total += 1
+        finally:
+            for f in files:
+                f.close()
+        return lists, total, skipped
+
+    def run(self, source):
+        start = time.monotonic()
+        lists, total, skipped = self.partition(source)
+        print(f"Ingesting {total} images ({skipped} already in the database) with {self.workers} workers, "
+              f"{self.settings['intra_op_threads']} inference threads each")
+
+        progress = multiprocessing.Queue()
+        partitions = [self.directory / f"part-{number}" for number in range(min(self.workers, total))]
+        processes = [multiprocessing.Process(target=ingest_partition, args=(number, lists[number], partitions[number], self.settings, progress))
+                     for number in range(len(partitions))]
+        for process in processes:
+            process.start()
+
+        written = failed = 0
+        running = len(processes)
+        last_output = 0
+        metrics = {}
+        try:
+            while running:
+                try:
+                    number, count, extra = progress.get(timeout=1)
+                except Empty:
+                    running = sum(process.is_alive() for process in processes)  # A worker may have died
+                    continue
+                if count is None:
+                    running -= 1
+                    metrics[number] = extra
+                    continue
+                written += count
+                failed += extra
+                if written - last_output >= self.settings["output"]:
+                    last_output = written
+                    rate = written / (time.monotonic() - start)
+                    print(f"Completed {written} / {total} | Failed {failed} | {rate:.1f} images/sec")
+        except KeyboardInterrupt:
+            print("Stopping workers, the images written so far will be merged")
+            for process in processes:
+                process.terminate()
+        for process in processes:
+            process.join()
+            if process.exitcode:
+                print(f"Ingest worker {processes.index(process)} exited with code {process.exitcode}")
+
+        merged = 0
+        for partition in partitions:
+            partition_file = partition.with_suffix(".sqlite")
+            if partition_file.exists():
+                merged += self.database.merge(partition_file)
+                for suffix in (".sqlite", ".sqlite-wal", ".sqlite-shm"):
+                    partition.with_suffix(suffix).unlink(missing_ok=True)
+        for path in lists:
+            path.unlink(missing_ok=True)
+        self.directory.rmdir()
+
+        elapsed = time.monotonic() - start
+        print(f"Merged {merged} images into {self.database.filename} in {elapsed:.1f}s ({merged / elapsed:.1f} images/sec)")
+        return {"images": merged, "skipped": skipped, "failed": failed, "seconds": round(elapsed, 1),
+                "images_per_sec": round(merged / elapsed, 2), "workers": [metrics[number] for number in sorted(metrics)]}
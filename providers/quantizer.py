@@ -0,0 +1,233 @@
+import threading
+import numpy as np
+
+from providers.index import ExactIndex, kmeans, nearest_centroids
+
+
+class ProductQuantizer:
+    """
+    Splits vectors into `m` sub-vectors and replaces each one with the id of its nearest of 256 k-means centroids,
+    so a vector is stored in `m` bytes.  Searches use asymmetric distances: the query stays in float32 and is
+    compared to the centroids through a per-query lookup table.
+    """
+    def __init__(self, dim, m=96):
+        # Use the largest sub-vector count <= m that divides the dimension
+        self.m = max(d for d in range(1, min(m, dim) + 1) if dim % d == 0)
+        self.dim = dim
+        self.dsub = dim // self.m
+        self.centroids = None  # (m, 256, dsub)
+
+    def train(self, sample):
+        sample = np.asarray(sample, dtype=np.float32)
+        ksub = min(256, len(sample))
+        self.centroids = np.zeros((self.m, 256, self.dsub), dtype=np.float32)
+        for j in range(self.m):
+            self.centroids[j, :ksub] = kmeans(np.ascontiguousarray(sample[:, j * self.dsub:(j + 1) * self.dsub]), ksub, iterations=8)
+            if ksub < 256:
+                self.centroids[j, ksub:] = 1e6  # Far away so they are never chosen when encoding
+
+    def encode(self, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        codes = np.empty((len(vectors), self.m), dtype=np.uint8)
+        for j in range(self.m):
+            codes[:, j] = nearest_centroids(vectors[:, j * self.dsub:(j + 1) * self.dsub], self.centroids[j])
+        return codes
+
+    def distance_table(self, query):
+        """ Squared distance from every query sub-vector to every centroid, shape (m, 256). """
+        sub = query.reshape(self.m, 1, self.dsub)
+        return ((self.centroids - sub) ** 2).sum(axis=2)
+
+    def distances(self, table, codes):
+        """ Squared asymmetric distances between the query behind `table` and a chunk of codes. """
+        return table[np.arange(self.m), codes].sum(axis=1)
+
+    def code_size(self):
+        return self.m
+
+
+class ScalarQuantizer:
+    """ Stores every dimension as one byte between the per-dimension minimum and maximum seen in training. """
+    def __init__(self, dim):
+        self.dim = dim
+        self.low = None
+        self.scale = None
+
+    def train(self, sample):
+        sample = np.asarray(sample, dtype=np.float32)
+        self.low = sample.min(axis=0)
+        self.scale = np.maximum(sample.max(axis=0) - self.low, 1e-12) / 255
+
+    def encode(self, vectors):
+        codes = np.rint((np.asarray(vectors, dtype=np.float32) - self.low) / self.scale)
+        return np.clip(codes, 0, 255).astype(np.uint8)
+
+    def decode(self, codes):
+        return codes.astype(np.float32) * self.scale + self.low
+
+    def distance_table(self, query):
+        return query
+
+    def distances(self, query, codes):
+        diff = self.decode(codes) - query
+        return np.einsum("ij,ij->i", diff, diff)
+
+    def code_size(self):
+        return self.dim
+
+
+class QuantizedIndex:
+    """
+    Compressed index holding only quantized codes in RAM (pq = product quantization, sq8 = one byte per dimension).
+    Optionally the top `rerank` x k candidates are re-scored with the full precision vectors returned by `fetch`,
+    which the Database points at the SQLite blobs.  Until the quantizer is trained vectors are kept in an ExactIndex.
+    """
+    supports_allowed = False
+
+    def __init__(self, kind="pq", subvectors=96, train_size=20000, rerank=0, chunk_rows=65536):
+        self.kind = kind
+        self.subvectors = subvectors
+        self.train_size = train_size
+        self.rerank = rerank
+        self.chunk_rows = chunk_rows
+        self.quantizer = None
+        self.fetch = None  # Callable(keys) -> {key: full precision vector}
+        self.codes = None
+        self.keys = []
+        self.positions = {}
+        self.pending = ExactIndex()
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.keys) + len(self.pending)
+
+    def __contains__(self, key):
+        return key in self.positions or key in self.pending
+
+    @property
+    def trained(self):
+        return self.quantizer is not None
+
+    def train(self, sample=None, count=None):
+        """ Trains the quantizer from a sample (or the pending vectors) and encodes the pending vectors. """
+        with self.lock:
+            data = self.pending.matrix().astype(np.float32) if sample is None else np.asarray(sample, dtype=np.float32)
+            if len(data) == 0:
+                return
+            if len(data) > self.train_size:
+                data = data[np.random.default_rng(0).choice(len(data), size=self.train_size, replace=False)]
+            dim = data.shape[1]
+            quantizer = ProductQuantizer(dim, self.subvectors) if self.kind == "pq" else ScalarQuantizer(dim)
+            quantizer.train(data)
+            self.quantizer = quantizer
+
+            pending = self.pending
+            self.pending = ExactIndex()
+            if len(pending):
+                self._encode(pending.live_keys(), pending.matrix().astype(np.float32))
+
+    def _reserve(self, size):
+        width = self.quantizer.code_size()
+        if self.codes is None:
+            self.codes = np.empty((max(1024, size), width), dtype=np.uint8)
+        elif size > len(self.codes):
+            codes = np.empty((max(size, len(self.codes) * 2), width), dtype=np.uint8)
+            codes[:len(self.keys)] = self.codes[:len(self.keys)]
+            self.codes = codes
+
+    def _encode(self, keys, vectors):
+        self._reserve(len(self.keys) + len(keys))
+        for start in range(0, len(keys), self.chunk_rows):
+            chunk_keys = keys[start:start + self.chunk_rows]
+            codes = self.quantizer.encode(vectors[start:start + self.chunk_rows])
+            for key, code in zip(chunk_keys, codes):
+                row = self.positions.get(key)
+                if row is None:
+                    row = len(self.keys)
+                    self.keys.append(key)
+                    self.positions[key] = row
+                self.codes[row] = code
+
+    def attach(self, keys, vectors, norms=None, deleted=None):
+        """ Encodes a block (for example a memory-mapped segment) chunk by chunk, keeping only the codes. """
+        live = np.arange(len(keys)) if deleted is None else np.flatnonzero(~deleted)
+        for start in range(0, len(live), self.chunk_rows):
+            rows = live[start:start + self.chunk_rows]
+            self.add_many([keys[i] for i in rows], np.asarray(vectors[rows], dtype=np.float32))
+
+    def add(self, key, vector):
+        self.add_many([key], [vector])
+
+    def add_many(self, keys, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if len(keys) == 0:
+            return
+        with self.lock:
+            if self.quantizer is None:
+                self.pending.add_many(keys, vectors)
+                if len(self.pending) >= self.train_size:
+                    self.train()
+            else:
+                self._encode(list(keys), vectors)
+
+    def remove(self, key):
+        with self.lock:
+            if self.pending.remove(key):
+                return True
+            row = self.positions.pop(key, None)
+            if row is None:
+                return False
+            last = len(self.keys) - 1
+            if row != last:
+                moved = self.keys[last]
+                self.codes[row] = self.codes[last]
+                self.keys[row] = moved
+                self.positions[moved] = row
+            self.keys.pop()
+            return True
+
+    def _candidates(self, query, count):
+        """ Top `count` (key, squared asymmetric distance) pairs from the codes. """
+        table = self.quantizer.distance_table(query)
+        best_ids = np.empty(0, dtype=np.int64)
+        best_dists = np.empty(0, dtype=np.float32)
+        for start in range(0, len(self.keys), self.chunk_rows):
+            dists = self.quantizer.distances(table, self.codes[start:min(start + self.chunk_rows, len(self.keys))])
+            best_dists = np.concatenate([best_dists, dists])
+            best_ids = np.concatenate([best_ids, np.arange(start, start + len(dists))])
+            if len(best_ids) > count:
+                keep = np.argpartition(best_dists, count - 1)[:count]
+                best_dists, best_ids = best_dists[keep], best_ids[keep]
+        order = np.argsort(best_dists)
+        return [(self.keys[i], float(d)) for i, d in zip(best_ids[order], best_dists[order])]
+
+    def search(self, query_vector, top_k=5):
+        with self.lock:
+            query = np.asarray(query_vector, dtype=np.float32).ravel()
+            results = self.pending.search(query, top_k)
+            if self.quantizer is None or not self.keys or top_k <= 0:
+                return results
+
+            count = top_k * self.rerank if self.rerank and self.fetch is not None else top_k
+            candidates = self._candidates(query, count)
+
+        if self.rerank and self.fetch is not None:
+            vectors = self.fetch([key for key, _ in candidates])
+            rescored = [(key, float(np.linalg.norm(vectors[key] - query))) for key, _ in candidates if key in vectors]
+        else:
+            rescored = [(key, float(np.sqrt(max(d, 0.0)))) for key, d in candidates]
+
+        results.extend(rescored)
+        results.sort(key=lambda r: r[1])
+        return results[:top_k]
+
+    def search_many(self, query_vectors, top_k=5):
+        return [self.search(query_vector, top_k) for query_vector in query_vectors]
+
+    def memory(self):
+        return self.pending.memory() + (0 if self.codes is None else self.codes.nbytes)
+
+    def stats(self):
+        return {"type": self.kind, "vectors": len(self), "trained": self.trained,
+                "code_bytes": self.quantizer.code_size() if self.quantizer else None,
+                "rerank": self.rerank, "memory_bytes": self.memory()}
@@ -0,0 +1,118 @@
+import math
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, wait
+
+from providers.compare import Compare, COMPARATORS
+from providers.descriptor_store import DESCRIPTOR_LAYOUT
+
+# Comparators where a lower score is the better match
+LOWER_IS_BETTER = {"orb"}
+
+
+def score_candidates(query_img, query_descriptors, max_features, candidates, methods, deadline):
+    """ Runs in a worker process: scores a chunk of candidates, skipping comparators once the deadline has passed. """
+    comp = Compare(query_img, max_features=max_features)
+    comp.query_descriptors = dict(query_descriptors)
+
+    scores = []
+    for path2, descriptors in candidates:
+        comp.set(path2, descriptors)
+        result = {}
+        for method in methods:
+            if time.time() > deadline:
+                result[method] = "timeout"
+                continue
+            try:
+                result[method] = str(getattr(comp, method)())
+            except Exception as e:
+                result[method] = f"error: {e}"
+        scores.append(result)
+    return scores
+
+
+class Reranker:
+    """ Scores search results with the Compare methods on a shared process pool. """
+    _executor = None
+    _lock = threading.Lock()
+
+    def __init__(self, workers, descriptor_store=None):
+        self.workers = workers
+        self.descriptor_store = descriptor_store
+
+    def executor(self):
+        """ The pool is created on first use and shared between requests. """
+        with Reranker._lock:
+            if Reranker._executor is None:
+                Reranker._executor = ProcessPoolExecutor(max_workers=self.workers)
+            return Reranker._executor
+
+    @staticmethod
+    def methods(compare_opts):
+        return [c for c in compare_opts if c in COMPARATORS]
+
+    def rerank(self, query, results, compare_opts, timeout=None, sort_by=None):
+        """ Adds a `compare` dict to every result, then optionally re-sorts the results by one comparator. """
+        methods = self.methods(compare_opts)
+        if not results or not methods:
+            return results
+
+        # Decode the search image and compute its descriptors once for the whole request
+        comp = Compare(query, self.descriptor_store)
+        query_img = comp.image1()
+        query_descriptors = comp.query([m for m in methods if m in DESCRIPTOR_LAYOUT])
+
+        candidates = []
+        for result in results:
+            descriptors = {}
+            if self.descriptor_store is not None:
+                for m in methods:
+                    if m in DESCRIPTOR_LAYOUT:
+                        descriptors[m] = self.descriptor_store.get(os.path.basename(result["image"]), m)
+            candidates.append((result["image"], descriptors))
+
+        deadline = time.time() + timeout if timeout else math.inf
+
+        if self.workers > 0:
+            scores = self._score_parallel(query_img, query_descriptors, comp.max_features, candidates, methods, deadline)
+        else:
+            scores = score_candidates(query_img, query_descriptors, comp.max_features, candidates, methods, deadline)
+
+        for result, score in zip(results, scores):
+            result["compare"] = score
+
+        if sort_by in methods:
+            results.sort(key=lambda r: self.sort_key(r["compare"].get(sort_by), sort_by))
+        return results
+
+    def _score_parallel(self, query_img, query_descriptors, max_features, candidates, methods, deadline):
+        executor = self.executor()
+        chunk = max(1, math.ceil(len(candidates) / (self.workers * 2)))
+        futures = [executor.submit(score_candidates, query_img, query_descriptors, max_features,
+                                   candidates[i:i + chunk], methods, deadline)
+                   for i in range(0, len(candidates), chunk)]
+
+        wait(futures, timeout=None if deadline == math.inf else max(0.0, deadline - time.time()) + 0.1)
+
+        scores = []
+        for i, future in zip(range(0, len(candidates), chunk), futures):
+            size = len(candidates[i:i + chunk])
+            if future.done() and not future.cancelled() and future.exception() is None:
+                scores.extend(future.result())
+            else:
+                future.cancel()
+                status = "timeout" if not future.done() or future.cancelled() else f"error: {future.exception()}"
+                scores.extend({m: status for m in methods} for _ in range(size))
+        return scores
+
+    @staticmethod
+    def sort_key(value, method):
+        """ Best score first, timed out or failed comparisons last. """
+        try:
+            score = float(value)
+        except (TypeError, ValueError):
+            return (1, 0.0)
+        if math.isnan(score):
+            return (1, 0.0)
+        return (0, score if method in LOWER_IS_BETTER else -score)
@@ -0,0 +1,128 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+
+def digest(data):
+    """ Hash of image bytes or a feature vector, used as a cache key. """
+    hasher = xxhash.xxh3_128() if xxhash is not None else hashlib.blake2b(digest_size=16)
+    hasher.update(data)
+    return hasher.hexdigest()
+
+
+class LRUCache:
+    """ Least recently used cache which evicts entries once their total size passes max_bytes. """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.entries = OrderedDict()  # Key -> (value, size)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, size):
+        with self.lock:
+            if size > self.max_bytes:
+                return
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.bytes -= previous[1]
+            self.entries[key] = (value, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.bytes -= evicted
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {"entries": len(self.entries), "bytes": self.bytes, "max_bytes": self.max_bytes, "hits": self.hits,
+                    "misses": self.misses, "evictions": self.evictions,
+                    "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0}
+
+
+class SearchCache:
+    """
+    In memory cache for repeated searches.  The first layer maps (image content, extractor) to the feature vector,
+    the second maps (feature vector, limit, comparators, index version) to the results.  Results are dropped as
+    soon as the database version changes, as any add or remove can change them.
+    """
+    entry_overhead = 128  # Rough bytes of Python objects per entry
+
+    def __init__(self, database, extractor, max_bytes=64 * 1024 * 1024):
+        self.database = database
+        self.extractor = extractor
+        self.features = LRUCache(max_bytes // 4)
+        self.results = LRUCache(max_bytes - max_bytes // 4)
+        self.version = database.version
+        self.invalidations = 0
+
+    def image_key(self, image):
+        """ Cache key for a search image: a path, base64 data URI or UploadedImage.  None if it can not be read. """
+        if isinstance(image, str):
+            data = image.encode("utf-8")
+        elif hasattr(image, "data"):
+            data = image.data
+        else:
+            try:
+                with open(image, "rb") as f:
+                    data = f.read()
+            except OSError:
+                return None
+        return f"{self.extractor}:{digest(data)}"
+
+    def get_features(self, key):
+        return self.features.get(key) if key is not None else None
+
+    def put_features(self, key, features):
+        if key is not None and features is not None:
+            self.features.put(key, features, features.nbytes + self.entry_overhead)
+
+    def _check_version(self):
+        version = self.database.version
+        if version != self.version:
+            self.results.clear()
+            self.version = version
+            self.invalidations += 1
+        return version
+
+    def result_key(self, features, *options):
+        return (digest(np.ascontiguousarray(features, dtype=np.float32)), self._check_version(), *options)
+
+    def get_results(self, key):
+        if key[1] != self._check_version():
+            return None
+        return self.results.get(key)
+
+    def put_results(self, key, results):
+        if key[1] != self.database.version:
+            return  # The database changed while searching
+        size = self.entry_overhead + sum(self.entry_overhead + len(result["image"]) for result in results)
+        self.results.put(key, results, size)
+
+    def stats(self):
+        return {"features": self.features.stats(), "results": self.results.stats(), "invalidations": self.invalidations}
@@ -0,0 +1,366 @@
+import itertools
+import multiprocessing
+import signal
+import threading
+import time
+from concurrent.futures import Future, TimeoutError
+
+import numpy as np
+
+from providers.index import ExactIndex
+
+
+def _open_vectors(source):
+    """ Rebuilds a shard's rows in the worker, memory-mapped segments are mapped again instead of copied. """
+    if isinstance(source, np.ndarray):
+        return source
+    filename, offset, shape, dtype, start, stop = source
+    return np.memmap(filename, dtype=dtype, mode="r", offset=offset, shape=shape)[start:stop]
+
+
+class ShardError(Exception):
+    """ Sent back in place of a result when a shard could not handle a request. """
+
+
+def _run_searches(conn, index, searches, allowed=None):
+    """ Answers several queued searches with one search_many call, a filtered search is always run on its own. """
+    start = time.monotonic()
+    try:
+        queries = np.vstack([message[2] for message in searches])
+        top_k = max(message[3] for message in searches)
+        results = index.search_many(queries, top_k, allowed=allowed)
+    except Exception as e:
+        if len(searches) == 1:
+            conn.send((searches[0][1], ShardError(f"Search failed: {e}"), 0.0))
+        else:  # Answer each search on its own so one bad query does not fail the others
+            for search in searches:
+                _run_searches(conn, index, [search])
+        return
+    elapsed = 1000 * (time.monotonic() - start)
+
+    row = 0
+    for _, request_id, vectors, k in searches:
+        conn.send((request_id, [result[:k] for result in results[row:row + len(vectors)]], elapsed))
+        row += len(vectors)
+
+
+def _handle(conn, index, message, errors):
+    """ Handles one message other than a search.  Errors are answered or, for messages without a reply, counted. """
+    kind = message[0]
+    try:
+        if kind == "attach":
+            _, keys, source, norms, deleted = message
+            index.attach(keys, _open_vectors(source), norms, deleted)
+        elif kind == "add":
+            index.add_many(message[1], message[2])
+        elif kind == "remove":
+            index.remove(message[1])
+        elif kind == "filtered":
+            _run_searches(conn, index, [message[:4]], allowed=message[4])
+        elif kind == "get":
+            conn.send((message[1], index.get(message[2]), 0.0))
+        elif kind == "stats":
+            conn.send((message[1], {"vectors": len(index), "memory_bytes": index.memory(), "mapped_bytes": index.mapped(),
+                                    "mapped_dtype": index.mapped_dtype(), "errors": errors[0], "last_error": errors[1]}, 0.0))
+    except Exception as e:
+        print(f"Search shard failed to handle '{kind}': {e}")
+        if kind in ("get", "stats"):
+            conn.send((message[1], ShardError(f"'{kind}' failed: {e}"), 0.0))
+        else:  # The shard no longer holds exactly what the index expects
+            errors[0] += 1
+            errors[1] = f"'{kind}' failed: {e}"
+
+
+def shard_worker(conn, dtype, chunk_rows, max_batch=64):
+    """ Worker process holding one shard in an ExactIndex, messages are handled in the order they are sent. """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # The server shuts the shards down itself on Ctrl+C
+    index = ExactIndex(dtype=dtype, chunk_rows=chunk_rows)
+    searches = []
+    errors = [0, None]  # Failed messages without a reply, and the last error
+    while True:
+        if searches and (len(searches) >= max_batch or not conn.poll()):
+            _run_searches(conn, index, searches)
+            searches = []
+            continue
+
+        message = conn.recv()
+        if message is not None and message[0] == "search":
+            searches.append(message)
+            continue
+        if searches:
+            _run_searches(conn, index, searches)
+            searches = []
+
+        if message is None:
+            break
+        _handle(conn, index, message, errors)
+    conn.close()
+
+
+class ShardStats:
+    def __init__(self):
+        self.searches = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.compute_ms = 0.0
+        self.lock = threading.Lock()
+
+    def record(self, elapsed, compute):
+        with self.lock:
+            self.searches += 1
+            self.total_ms += elapsed
+            self.max_ms = max(self.max_ms, elapsed)
+            self.compute_ms += compute
+
+    def to_dict(self):
+        with self.lock:
+            searches = max(self.searches, 1)
+            return {"searches": self.searches, "avg_ms": round(self.total_ms / searches, 3),
+                    "avg_compute_ms": round(self.compute_ms / searches, 3), "max_ms": round(self.max_ms, 3)}
+
+
+class Shard:
+    """ Front end of one worker process, replies are matched to their request by a reader thread. """
+    def __init__(self, number, dtype, chunk_rows):
+        self.number = number
+        self.vectors = 0
+        self.stats = ShardStats()
+        self.conn, child = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=shard_worker, args=(child, dtype, chunk_rows), daemon=True)
+        self.process.start()
+        child.close()
+        self.pending = {}
+        self.pending_lock = threading.Lock()  # Taken by call() and by the reader when the worker stops
+        self.stopped = False
+        self.send_lock = threading.Lock()
+        self.reader = threading.Thread(target=self._read, daemon=True)
+        self.reader.start()
+
+    @property
+    def alive(self):
+        return not self.stopped and self.process.is_alive()
+
+    def _read(self):
+        while True:
+            try:
+                request_id, result, compute = self.conn.recv()
+            except (EOFError, OSError):
+                break
+            with self.pending_lock:
+                future = self.pending.pop(request_id, None)
+            if future is None:
+                continue
+            future.compute = compute
+            if isinstance(result, ShardError):
+                future.set_exception(RuntimeError(f"Search shard {self.number}: {result}"))
+            else:
+                future.set_result(result)
+
+        with self.pending_lock:
+            self.stopped = True
+            pending, self.pending = self.pending, {}
+        if pending:
+            print(f"Search shard {self.number} stopped with exit code {self.process.exitcode}")
+        for future in pending.values():
+            future.set_exception(RuntimeError(f"Search shard {self.number} stopped"))
+
+    def send(self, message):
+        with self.send_lock:
+            self.conn.send(message)
+
+    def call(self, kind, request_id, *args):
+        future = Future()
+        future.request_id = request_id
+        with self.pending_lock:
+            if self.stopped:
+                raise RuntimeError(f"Search shard {self.number} stopped")
+            self.pending[request_id] = future
+        try:
+            self.send((kind, request_id, *args))
+        except OSError:
+            with self.pending_lock:
+                self.pending.pop(request_id, None)
+            raise RuntimeError(f"Search shard {self.number} stopped")
+        return future
+
+    def wait(self, future, timeout):
+        """ Result of a call, a shard that does not answer in time is treated as stopped. """
+        try:
+            return future.result(timeout=timeout)
+        except TimeoutError:
+            with self.pending_lock:
+                self.pending.pop(future.request_id, None)
+            raise RuntimeError(f"Search shard {self.number} stopped, no reply within {timeout}s")
+
+    def close(self):
+        try:
+            self.send(None)
+        except OSError:
+            pass
+        self.process.join(timeout=5)
+        self.conn.close()
+
+
+class ShardedIndex:
+    """
+    Exact index split across worker processes so searches use more than one core.  Memory-mapped vector store
+    segments are divided into contiguous row ranges which each worker maps itself, new vectors go to the shard
+    holding the fewest.  Every query is sent to all shards and their top-k lists are merged, giving the same
+    results as a single ExactIndex.
+    """
+    supports_allowed = True  # search_many can be restricted to a set of keys
+
+    def __init__(self, shards=2, dtype="float32", chunk_rows=16384, timeout=30.0):
+        self.dtype = np.dtype(dtype)
+        self.timeout = timeout  # Seconds to wait for a shard's reply
+        self.shards = [Shard(number, dtype, chunk_rows) for number in range(shards)]
+        self.owner = {}  # Key -> shard number
+        self.request_ids = itertools.count()
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.owner)
+
+    def __contains__(self, key):
+        return key in self.owner
+
+    def _take(self, key, shard):
+        """ Records the new owner of a key, removing the copy held by another shard. """
+        previous = self.owner.get(key)
+        if previous is not None and previous != shard:
+            self.shards[previous].send(("remove", key))
+            self.shards[previous].vectors -= 1
+        if previous != shard:
+            self.shards[shard].vectors += 1
+        self.owner[key] = shard
+
+    def attach(self, keys, vectors, norms=None, deleted=None):
+        if norms is None:
+            norms = np.einsum("ij,ij->i", vectors, vectors, dtype=np.float32)
+        if deleted is None:
+            deleted = np.zeros(len(vectors), dtype=bool)
+        mapped = isinstance(vectors, np.memmap) and vectors.filename is not None and vectors.flags.c_contiguous
+
+        bounds = np.linspace(0, len(vectors), len(self.shards) + 1).astype(int)
+        with self.lock:
+            for shard, start, stop in zip(self.shards, bounds[:-1], bounds[1:]):
+                if start == stop:
+                    continue
+                if mapped:
+                    source = (vectors.filename, vectors.offset, vectors.shape, vectors.dtype.str, int(start), int(stop))
+                else:
+                    source = np.ascontiguousarray(vectors[start:stop])
+                shard_keys = list(keys[start:stop])
+                shard.send(("attach", shard_keys, source, np.asarray(norms[start:stop]), np.asarray(deleted[start:stop])))
+                for key, removed in zip(shard_keys, deleted[start:stop]):
+                    if not removed:
+                        self._take(key, shard.number)
+
+    def add(self, key, vector):
+        self.add_many([key], [vector])
+
+    def add_many(self, keys, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if len(keys) == 0:
+            return
+        with self.lock:
+            groups = {}
+            for key, vector in zip(keys, vectors):
+                shard = self.owner.get(key)
+                if shard is None:
+                    shard = min(self.shards, key=lambda s: s.vectors).number
+                self._take(key, shard)
+                groups.setdefault(shard, ([], []))
+                groups[shard][0].append(key)
+                groups[shard][1].append(vector)
+            for shard, (shard_keys, shard_vectors) in groups.items():
+                self.shards[shard].send(("add", shard_keys, np.vstack(shard_vectors)))
+
+    def remove(self, key):
+        with self.lock:
+            shard = self.owner.pop(key, None)
+            if shard is None:
+                return False
+            self.shards[shard].send(("remove", key))
+            self.shards[shard].vectors -= 1
+            return True
+
+    def get(self, key):
+        shard = self.owner.get(key)
+        if shard is None:
+            return None
+        shard = self.shards[shard]
+        return shard.wait(shard.call("get", next(self.request_ids), key), self.timeout)
+
+    def search(self, query_vector, top_k=5):
+        return self.search_many([query_vector], top_k)[0]
+
+    def search_many(self, query_vectors, top_k=5, allowed=None):
+        """
+        Fans the queries out to every shard and merges their sorted top-k lists.
+        allowed restricts the search to a collection of keys, each shard is sent the ones it holds.
+        """
+        queries = np.asarray(query_vectors, dtype=np.float32).reshape(len(query_vectors), -1)
+        if not self.owner or top_k <= 0:
+            return [[] for _ in range(len(queries))]
+
+        start = time.monotonic()
+        if allowed is None:
+            calls = [(shard, shard.call("search", next(self.request_ids), queries, top_k)) for shard in self.shards]
+        else:
+            groups = {}
+            for key in allowed:
+                shard = self.owner.get(key)
+                if shard is not None:
+                    groups.setdefault(shard, []).append(key)
+            calls = [(self.shards[shard], self.shards[shard].call("filtered", next(self.request_ids), queries, top_k, keys))
+                     for shard, keys in groups.items()]
+        merged = [[] for _ in range(len(queries))]
+        for shard, future in calls:
+            results = shard.wait(future, self.timeout)
+            shard.stats.record(1000 * (time.monotonic() - start), future.compute)
+            for row, result in zip(merged, results):
+                row.extend(result)
+        return [sorted(row, key=lambda item: item[1])[:top_k] for row in merged]
+
+    def _shard_stats(self):
+        """ Stats of each shard, a stopped or failing shard reports only that it is not alive. """
+        futures = []
+        for shard in self.shards:
+            try:
+                futures.append(shard.call("stats", next(self.request_ids)))
+            except RuntimeError as e:
+                futures.append(e)
+        stats = []
+        for shard, future in zip(self.shards, futures):
+            try:
+                if isinstance(future, Exception):
+                    raise future
+                stats.append({"alive": True, **shard.wait(future, self.timeout)})
+            except Exception as e:
+                stats.append({"alive": shard.alive, "error": str(e), "vectors": 0, "memory_bytes": 0, "mapped_bytes": 0,
+                              "mapped_dtype": None})
+        return stats
+
+    def health(self):
+        """ Which shards are still running, searches fail while any of them is stopped. """
+        stopped = [shard.number for shard in self.shards if not shard.alive]
+        return {"shards": len(self.shards), "alive": len(self.shards) - len(stopped), "stopped": stopped}
+
+    def memory(self):
+        return sum(stats["memory_bytes"] for stats in self._shard_stats())
+
+    def stats(self):
+        shards = []
+        for shard, stats in zip(self.shards, self._shard_stats()):
+            shards.append({"shard": shard.number, **stats, **shard.stats.to_dict()})
+        return {"type": "exact", "shards": len(self.shards), "alive": sum(shard["alive"] for shard in shards),
+                "vectors": len(self), "dtype": self.dtype.name,
+                "memory_bytes": sum(shard["memory_bytes"] for shard in shards),
+                "mapped_bytes": sum(shard["mapped_bytes"] for shard in shards),
+                "mapped_dtype": ",".join(sorted({shard["mapped_dtype"] for shard in shards if shard["mapped_dtype"]})) or None,
+                "per_shard": shards}
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
@@ -0,0 +1,40 @@
+import threading
+import time
+from contextlib import contextmanager
+
+
+class Startup:
+    """ Times each phase of starting the server, reported by /health. """
+    def __init__(self):
+        self.started = time.monotonic()
+        self.phases = {}
+        self.ready_after = None
+        self.failed = None  # Why the database could not be loaded
+        self.lock = threading.Lock()
+
+    def record(self, name, seconds):
+        with self.lock:
+            self.phases[name] = round(seconds, 3)
+        print(f"Startup: {name} took {seconds:.2f}s")
+
+    @contextmanager
+    def phase(self, name):
+        start = time.monotonic()
+        yield
+        self.record(name, time.monotonic() - start)
+
+    def ready(self):
+        self.ready_after = round(time.monotonic() - self.started, 3)
+        print(f"Startup: ready after {self.ready_after:.2f}s")
+
+    def fail(self, error):
+        self.failed = str(error)
+        print(f"Startup: failed, {self.failed}")
+
+    def stats(self):
+        with self.lock:
+            stats = {"uptime_sec": round(time.monotonic() - self.started, 1), "ready_after_sec": self.ready_after,
+                     "phases": dict(self.phases)}
+        if self.failed is not None:
+            stats["error"] = self.failed
+        return stats
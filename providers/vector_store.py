@@ -0,0 +1,181 @@
+import json
+import os
+import threading
+from pathlib import Path
+import numpy as np
+
+
+class VectorStore:
+    """
+    Flat float32 vector segments stored next to the SQLite file so the server can memory-map them at startup.
+
+    Every segment has a `.npy` matrix, a `.norms.npy` array of squared lengths, a `.keys` file with one image
+    name per line and a `.tomb.npy` bitmap of deleted rows.  New vectors are buffered and written as a new
+    segment on flush.  SQLite stays the source of truth, the store can always be rebuilt from it.
+    """
+    def __init__(self, path, segment_rows=250000):
+        self.path = Path(path)
+        self.segment_rows = segment_rows
+        self.dim = None
+        self.segments = []  # Manifest entries: {"name", "rows"}
+        self.tombstones = []  # Deleted row flags per segment
+        self.locations = {}  # Key -> (segment number, row), segment number None for pending rows
+        self.pending_keys = []
+        self.pending_vectors = []
+        self.dirty_tombstones = set()
+        self.lock = threading.RLock()
+
+    def exists(self):
+        return (self.path / "manifest.json").exists()
+
+    def __len__(self):
+        return len(self.locations)
+
+    def is_clean(self):
+        """ True when every change has been written to disk. """
+        return not self.pending_keys and not self.dirty_tombstones
+
+    def _reset(self):
+        self.dim = None
+        self.segments = []
+        self.tombstones = []
+        self.locations = {}
+        self.pending_keys = []
+        self.pending_vectors = []
+        self.dirty_tombstones = set()
+
+    def open(self):
+        """ Opens every segment, returns a list of (keys, vectors, norms, deleted) with the vectors memory-mapped. """
+        with self.lock:
+            self._reset()
+            manifest = json.loads((self.path / "manifest.json").read_text(encoding="utf-8"))
+            self.dim = manifest["dim"]
+            self.segments = manifest["segments"]
+
+            blocks = []
+            for number, segment in enumerate(self.segments):
+                name, rows = segment["name"], segment["rows"]
+                vectors = np.load(self.path / f"{name}.npy", mmap_mode="r")
+                norms = np.load(self.path / f"{name}.norms.npy")
+                keys = (self.path / f"{name}.keys").read_text(encoding="utf-8").split("\n")
+                tomb_file = self.path / f"{name}.tomb.npy"
+                if tomb_file.exists():
+                    deleted = np.unpackbits(np.load(tomb_file), count=rows).astype(bool)
+                else:
+                    deleted = np.zeros(rows, dtype=bool)
+                self.tombstones.append(deleted)
+
+                for row, key in enumerate(keys):
+                    if deleted[row]:
+                        continue
+                    previous = self.locations.get(key)
+                    if previous is not None:  # An older copy which was not tombstoned
+                        self.tombstones[previous[0]][previous[1]] = True
+                        self.dirty_tombstones.add(previous[0])
+                    self.locations[key] = (number, row)
+                blocks.append((keys, vectors, norms, deleted))
+            return blocks
+
+    def append(self, keys, vectors):
+        """ Buffers vectors for a new segment, tombstoning any older copy of the same key. """
+        with self.lock:
+            for key, vector in zip(keys, vectors):
+                location = self.locations.get(key)
+                if location is not None and location[0] is None:
+                    self.pending_vectors[location[1]] = np.asarray(vector, dtype=np.float32)
+                    continue
+                if location is not None:
+                    self._tombstone(location)
+                self.locations[key] = (None, len(self.pending_keys))
+                self.pending_keys.append(key)
+                self.pending_vectors.append(np.asarray(vector, dtype=np.float32))
+
+            if len(self.pending_keys) >= self.segment_rows:
+                self.flush()
+
+    def delete(self, key):
+        with self.lock:
+            location = self.locations.pop(key, None)
+            if location is None:
+                return False
+            if location[0] is None:
+                self.pending_keys[location[1]] = None  # Skipped when the segment is written
+            else:
+                self._tombstone(location)
+            return True
+
+    def _tombstone(self, location):
+        number, row = location
+        self.tombstones[number][row] = True
+        self.dirty_tombstones.add(number)
+
+    def _write_segment(self, keys, matrix):
+        name = f"seg-{len(self.segments):06d}"
+        np.save(self.path / f"{name}.npy", matrix)
+        np.save(self.path / f"{name}.norms.npy", np.einsum("ij,ij->i", matrix, matrix, dtype=np.float32))
+        (self.path / f"{name}.keys").write_text("\n".join(keys), encoding="utf-8")
+        number = len(self.segments)
+        self.segments.append({"name": name, "rows": len(keys)})
+        self.tombstones.append(np.zeros(len(keys), dtype=bool))
+        for row, key in enumerate(keys):
+            self.locations[key] = (number, row)
+
+    def _write_manifest(self):
+        manifest = {"dim": self.dim, "segments": self.segments}
+        tmp = self.path / "manifest.json.tmp"
+        tmp.write_text(json.dumps(manifest), encoding="utf-8")
+        os.replace(tmp, self.path / "manifest.json")
+
+    def flush(self):
+        """ Writes buffered vectors as a new segment and saves changed tombstone bitmaps. """
+        with self.lock:
+            if self.is_clean():
+                return
+            self.path.mkdir(parents=True, exist_ok=True)
+
+            live = [i for i, key in enumerate(self.pending_keys) if key is not None]
+            if live:
+                matrix = np.vstack([self.pending_vectors[i] for i in live]).astype(np.float32)
+                if self.dim is None:
+                    self.dim = matrix.shape[1]
+                self._write_segment([self.pending_keys[i] for i in live], matrix)
+            self.pending_keys = []
+            self.pending_vectors = []
+
+            for number in self.dirty_tombstones:
+                name = self.segments[number]["name"]
+                np.save(self.path / f"{name}.tomb.npy", np.packbits(self.tombstones[number]))
+            self.dirty_tombstones = set()
+
+            self._write_manifest()
+
+    def rebuild(self, rows):
+        """ Regenerates the store from an iterable of (key, feature blob) rows, dropping every old segment. """
+        with self.lock:
+            self.path.mkdir(parents=True, exist_ok=True)
+            for file in self.path.iterdir():
+                if file.name.startswith("seg-") or file.name.startswith("manifest"):
+                    file.unlink()
+            self._reset()
+
+            keys = []
+            vectors = []
+            for key, blob in rows:
+                keys.append(key)
+                vectors.append(np.frombuffer(blob, dtype=np.float32))
+                if len(keys) >= self.segment_rows:
+                    self._write_rebuilt(keys, vectors)
+                    keys, vectors = [], []
+            if keys:
+                self._write_rebuilt(keys, vectors)
+            self._write_manifest()
+
+    def _write_rebuilt(self, keys, vectors):
+        matrix = np.vstack(vectors)
+        if self.dim is None:
+            self.dim = matrix.shape[1]
+        self._write_segment(keys, matrix)
+
+    def stats(self):
+        return {"segments": len(self.segments), "vectors": len(self.locations), "pending": len(self.pending_keys),
+                "deleted": int(sum(tombstones.sum() for tombstones in self.tombstones))}